@@ -1,9 +1,11 @@
 from django.contrib import admin
-from .models import User, Futsal, Ground, TimeSlot, Booking, Team, Tournament, Fixture, Post, Comment
+from .models import User, Futsal, Ground, GroundSchedule, ScheduleException, TimeSlot, Booking, Team, Tournament, Fixture, Post, Comment
 
 admin.site.register(User)
 admin.site.register(Futsal)
 admin.site.register(Ground)
+admin.site.register(GroundSchedule)
+admin.site.register(ScheduleException)
 admin.site.register(TimeSlot)
 admin.site.register(Booking)
 admin.site.register(Team)
@@ -0,0 +1,424 @@
+"""Availability index and virtual slots.
+
+Every (ground, date) pair with TimeSlot rows gets one GroundAvailability row
+holding two small bitsets: ``open_mask`` has bit n set when a slot starts at
+n:00 and ``booked_mask`` has the same bit set once that slot is booked.
+
+Grounds with a GroundSchedule do not need pre-generated rows at all. Their
+slots come from the weekly hours (or a ScheduleException for that date) and
+only get a TimeSlot row once somebody books them. Until then they are
+exposed under a negative "virtual" id that ``materialize`` turns into a row.
+
+Availability requests are answered from the schedule and the index, so they
+never scan TimeSlot. Slots sit on the hourly grid.
+
+Every change to an index row moves its ``version`` forward. ``etag`` hashes
+those versions with the schedule, exceptions and active holds, so clients
+polling an unchanged day get a 304 for the price of one small query.
+"""
+import hashlib
+import json
+import time as clock
+from collections import defaultdict
+from datetime import date as date_cls, datetime, time, timedelta
+
+from django.conf import settings
+from django.contrib.postgres.expressions import ArraySubquery
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Value
+from django.db.models.functions import Greatest, JSONObject
+from django.utils import timezone
+
+from . import live
+from .holds import hold_cutoff
+from .models import Ground, GroundAvailability, GroundSchedule, ScheduleException, SlotHold, TimeSlot
+
+
+def slot_bit(start_time):
+    """Bit for the slot starting at ``start_time``"""
+    return 1 << start_time.hour
+
+
+def hours_in(mask):
+    """Hours whose bit is set in ``mask``, in ascending order"""
+    return [hour for hour in range(24) if mask & (1 << hour)]
+
+
+def _version_floor():
+    """Lowest version a row may get now, in microseconds
+
+    Index rows are deleted when their day has no slots left, a clock floor
+    keeps a row created again later from reusing a version it already had.
+    """
+    return int(clock.time() * 1_000_000)
+
+
+def _tally(slots):
+    """{(ground_id, date): (open_mask, booked_mask, slot_ids)} of a TimeSlot queryset"""
+    rows = {}
+    for slot_id, ground_id, date, start_time, is_booked in slots.values_list(
+        'id', 'ground_id', 'date', 'start_time', 'is_booked'
+    ).iterator(chunk_size=5000):
+        open_mask, booked_mask, slot_ids = rows.get((ground_id, date), (0, 0, {}))
+        bit = slot_bit(start_time)
+        slot_ids[str(start_time.hour)] = slot_id
+        rows[(ground_id, date)] = (open_mask | bit, booked_mask | bit if is_booked else booked_mask, slot_ids)
+    return rows
+
+
+def rebuild(ground_ids=None, dates=None):
+    """Recompute index rows from TimeSlot for the given grounds and dates
+
+    The index rows are locked before TimeSlot is read and then updated in
+    place. A concurrent ``_mark`` either committed before the lock, and its
+    slot change is read here, or waits for the lock and applies its bit on
+    top of the rebuilt row, so no change is lost.
+    """
+    slots = TimeSlot.objects.all()
+    existing = GroundAvailability.objects.all()
+    if ground_ids is not None:
+        slots = slots.filter(ground_id__in=ground_ids)
+        existing = existing.filter(ground_id__in=ground_ids)
+    if dates is not None:
+        slots = slots.filter(date__in=dates)
+        existing = existing.filter(date__in=dates)
+
+    with transaction.atomic():
+        # Every day with slots gets a row first, so there is something to lock
+        GroundAvailability.objects.bulk_create(
+            [
+                GroundAvailability(ground_id=ground_id, date=date)
+                for ground_id, date in sorted(set(slots.order_by().values_list('ground_id', 'date')))
+            ],
+            ignore_conflicts=True,
+            batch_size=1000,
+        )
+        locked = {
+            (row.ground_id, row.date): row
+            for row in existing.select_for_update().order_by('ground_id', 'date')
+        }
+        rows = _tally(slots)
+
+        floor = _version_floor()
+        changed, gone = [], []
+        for key, row in locked.items():
+            if key not in rows:
+                gone.append(row.id)
+                continue
+            if (row.open_mask, row.booked_mask, row.slot_ids) != rows[key]:
+                row.open_mask, row.booked_mask, row.slot_ids = rows[key]
+                row.version = max(row.version + 1, floor)
+                changed.append(row)
+        GroundAvailability.objects.bulk_update(
+            changed, ['open_mask', 'booked_mask', 'slot_ids', 'version'], batch_size=1000
+        )
+        GroundAvailability.objects.filter(id__in=gone).delete()
+        # Days whose first slot appeared after the rows above were created
+        GroundAvailability.objects.bulk_create(
+            [
+                GroundAvailability(ground_id=ground_id, date=date, open_mask=open_mask,
+                                   booked_mask=booked_mask, slot_ids=slot_ids, version=floor)
+                for (ground_id, date), (open_mask, booked_mask, slot_ids) in rows.items()
+                if (ground_id, date) not in locked
+            ],
+            ignore_conflicts=True,
+        )
+        if dates is not None:
+            # Targeted rebuilds follow slot edits, clients should refetch those days
+            live.publish('changed', {key: () for key in locked.keys() | rows.keys()})
+    return len(rows)
+
+
+def _mark(slots, booked):
+    """Set or clear the booked bit of each slot, one UPDATE per ground/date"""
+    bits = defaultdict(int)
+    for slot in slots:
+        bits[(slot.ground_id, slot.date)] |= slot_bit(slot.start_time)
+
+    # Same order as the locks taken by rebuild
+    for (ground_id, date), bit in sorted(bits.items()):
+        if booked:
+            expression = F('booked_mask').bitor(bit)
+        else:
+            expression = F('booked_mask').bitand(~bit)
+        updated = GroundAvailability.objects.filter(
+            ground_id=ground_id, date=date
+        ).update(booked_mask=expression, version=Greatest(F('version') + 1, Value(_version_floor())))
+        if not updated:
+            # Slot was created outside the index, pick it up now
+            rebuild([ground_id], [date])
+
+    live.publish('booked' if booked else 'freed', {key: hours_in(bit) for key, bit in bits.items()})
+
+
+def mark_booked(*slots):
+    _mark(slots, booked=True)
+
+
+def mark_free(*slots):
+    _mark(slots, booked=False)
+
+
+def virtual_slot_id(ground_id, date, hour):
+    """Stable id for a slot that has no TimeSlot row yet"""
+    return -(ground_id * 10 ** 8 + date.toordinal() * 100 + hour)
+
+
+def parse_virtual_slot_id(slot_id):
+    """(ground_id, date, hour) encoded in a virtual slot id"""
+    value = -slot_id
+    ground_id, rest = divmod(value, 10 ** 8)
+    ordinal, hour = divmod(rest, 100)
+    if hour > 23 or not ordinal:
+        raise ValueError(f'Invalid slot id {slot_id}')
+    return ground_id, date_cls.fromordinal(ordinal), hour
+
+
+def bookable_date(day):
+    """Whether ``day`` lies between today and the booking horizon"""
+    today = timezone.localdate()
+    return today <= day <= today + timedelta(days=settings.BOOKING_HORIZON_DAYS)
+
+
+def _interval_mask(open_time, close_time):
+    """Bits for the hourly slots between two "HH:MM:SS" times"""
+    close_hour = int(close_time[:2]) or 24
+    return sum(1 << hour for hour in range(int(open_time[:2]), close_hour))
+
+
+def ground_days(grounds, start, end, dates=None):
+    """Open and booked hours of ``grounds`` for each day from ``start`` to ``end``
+
+    Schedules, exceptions, active holds and index rows are pulled in as array
+    subqueries, so this is a single query however many grounds and days are
+    asked for. ``dates`` limits it to those days instead of the whole range.
+    Yields ``(ground, {date: (open_mask, booked_mask, slot_ids)})``.
+    """
+    if dates is not None:
+        dates = sorted(set(dates))
+        span = {'date__in': dates}
+    else:
+        span = {'date__range': (start, end)}
+        dates = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    grounds = grounds.annotate(
+        schedule=ArraySubquery(
+            GroundSchedule.objects.filter(ground=OuterRef('pk'))
+            .values(json=JSONObject(weekday='weekday', open='open_time', close='close_time'))
+        ),
+        exceptions=ArraySubquery(
+            ScheduleException.objects.filter(ground=OuterRef('pk'), **span)
+            .values(json=JSONObject(date='date', open='open_time', close='close_time'))
+        ),
+        held=ArraySubquery(
+            SlotHold.objects.filter(
+                ground=OuterRef('pk'), created_at__gte=hold_cutoff(), **span
+            ).values(json=JSONObject(date='date', start='start_time'))
+        ),
+        days=ArraySubquery(
+            GroundAvailability.objects.filter(ground=OuterRef('pk'), **span)
+            .values(json=JSONObject(
+                date='date', open='open_mask', booked='booked_mask', ids='slot_ids'
+            ))
+        ),
+    ).order_by('id')
+
+    for ground in grounds:
+        weekly = defaultdict(int)
+        for entry in ground.schedule:
+            weekly[entry['weekday']] |= _interval_mask(entry['open'], entry['close'])
+
+        overrides = {}
+        for entry in ground.exceptions:
+            day = date_cls.fromisoformat(entry['date'])
+            overrides.setdefault(day, 0)
+            if entry['open'] and entry['close']:
+                overrides[day] |= _interval_mask(entry['open'], entry['close'])
+
+        index = {date_cls.fromisoformat(row['date']): row for row in ground.days}
+
+        # Slots held for a checkout in progress are as good as booked
+        held = defaultdict(int)
+        for entry in ground.held:
+            held[date_cls.fromisoformat(entry['date'])] |= 1 << int(entry['start'][:2])
+
+        days = {}
+        for day in dates:
+            row = index.get(day)
+            booked = (row['booked'] if row else 0) | held[day]
+            if ground.schedule:
+                # Booked rows stay visible even if the hours changed since
+                open_mask = overrides.get(day, weekly[day.weekday()]) | booked
+            else:
+                open_mask = row['open'] if row else 0
+            if open_mask:
+                days[day] = (open_mask, booked, row['ids'] if row else {})
+        yield ground, days
+
+
+def etag(grounds, start, end):
+    """Strong ETag for the availability of ``grounds`` from ``start`` to ``end``
+
+    Covers everything ``ground_days`` and the slot data read: the ground
+    fields shown with slots, weekly hours, exceptions, active holds and the
+    index versions. Holds drop out of it as soon as they expire.
+    """
+    markers = grounds.annotate(
+        schedule=ArraySubquery(
+            GroundSchedule.objects.filter(ground=OuterRef('pk')).order_by('id')
+            .values(json=JSONObject(weekday='weekday', open='open_time', close='close_time'))
+        ),
+        exceptions=ArraySubquery(
+            ScheduleException.objects.filter(ground=OuterRef('pk'), date__range=(start, end)).order_by('id')
+            .values(json=JSONObject(date='date', open='open_time', close='close_time'))
+        ),
+        held=ArraySubquery(
+            SlotHold.objects.filter(
+                ground=OuterRef('pk'), date__range=(start, end), created_at__gte=hold_cutoff()
+            ).order_by('id').values('id')
+        ),
+        versions=ArraySubquery(
+            GroundAvailability.objects.filter(ground=OuterRef('pk'), date__range=(start, end))
+            .order_by('date').values(json=JSONObject(date='date', version='version'))
+        ),
+    ).order_by('id').values_list(
+        'id', 'name', 'price_per_hour', 'is_available', 'schedule', 'exceptions', 'held', 'versions'
+    )
+    raw = json.dumps([start, end, list(markers)], default=str, sort_keys=True)
+    return '"%s"' % hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _slot_id(ground_id, day, hour, slot_ids):
+    return slot_ids.get(str(hour)) or virtual_slot_id(ground_id, day, hour)
+
+
+def slot_data(ground, day, hour, is_booked, slot_ids):
+    """Shape a slot the same way TimeSlotSerializer does"""
+    start = time(hour, 0)
+    end = (datetime.combine(day, start) + timedelta(hours=1)).time()
+    return {
+        'id': _slot_id(ground.id, day, hour, slot_ids),
+        'ground': ground.id,
+        'ground_name': ground.name,
+        'date': day.isoformat(),
+        'start_time': start.isoformat(),
+        'end_time': end.isoformat(),
+        'is_booked': is_booked,
+    }
+
+
+def slots_for(date, available_only=True, **filters):
+    """Serialized slots on ``date`` for the grounds matching ``filters``"""
+    grounds = Ground.objects.filter(**filters).only('id', 'name')
+
+    data = []
+    for ground, days in ground_days(grounds, date, date):
+        if date not in days:
+            continue
+        open_mask, booked_mask, slot_ids = days[date]
+        for hour in hours_in(open_mask):
+            is_booked = bool(booked_mask & (1 << hour))
+            if available_only and is_booked:
+                continue
+            data.append(slot_data(ground, date, hour, is_booked, slot_ids))
+    return data
+
+
+def free_slot_counts(futsal_ids, date):
+    """Number of free slots on ``date`` per futsal, over its available grounds"""
+    grounds = Ground.objects.filter(futsal_id__in=futsal_ids, is_available=True).only('id', 'futsal_id')
+
+    counts = defaultdict(int)
+    for ground, days in ground_days(grounds, date, date):
+        if date in days:
+            open_mask, booked_mask, _ = days[date]
+            counts[ground.futsal_id] += len(hours_in(open_mask & ~booked_mask))
+    return counts
+
+
+def calendar(futsal, start, end):
+    """Availability of every ground of ``futsal`` from ``start`` to ``end``
+
+    Each ground carries a ``days`` map of
+    ``{date: {"free": {hour: slot_id}, "booked": [hour]}}``; a slot starting
+    at ``hour`` runs for one hour.
+    """
+    grounds = Ground.objects.filter(futsal=futsal).only('id', 'name', 'price_per_hour', 'is_available')
+
+    data = []
+    for ground, days in ground_days(grounds, start, end):
+        data.append({
+            'id': ground.id,
+            'name': ground.name,
+            'price_per_hour': str(ground.price_per_hour),
+            'is_available': ground.is_available,
+            'days': {
+                day.isoformat(): {
+                    'free': {
+                        hour: _slot_id(ground.id, day, hour, slot_ids)
+                        for hour in hours_in(open_mask & ~booked_mask)
+                    },
+                    'booked': hours_in(booked_mask),
+                }
+                for day, (open_mask, booked_mask, slot_ids) in days.items()
+            },
+        })
+    return data
+
+
+def materialize(slot_ids):
+    """Real TimeSlot ids for ``slot_ids``, creating rows for virtual ones
+
+    Raises ValueError when a virtual id does not point at an open slot
+    between today and the booking horizon.
+    """
+    slot_ids = [int(slot_id) for slot_id in slot_ids]
+    wanted = {slot_id: parse_virtual_slot_id(slot_id) for slot_id in slot_ids if slot_id < 0}
+    if not wanted:
+        return slot_ids
+    for slot_id, (_, day, _) in wanted.items():
+        if not bookable_date(day):
+            raise ValueError(f'Slot {slot_id} is outside the booking window')
+
+    real_ids = materialize_hours(wanted.values())
+    return [real_ids[wanted[slot_id]] if slot_id < 0 else slot_id for slot_id in slot_ids]
+
+
+def materialize_hours(hours):
+    """TimeSlot ids for ``(ground_id, date, hour)`` triples, creating missing rows
+
+    Open hours are only computed for the requested days, not the range between them.
+    Raises ValueError when an hour is not open on its ground.
+    """
+    hours = set(hours)
+    ground_ids = {ground_id for ground_id, _, _ in hours}
+    dates = {day for _, day, _ in hours}
+    open_hours = {}
+    for ground, days in ground_days(Ground.objects.filter(id__in=ground_ids).only('id', 'name'),
+                                    min(dates), max(dates), dates=dates):
+        for day, (open_mask, _, _) in days.items():
+            open_hours[(ground.id, day)] = open_mask
+
+    new_slots = []
+    for ground_id, day, hour in sorted(hours):
+        if not open_hours.get((ground_id, day), 0) & (1 << hour):
+            raise ValueError(f'Slot at {hour}:00 on {day} is not open')
+        start = time(hour, 0)
+        new_slots.append(TimeSlot(
+            ground_id=ground_id,
+            date=day,
+            start_time=start,
+            end_time=(datetime.combine(day, start) + timedelta(hours=1)).time(),
+        ))
+    TimeSlot.objects.bulk_create(new_slots, ignore_conflicts=True)
+
+    match = Q()
+    for slot in new_slots:
+        match |= Q(ground_id=slot.ground_id, date=slot.date, start_time=slot.start_time)
+    real_ids = {
+        (ground_id, day, start_time.hour): slot_id
+        for slot_id, ground_id, day, start_time in TimeSlot.objects.filter(match).values_list(
+            'id', 'ground_id', 'date', 'start_time'
+        )
+    }
+    rebuild(ground_ids, dates)
+    return real_ids
@@ -0,0 +1,124 @@
+"""Read cache for the venue and ground catalog.
+
+Catalog responses are cached in two tiers: a small in-process dict in
+front of the shared ``CATALOG_CACHE_ALIAS`` cache (Redis in production,
+see ``CACHES``). Every key embeds the catalog version; saving or deleting
+a Futsal or Ground bumps the version in the shared cache, which orphans
+every cached response at once instead of hunting for the keys to delete.
+
+Each process re-reads the version at most every ``CATALOG_LOCAL_TTL``
+seconds, so other processes serve the old catalog for at most that long.
+
+Without ``REDIS_URL`` the cache is LocMemCache, private to each process, and
+a version bump never reaches the other processes. Responses are then only
+cached for ``CATALOG_PROCESS_CACHE_TIMEOUT`` seconds and skip the local
+tier, so a change shows everywhere within that time.
+Queryset ``update()``/``delete()`` calls do not send signals and must call
+``invalidate()`` themselves.
+"""
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+VERSION_KEY = 'catalog:version'
+
+_lock = threading.Lock()
+_local = {}
+_version = None
+_version_read_at = 0.0
+_stats = Counter()
+
+
+def _shared():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def is_shared():
+    """Whether every process sees the same catalog cache"""
+    return not isinstance(_shared(), (LocMemCache, DummyCache))
+
+
+def version():
+    """Current catalog version, re-read from the shared cache every ``CATALOG_LOCAL_TTL`` seconds"""
+    global _version, _version_read_at
+    now = time.monotonic()
+    if _version is not None and now - _version_read_at < settings.CATALOG_LOCAL_TTL:
+        return _version
+
+    current = _shared().get(VERSION_KEY)
+    if current is None:
+        # add() is a no-op if another process got there first
+        _shared().add(VERSION_KEY, 1, timeout=None)
+        current = _shared().get(VERSION_KEY, 1)
+    with _lock:
+        if current != _version:
+            # Entries of older versions can never be hit again
+            _local.clear()
+        _version, _version_read_at = current, now
+    return current
+
+
+def invalidate():
+    """Start a new catalog version, every cached response is stale from now on"""
+    global _version
+    try:
+        new = _shared().incr(VERSION_KEY)
+    except ValueError:
+        # Nothing cached yet, or the shared cache lost the key
+        _shared().add(VERSION_KEY, 1, timeout=None)
+        new = _shared().incr(VERSION_KEY)
+    with _lock:
+        _local.clear()
+        _version = None
+        _stats['invalidations'] += 1
+    return new
+
+
+def get_or_build(name, build):
+    """Cached value of ``name`` for the current version, ``build()`` on a miss"""
+    key = f'catalog:{version()}:{name}'
+    shared = is_shared()
+    if shared:
+        with _lock:
+            if key in _local:
+                _stats['local_hits'] += 1
+                return _local[key]
+
+    value = _shared().get(key)
+    with _lock:
+        _stats['shared_hits' if value is not None else 'misses'] += 1
+    if value is None:
+        value = build()
+        timeout = settings.CATALOG_CACHE_TIMEOUT if shared else settings.CATALOG_PROCESS_CACHE_TIMEOUT
+        _shared().set(key, value, timeout=timeout)
+
+    if shared:
+        with _lock:
+            if len(_local) >= settings.CATALOG_LOCAL_MAX_ENTRIES:
+                _local.clear()
+            _local[key] = value
+    return value
+
+
+def stats():
+    """Hit and miss counters of this process"""
+    with _lock:
+        counters = dict(_stats)
+        local_entries = len(_local)
+    lookups = sum(counters.get(name, 0) for name in ('local_hits', 'shared_hits', 'misses'))
+    hits = counters.get('local_hits', 0) + counters.get('shared_hits', 0)
+    return {
+        'shared': is_shared(),
+        'version': _version,
+        'local_entries': local_entries,
+        'local_hits': counters.get('local_hits', 0),
+        'shared_hits': counters.get('shared_hits', 0),
+        'misses': counters.get('misses', 0),
+        'invalidations': counters.get('invalidations', 0),
+        'hit_ratio': round(hits / lookups, 3) if lookups else None,
+    }
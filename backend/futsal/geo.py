@@ -0,0 +1,44 @@
+"""Distance queries over Futsal coordinates.
+
+A bounding box around the point narrows venues down on the
+(latitude, longitude) index first; the great-circle distance is then
+computed by the database for that handful of rows only. The box does not
+wrap around the antimeridian, which no venue is close to.
+"""
+import math
+
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import ASin, Cos, Least, Power, Radians, Sin, Sqrt
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def bounding_box(lat, lng, radius_km):
+    """(min_lat, max_lat, min_lng, max_lng) of the box enclosing the circle"""
+    dlat = radius_km / KM_PER_DEGREE
+    # Longitude degrees shrink towards the poles, never divide by zero
+    dlng = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, max(lng - dlng, -180.0), min(lng + dlng, 180.0)
+
+
+def distance_km(lat, lng):
+    """Haversine distance in km from (lat, lng) to each row's coordinates"""
+    lat1 = Radians(Value(lat, output_field=FloatField()))
+    lat2 = Radians(F('latitude'))
+    half_dlat = (lat2 - lat1) / 2
+    half_dlng = (Radians(F('longitude')) - Radians(Value(lng, output_field=FloatField()))) / 2
+    a = Power(Sin(half_dlat), 2) + Cos(lat1) * Cos(lat2) * Power(Sin(half_dlng), 2)
+    # Rounding can push ``a`` a hair above 1 for antipodal points
+    return 2 * EARTH_RADIUS_KM * ASin(Sqrt(Least(a, Value(1.0))))
+
+
+def nearest(queryset, lat, lng, radius_km):
+    """Rows of ``queryset`` within ``radius_km`` of (lat, lng), closest first"""
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+    return (
+        queryset.filter(latitude__range=(min_lat, max_lat), longitude__range=(min_lng, max_lng))
+        .annotate(distance_km=distance_km(lat, lng))
+        .filter(distance_km__lte=radius_km)
+        .order_by('distance_km', 'id')
+    )
@@ -0,0 +1,96 @@
+"""Short-lived slot holds for checkouts waiting on payment.
+
+A hold is only active for ``SLOT_HOLD_TTL`` after it was created. Expired
+holds are ignored everywhere right away and deleted later in batches by
+``sweep_slot_holds``, so nothing has to run on time for them to lapse.
+
+The end of the hold is also stamped on the slot as ``held_until``. A
+booking claims its slot with one conditional UPDATE on that row, and
+PostgreSQL rechecks the row's own columns after waiting for a concurrent
+hold, which it would not do for a lookup of SlotHold.
+"""
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import live
+from .models import SlotHold, TimeSlot
+
+
+class SlotsHeld(Exception):
+    """A slot is booked or held by another checkout"""
+
+
+def hold_cutoff():
+    """Holds created before this moment have expired"""
+    return timezone.now() - settings.SLOT_HOLD_TTL
+
+
+def not_held():
+    """Slots without an active hold"""
+    return Q(held_until__isnull=True) | Q(held_until__lte=timezone.now())
+
+
+def hold_slots(slot_ids, booking_ref):
+    """Hold every slot of a cart for ``booking_ref``, or none of them"""
+    with transaction.atomic():
+        # An expired hold must not block the new one on the unique slot
+        SlotHold.objects.filter(time_slot_id__in=slot_ids, created_at__lt=hold_cutoff()).delete()
+
+        # Locked like a direct booking locks its slot, so the two take turns and
+        # a slot booked meanwhile drops out here instead of being held
+        slots = list(
+            TimeSlot.objects.select_for_update()
+            .filter(not_held(), id__in=slot_ids, is_booked=False)
+            .order_by('id')
+            .only('id', 'ground_id', 'date', 'start_time')
+        )
+        if len(slots) != len(set(slot_ids)):
+            raise SlotsHeld(booking_ref)
+        TimeSlot.objects.filter(id__in=[slot.id for slot in slots]).update(
+            held_until=timezone.now() + settings.SLOT_HOLD_TTL
+        )
+        try:
+            with transaction.atomic():
+                SlotHold.objects.bulk_create([
+                    SlotHold(
+                        time_slot_id=slot.id,
+                        booking_ref=booking_ref,
+                        ground_id=slot.ground_id,
+                        date=slot.date,
+                        start_time=slot.start_time,
+                    )
+                    for slot in slots
+                ])
+        except IntegrityError:
+            raise SlotsHeld(booking_ref)
+        live.publish('held', live.hours_by_day((slot.ground_id, slot.date, slot.start_time) for slot in slots))
+    return slots
+
+
+def release(booking_ref, notify=True):
+    """Drop the holds of ``booking_ref``, ``notify=False`` when its slots are being booked anyway"""
+    holds = SlotHold.objects.filter(booking_ref=booking_ref)
+    with transaction.atomic():
+        TimeSlot.objects.filter(hold__booking_ref=booking_ref).update(held_until=None)
+        if not notify:
+            return holds.delete()[0]
+        rows = list(holds.values_list('ground_id', 'date', 'start_time'))
+        released = holds.delete()[0]
+        live.publish('released', live.hours_by_day(rows))
+    return released
+
+
+def sweep(batch_size=1000):
+    """Delete expired holds in batches, returns how many went"""
+    expired = SlotHold.objects.filter(created_at__lt=hold_cutoff()).order_by('created_at')
+    swept = 0
+    while True:
+        rows = list(expired.values_list('id', 'ground_id', 'date', 'start_time')[:batch_size])
+        if not rows:
+            return swept
+        with transaction.atomic():
+            swept += SlotHold.objects.filter(id__in=[row[0] for row in rows]).delete()[0]
+            # These were already free for new checkouts, tell the clients too
+            live.publish('released', live.hours_by_day(row[1:] for row in rows))
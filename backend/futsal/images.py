@@ -0,0 +1,171 @@
+"""Resized WebP and JPEG variants of uploaded images.
+
+Saving a profile picture or post image only stores the original. Once the
+transaction commits, a small in-process thread pool renders one variant
+per size in ``SIZES`` and format in ``FORMATS`` into ``variants/``. It
+then records their names in the row's ``*_variants`` JSON, which looks
+like:
+
+    {"source": "posts/3f/3f9c...e1.jpg",
+     "small": {"width": 160, "height": 90, "webp": "variants/a0/a04b...7d.webp", "jpeg": ...}, ...}
+
+Serializers pick the size a screen needs, in WebP unless the request asks
+for ``?image_format=jpeg``. Until the variants exist they fall back to the
+original. The JSON is only written if the original is still the same file,
+so an upload that replaces it meanwhile wins. Files are content-addressed
+(see ``media``), so re-rendering an image stores nothing new, and variants
+nobody refers to any more are left to ``collect_media_orphans``.
+``generate_image_variants`` makes any variants lost to a restart.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+
+from .models import Post, User
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels, images are never enlarged
+SIZES = {
+    'small': 160,
+    'medium': 640,
+    'large': 1280,
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+# (image field, variants field) of the models whose images get variants
+TARGETS = {
+    User: [('profile_picture', 'profile_picture_variants')],
+    Post: [('image', 'image_variants')],
+}
+
+_pool = None
+
+
+def render(image):
+    """{size: (width, height, {format: bytes})} for an opened Pillow image"""
+    image = ImageOps.exif_transpose(image)
+    rendered = {}
+    for size, edge in SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.Resampling.LANCZOS)
+        encoded = {}
+        for name, (pillow_format, options) in FORMATS.items():
+            frame = resized
+            if pillow_format == 'JPEG' and frame.mode != 'RGB':
+                # JPEG has no alpha, transparent areas turn white
+                background = Image.new('RGB', frame.size, 'white')
+                frame = frame.convert('RGBA')
+                background.paste(frame, mask=frame.getchannel('A'))
+                frame = background
+            elif frame.mode not in ('RGB', 'RGBA'):
+                frame = frame.convert('RGBA')
+            buffer = BytesIO()
+            frame.save(buffer, pillow_format, **options)
+            encoded[name] = buffer.getvalue()
+        rendered[size] = (resized.width, resized.height, encoded)
+    return rendered
+
+
+def generate(model, pk, field, variants_field):
+    """Render and store the variants of one row's image, returns the variants or None"""
+    instance = model.objects.filter(pk=pk).only('pk', field, variants_field).first()
+    if instance is None or not getattr(instance, field):
+        return None
+    source = getattr(instance, field)
+    with source.open('rb'):
+        with Image.open(source) as image:
+            image.load()
+            rendered = render(image)
+
+    variants = {'source': source.name}
+    for size, (width, height, encoded) in rendered.items():
+        variants[size] = {'width': width, 'height': height}
+        for name, data in encoded.items():
+            variants[size][name] = default_storage.save(f'variants/{size}.{name}', ContentFile(data))
+
+    # Only if the original is still the one rendered, a newer upload has its own job
+    if model.objects.filter(pk=pk, **{field: source.name}).update(**{variants_field: variants}):
+        return variants
+    return None
+
+
+def _run(model, pk, field, variants_field):
+    close_old_connections()
+    try:
+        generate(model, pk, field, variants_field)
+    except Exception:
+        logger.exception('Could not make image variants of %s %s', model.__name__, pk)
+    finally:
+        close_old_connections()
+
+
+def schedule(model, pk, field, variants_field):
+    """Render variants on the worker pool once the current transaction commits"""
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_VARIANT_WORKERS, thread_name_prefix='image-variants'
+        )
+    transaction.on_commit(lambda: _pool.submit(_run, model, pk, field, variants_field))
+
+
+def refresh(instance, update_fields=None):
+    """Schedule new variants for changed images of a saved row, forget those of removed images"""
+    deferred = instance.get_deferred_fields()
+    for field, variants_field in TARGETS.get(type(instance), []):
+        if update_fields is not None and field not in update_fields:
+            continue
+        if field in deferred or variants_field in deferred:
+            continue
+        source = getattr(instance, field)
+        variants = getattr(instance, variants_field) or {}
+        if source and variants.get('source') != source.name:
+            schedule(type(instance), instance.pk, field, variants_field)
+        elif not source and variants:
+            type(instance).objects.filter(pk=instance.pk).update(**{variants_field: {}})
+            setattr(instance, variants_field, {})
+
+
+def _absolute(request, path):
+    url = default_storage.url(path)
+    return request.build_absolute_uri(url) if request else url
+
+
+def preferred_format(request):
+    """``?image_format=`` of the request if it names a format, else webp"""
+    wanted = request.query_params.get('image_format') if request else None
+    return wanted if wanted in FORMATS else 'webp'
+
+
+def url(request, source, variants, size):
+    """URL of the ``size`` variant of ``source``, the original while it has none"""
+    if not source:
+        return None
+    variant = (variants or {}).get(size) if (variants or {}).get('source') == source.name else None
+    if variant:
+        return _absolute(request, variant[preferred_format(request)])
+    return _absolute(request, source.name)
+
+
+def urls(request, source, variants):
+    """{size: {width, height, webp, jpeg}} with absolute URLs, empty until the variants exist"""
+    if not source or (variants or {}).get('source') != source.name:
+        return {}
+    return {
+        size: {
+            'width': variants[size]['width'],
+            'height': variants[size]['height'],
+            **{name: _absolute(request, variants[size][name]) for name in FORMATS},
+        }
+        for size in SIZES if size in variants
+    }
@@ -0,0 +1,102 @@
+"""Khalti ePayment gateway client.
+
+One pooled, keep-alive session per process with strict timeouts and
+retries with exponential backoff. ``initiate`` is only retried when the
+connection could not be opened, so the request never reached Khalti: an
+error after sending may still have created a payment. ``lookup`` is
+read-only and is retried on any connection error, timeout or 5xx answer.
+
+Point ``KHALTI_BASE_URL`` at ``run_khalti_stub`` for tests and load runs.
+"""
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+RETRY_STATUSES = {502, 503, 504}
+
+
+class KhaltiError(Exception):
+    """Khalti could not be reached or kept failing after all retries"""
+
+
+def _headers():
+    return {
+        "Authorization": f"Key {os.getenv('KHALTI_SECRET_KEY')}",
+        "Content-Type": "application/json",
+    }
+
+
+def _not_sent(error):
+    """Whether a requests error was raised before the request went out"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    # Refused, unreachable or unresolvable, as opposed to a connection dropped mid-request
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _json(response):
+    try:
+        return response.json()
+    except ValueError:
+        return {'detail': response.text}
+
+
+class KhaltiClient:
+    def __init__(self, base_url=None, timeout=None, retries=None, backoff=None, pool_size=None):
+        self.base_url = base_url or settings.KHALTI_BASE_URL
+        self.timeout = timeout or settings.KHALTI_TIMEOUT
+        self.retries = settings.KHALTI_RETRIES if retries is None else retries
+        self.backoff = settings.KHALTI_BACKOFF if backoff is None else backoff
+
+        pool_size = pool_size or settings.KHALTI_POOL_SIZE
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def initiate(self, payload):
+        """Start a payment, returns (status_code, data)"""
+        return self._post('epayment/initiate/', payload, idempotent=False)
+
+    def lookup(self, pidx):
+        """Payment status of ``pidx``, returns (status_code, data)"""
+        return self._post('epayment/lookup/', {'pidx': pidx}, idempotent=True)
+
+    def _post(self, path, payload, idempotent):
+        url = self.base_url + path
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                response = self.session.post(url, json=payload, headers=_headers(), timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if last_attempt or not (idempotent or _not_sent(e)):
+                    raise KhaltiError(str(e)) from e
+            else:
+                if not (idempotent and response.status_code in RETRY_STATUSES and not last_attempt):
+                    return response.status_code, _json(response)
+            time.sleep(self.backoff * 2 ** attempt)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The process-wide client, so every request reuses the same connections"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = KhaltiClient()
+    return _client
+
+
+def set_client(client):
+    """Swap the process-wide client, e.g. for one pointing at the local stub"""
+    global _client
+    _client = client
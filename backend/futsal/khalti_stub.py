@@ -0,0 +1,108 @@
+"""Local stand-in for the Khalti ePayment API.
+
+Implements ``epayment/initiate/`` and ``epayment/lookup/`` closely enough
+for tests and load runs. Latency, the status lookups report and a share of
+503 answers can be tuned to exercise timeouts and retries.
+"""
+import json
+import random
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class KhaltiStub:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, lookup_status='Completed', failure_rate=0.0):
+        self.latency = latency
+        self.lookup_status = lookup_status
+        self.failure_rate = failure_rate
+        self.payments = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/api/v2/'
+
+    def start(self):
+        """Serve from a background thread"""
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def set_status(self, pidx, payment_status):
+        """Force the status ``lookup`` reports for one payment"""
+        with self.lock:
+            self.payments[pidx]['status'] = payment_status
+
+    def initiate(self, payload):
+        pidx = secrets.token_hex(11)
+        with self.lock:
+            self.payments[pidx] = {
+                'amount': payload.get('amount'),
+                'purchase_order_id': payload.get('purchase_order_id'),
+                'status': self.lookup_status,
+            }
+        return 200, {
+            'pidx': pidx,
+            'payment_url': f'{self.base_url}pay/?pidx={pidx}',
+            'expires_in': 1800,
+        }
+
+    def lookup(self, payload):
+        with self.lock:
+            payment = self.payments.get(payload.get('pidx'))
+        if payment is None:
+            return 404, {'detail': 'Not found.', 'error_key': 'validation_error'}
+        return 200, {
+            'pidx': payload['pidx'],
+            'total_amount': payment['amount'],
+            'status': payment['status'],
+            'transaction_id': f"TXN{payload['pidx'][:10]}" if payment['status'] == 'Completed' else None,
+            'fee': 0,
+            'refunded': payment['status'] == 'Refunded',
+        }
+
+    def _handler(self):
+        stub = self
+        routes = {
+            '/api/v2/epayment/initiate/': stub.initiate,
+            '/api/v2/epayment/lookup/': stub.lookup,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real gateway
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+                route = routes.get(self.path)
+                if route is None:
+                    code, data = 404, {'detail': 'Not found.'}
+                elif random.random() < stub.failure_rate:
+                    code, data = 503, {'detail': 'Service unavailable'}
+                else:
+                    code, data = route(payload)
+
+                body = json.dumps(data).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,130 @@
+"""Post likes with a write-behind counter.
+
+A toggle is resolved against the likes table straight away, by deleting
+the pair or else inserting it. ``is_liked`` therefore always matches the
+database, whichever process served the toggle. Only the +1/-1 on
+``Post.likes_count`` is buffered per process. Each flush writes the whole
+buffer as one UPDATE, once ``LIKE_FLUSH_SIZE`` posts have a pending change
+or the oldest is ``LIKE_FLUSH_INTERVAL`` seconds old. Until then
+``overlay`` adds this process's unflushed changes to posts read from the
+database.
+
+``reconcile_like_counts`` recounts the stored counters should they drift,
+e.g. after a process died with changes still in its buffer.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+
+from .models import Post
+
+Like = Post.likes.through
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# post_id -> change of likes_count not written yet
+_pending = {}
+_oldest = None
+_flusher = None
+
+
+def toggle(post, user_id):
+    """Like or unlike ``post`` for ``user_id``, returns (liked, likes_count)"""
+    if Like.objects.filter(post_id=post.id, user_id=user_id).delete()[0]:
+        liked, delta = False, -1
+    else:
+        try:
+            with transaction.atomic():
+                Like.objects.create(post_id=post.id, user_id=user_id)
+            liked, delta = True, 1
+        except IntegrityError:
+            # A concurrent toggle of the same pair liked it first
+            liked, delta = True, 0
+
+    if delta and _add(post.id, delta):
+        flush()
+        post.refresh_from_db(fields=['likes_count'])
+    return liked, overlay([post])[0].likes_count
+
+
+def _add(post_id, delta):
+    """Buffer a counter change, returns whether the buffer is due for a flush"""
+    global _oldest
+    with _lock:
+        _pending[post_id] = _pending.get(post_id, 0) + delta
+        if _oldest is None:
+            _oldest = time.monotonic()
+        due = len(_pending) >= settings.LIKE_FLUSH_SIZE
+    _start_flusher()
+    return due
+
+
+def overlay(posts):
+    """Apply this process's unflushed counter changes to ``likes_count`` of ``posts``"""
+    with _lock:
+        pending = dict(_pending)
+    for post in posts:
+        post.likes_count += pending.get(post.id, 0)
+    return posts
+
+
+def flush():
+    """Write the buffered counter changes, returns how many posts were updated"""
+    global _oldest
+    with _lock:
+        batch = {post_id: delta for post_id, delta in _pending.items() if delta}
+        _pending.clear()
+        _oldest = None
+    if not batch:
+        return 0
+    try:
+        # An unlike may be flushed before the like it undoes, which another process
+        # still holds, the counter stops at zero and reconcile_like_counts squares it
+        return Post.objects.filter(id__in=batch).update(likes_count=Greatest(F('likes_count') + Case(
+            *(When(id=post_id, then=Value(delta)) for post_id, delta in batch.items()),
+            default=Value(0),
+        ), Value(0)))
+    except Exception:
+        # Put the changes back for the next flush
+        with _lock:
+            for post_id, delta in batch.items():
+                _pending[post_id] = _pending.get(post_id, 0) + delta
+            if _oldest is None:
+                _oldest = time.monotonic()
+        raise
+
+
+def _flush_loop():
+    while True:
+        time.sleep(settings.LIKE_FLUSH_INTERVAL)
+        with _lock:
+            due = _oldest is not None and time.monotonic() - _oldest >= settings.LIKE_FLUSH_INTERVAL
+        if not due:
+            continue
+        try:
+            flush()
+        except Exception:
+            logger.warning('Like flush failed, retrying', exc_info=True)
+        finally:
+            close_old_connections()
+
+
+def _start_flusher():
+    """Flush stragglers in the background so a quiet post is not left waiting"""
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='like-flusher', daemon=True)
+            _flusher.start()
+
+
+atexit.register(flush)
@@ -0,0 +1,177 @@
+"""Live availability updates for Server-Sent Events.
+
+Slot changes are published with PostgreSQL ``NOTIFY``, so they are
+delivered once the change commits and whichever process made it: a web
+worker, ``run_payment_worker`` or a management command. Each ASGI process
+keeps a single ``LISTEN`` connection on a background thread and fans every
+event out in process to the subscribers of that ground and date. A
+thousand idle subscribers cost a thousand small queues, not a thousand
+database connections.
+
+Events look like ``{"ground": 3, "date": "2026-05-01", "event": "booked",
+"hours": [18, 19]}`` with ``event`` one of ``booked``, ``freed``, ``held``,
+``released`` or ``changed`` (slots were added or removed, refetch).
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+from django.db import connection, connections
+
+CHANNEL = 'futsal_availability'
+QUEUE_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+def publish(event, changes):
+    """Notify subscribers once the current transaction commits
+
+    ``changes`` maps (ground_id, date) to the hours concerned, all of them
+    go out in a single statement.
+    """
+    payloads = [
+        json.dumps({'ground': ground_id, 'date': date.isoformat(), 'event': event, 'hours': sorted(hours)})
+        for (ground_id, date), hours in changes.items()
+    ]
+    if not payloads:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload', [CHANNEL, payloads])
+
+
+def hours_by_day(rows):
+    """{(ground_id, date): {hour}} for (ground_id, date, start_time) rows"""
+    changes = defaultdict(set)
+    for ground_id, date, start_time in rows:
+        changes[(ground_id, date)].add(start_time.hour)
+    return changes
+
+
+class Subscription:
+    """Events for a set of (ground_id, date) keys, read from an asyncio queue"""
+
+    def __init__(self, keys, loop):
+        self.keys = keys
+        self.loop = loop
+        self.queue = asyncio.Queue(QUEUE_SIZE)
+
+    def deliver(self, event):
+        # Runs on the subscriber's event loop
+        if self.queue.full():
+            # A client this far behind is better off refetching everything
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            event = {'event': 'resync'}
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+
+class Broker:
+    """In-process fan-out from the LISTEN thread to SSE subscribers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._listener = None
+        self._listening = threading.Event()
+        self._stopping = threading.Event()
+
+    def subscribe(self, keys):
+        subscription = Subscription(frozenset(keys), asyncio.get_running_loop())
+        with self._lock:
+            for key in subscription.keys:
+                self._subscribers[key].add(subscription)
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='availability-listener', daemon=True)
+                self._listener.start()
+        return subscription
+
+    async def ready(self, timeout=5):
+        """Wait until the LISTEN connection is up, events sent before that are not seen"""
+        return await asyncio.get_running_loop().run_in_executor(None, self._listening.wait, timeout)
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for key in subscription.keys:
+                subscribers = self._subscribers.get(key)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[key]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscribers in self._subscribers.values() for subscription in subscribers})
+
+    def dispatch(self, event):
+        key = (event['ground'], event['date'])
+        with self._lock:
+            subscribers = list(self._subscribers.get(key, ()))
+        self._deliver(subscribers, event)
+
+    def broadcast(self, event):
+        with self._lock:
+            subscribers = {subscription for subscribers in self._subscribers.values() for subscription in subscribers}
+        self._deliver(subscribers, event)
+
+    def _deliver(self, subscribers, event):
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # The subscriber's loop is gone, its request is over
+                self.unsubscribe(subscription)
+
+    def stop(self, timeout=5):
+        """End the LISTEN thread and close its connection"""
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is None:
+            return
+        self._stopping.set()
+        # Wakes the thread up from its wait for notifications
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, json.dumps({'event': 'stop'})])
+        listener.join(timeout)
+        self._stopping.clear()
+        self._listening.clear()
+
+    def _listen(self):
+        params = connections['default'].get_connection_params()
+        delay = 1
+        while not self._stopping.is_set():
+            listener = None
+            try:
+                listener = psycopg2.connect(**params)
+                listener.autocommit = True
+                with listener.cursor() as cursor:
+                    cursor.execute(f'LISTEN {CHANNEL}')
+                if self._listening.is_set():
+                    # Events may have been lost while reconnecting
+                    self.broadcast({'event': 'resync'})
+                self._listening.set()
+                delay = 1
+                while not self._stopping.is_set():
+                    if select.select([listener], [], [], 30) == ([], [], []):
+                        continue
+                    listener.poll()
+                    while listener.notifies and not self._stopping.is_set():
+                        self.dispatch(json.loads(listener.notifies.pop(0).payload))
+            except Exception:
+                logger.warning('Availability listener lost its connection, reconnecting', exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+            finally:
+                if listener is not None:
+                    listener.close()
+
+
+broker = Broker()
@@ -0,0 +1,61 @@
+"""Loyalty rewards: a free booking for every ``LOYALTY_REWARD_AFTER`` paid ones.
+
+Every booking that earns or redeems loyalty appends a LoyaltyEntry. The
+counters on User that the app reads are only ever changed by single UPDATE
+statements with F() expressions on those columns, never by saving the whole
+row, so concurrent bookings of one user cannot lose an increment and a
+reward cannot be claimed twice.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from .models import LoyaltyEntry, User
+
+
+def claim_reward(user_id):
+    """Take one free booking off the user's balance, False if not enough paid bookings yet
+
+    The check and the decrement are one conditional UPDATE, of two parallel
+    requests only one can win a single reward.
+    """
+    return bool(User.objects.filter(
+        id=user_id, bookings_since_reward__gte=settings.LOYALTY_REWARD_AFTER
+    ).update(
+        # Paid bookings beyond the threshold carry over to the next reward
+        bookings_since_reward=F('bookings_since_reward') - settings.LOYALTY_REWARD_AFTER,
+        total_rewards_claimed=F('total_rewards_claimed') + 1,
+    ))
+
+
+def refund_reward(user_id):
+    """Give back a reward claimed for a booking that could not be made"""
+    User.objects.filter(id=user_id).update(
+        bookings_since_reward=F('bookings_since_reward') + settings.LOYALTY_REWARD_AFTER,
+        total_rewards_claimed=F('total_rewards_claimed') - 1,
+    )
+
+
+def record(bookings):
+    """Append the ledger entries of new bookings and count the paid ones
+
+    One insert for the entries and one UPDATE per user, whatever the number
+    of bookings. Free bookings must have been paid for with claim_reward().
+    """
+    paid = Counter(booking.user_id for booking in bookings if not booking.is_free_booking)
+    with transaction.atomic():
+        LoyaltyEntry.objects.bulk_create([
+            LoyaltyEntry(
+                user_id=booking.user_id,
+                booking=booking,
+                kind='REDEEMED' if booking.is_free_booking else 'EARNED',
+            )
+            for booking in bookings
+        ])
+        for user_id, count in paid.items():
+            User.objects.filter(id=user_id).update(
+                total_bookings=F('total_bookings') + count,
+                bookings_since_reward=F('bookings_since_reward') + count,
+            )
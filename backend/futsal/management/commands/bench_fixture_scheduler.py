@@ -0,0 +1,98 @@
+import time as timer
+from collections import defaultdict
+from datetime import date, time, timedelta
+from itertools import combinations
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from futsal import availability, scheduler
+from futsal.models import Fixture, Futsal, Ground, GroundSchedule, Team, TimeSlot, Tournament, User
+
+
+class Command(BaseCommand):
+    help = ('Generate a round robin for many teams on scheduled grounds with some slots already '
+            'booked, time it and check the result')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teams', type=int, default=64)
+        parser.add_argument('--grounds', type=int, default=12)
+        parser.add_argument('--days', type=int, default=30)
+
+    def handle(self, *args, **options):
+        # Everything is seeded inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            tournament, grounds = self.seed(options)
+            started = timer.perf_counter()
+            fixtures = scheduler.generate(tournament, 'round_robin', grounds)
+            elapsed = timer.perf_counter() - started
+            self.stdout.write(
+                f'{len(fixtures)} matches for {options["teams"]} teams on {options["grounds"]} grounds '
+                f'scheduled in {elapsed:.2f}s, last match on {max(f.match_date for f in fixtures)}'
+            )
+            self.verify(tournament, fixtures)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        start = date.today() + timedelta(days=1)
+        futsal = Futsal.objects.create(name='Bench Futsal', location='Bench', contact='9800000000')
+        grounds = Ground.objects.bulk_create(
+            Ground(futsal=futsal, name=f'Ground {g}', price_per_hour=1000) for g in range(options['grounds'])
+        )
+        GroundSchedule.objects.bulk_create(
+            GroundSchedule(ground=ground, weekday=weekday, open_time=time(6), close_time=time(22))
+            for ground in grounds for weekday in range(7)
+        )
+        # Every third evening slot is already booked
+        booked = [
+            TimeSlot(ground=ground, date=start + timedelta(days=day), start_time=time(hour),
+                     end_time=time(hour + 1), is_booked=True)
+            for ground in grounds for day in range(options['days']) for hour in range(17, 21)
+            if (ground.id + day + hour) % 3 == 0
+        ]
+        TimeSlot.objects.bulk_create(booked, batch_size=5000)
+        availability.rebuild([ground.id for ground in grounds])
+
+        captain = User.objects.create(username='bench_scheduler')
+        teams = Team.objects.bulk_create(
+            Team(name=f'Bench Team {i}', captain=captain) for i in range(options['teams'])
+        )
+        tournament = Tournament.objects.create(
+            name='Bench Cup', start_date=start, end_date=start + timedelta(days=options['days'] - 1),
+            max_teams=options['teams'],
+        )
+        tournament.registered_teams.add(*teams)
+        return tournament, Ground.objects.filter(futsal=futsal)
+
+    def verify(self, tournament, fixtures):
+        booked = set(
+            TimeSlot.objects.filter(ground__in={f.ground_id for f in fixtures}, is_booked=True)
+            .values_list('ground_id', 'date', 'start_time')
+        )
+        used = set()
+        games = defaultdict(list)
+        for fixture in fixtures:
+            key = (fixture.ground_id, fixture.match_date, fixture.match_time)
+            if key in booked or key in used:
+                raise CommandError(f'Fixture {fixture.id} clashes on ground {fixture.ground_id}')
+            used.add(key)
+            for team in (fixture.team1_id, fixture.team2_id):
+                games[team].append((fixture.match_date, fixture.match_time.hour, fixture.round))
+
+        for team, played in games.items():
+            played.sort()
+            for (day, hour, round_before), (next_day, next_hour, round_after) in zip(played, played[1:]):
+                if day == next_day and next_hour - hour < 2:
+                    raise CommandError(f'Team {team} plays back to back on {day}')
+                if round_after <= round_before:
+                    raise CommandError(f'Team {team} plays round {round_after} after {round_before}')
+
+        pairs = {frozenset((f.team1_id, f.team2_id)) for f in fixtures}
+        teams = list(tournament.registered_teams.values_list('id', flat=True))
+        if len(pairs) != len(fixtures) or pairs != {frozenset(pair) for pair in combinations(teams, 2)}:
+            raise CommandError('Not every pair of teams meets exactly once')
+        if Fixture.objects.filter(tournament=tournament).count() != len(fixtures):
+            raise CommandError('Not every fixture was written')
+        self.stdout.write(self.style.SUCCESS(
+            'No clashes with bookings, no back-to-back games, every pair meets once'
+        ))
@@ -0,0 +1,91 @@
+import statistics
+import time as timer
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from futsal import matchmaking
+from futsal.models import Futsal, User
+from futsal.pagination import FreeAgentPagination
+from futsal.serializers import FreeAgentSerializer, UserSerializer
+
+
+class Command(BaseCommand):
+    help = ('Benchmark free agent lookups among many users: the old full list vs filtered cursor '
+            'pages on the partial index')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200000)
+        parser.add_argument('--looking', type=float, default=0.2, help='Share of users looking for a team')
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def handle(self, *args, **options):
+        # Everything is seeded inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            self.seed(options)
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        futsals = Futsal.objects.bulk_create(
+            Futsal(name=f'Bench Futsal {i}', location='Bench', contact='9800000000') for i in range(20)
+        )
+        positions = [code for code, _ in User.POSITION_CHOICES]
+        genders = [code for code, _ in User.GENDER_CHOICES]
+        looking_every = round(1 / options['looking'])
+        for offset in range(0, options['users'], 5000):
+            User.objects.bulk_create(
+                User(
+                    username=f'bench_agent_{n}',
+                    is_looking_for_team=n % looking_every == 0,
+                    preferred_position=positions[n % len(positions)],
+                    gender=genders[n % len(genders)],
+                    futsal=futsals[n % len(futsals)],
+                    date_of_birth=date(1975, 1, 1) + timedelta(days=n % 12000),
+                    matches_played=n % 300,
+                )
+                for n in range(offset, min(offset + 5000, options['users']))
+            )
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {User._meta.db_table}')
+        self.stdout.write(
+            f'Seeded {options["users"]} users, {User.objects.filter(is_looking_for_team=True).count()} looking'
+        )
+
+    def run(self, options):
+        factory = APIRequestFactory()
+        request = Request(factory.get('/api/users/looking_for_team/'))
+
+        def old():
+            users = User.objects.filter(is_looking_for_team=True)
+            return UserSerializer(users, many=True, context={'request': request}).data
+
+        cases = [
+            ('everyone', {}),
+            ('position', {'position': 'GK'}),
+            ('position + gender + age', {'position': 'MID', 'gender': 'FEMALE', 'min_age': 18, 'max_age': 30}),
+            ('home futsal', {'futsal_id': Futsal.objects.order_by('id').values_list('id', flat=True)[3]}),
+        ]
+        started = timer.perf_counter()
+        old_count = len(old())
+        self.stdout.write(
+            f'old endpoint: {old_count} full profiles in {(timer.perf_counter() - started) * 1000:.0f} ms'
+        )
+
+        for label, filters in cases:
+            def page():
+                paginator = FreeAgentPagination()
+                rows = paginator.paginate_queryset(matchmaking.free_agents(**filters), request)
+                return FreeAgentSerializer(rows, many=True, context={'request': request}).data
+
+            timings = []
+            for _ in range(options['iterations']):
+                begun = timer.perf_counter()
+                page()
+                timings.append(timer.perf_counter() - begun)
+            plan = matchmaking.free_agents(**filters).order_by(*FreeAgentPagination.ordering)[:21].explain()
+            index = 'user_free_agent_idx' if 'user_free_agent_idx' in plan else 'no index'
+            self.stdout.write(f'{label:<26} first page {statistics.median(timings) * 1000:>7.2f} ms   {index}')
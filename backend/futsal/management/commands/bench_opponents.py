@@ -0,0 +1,110 @@
+import random
+import statistics
+import time as timer
+from datetime import time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from futsal import availability, opponents
+from futsal.models import Booking, Futsal, Ground, GroundSchedule, Team, TimeSlot, User
+
+
+class Command(BaseCommand):
+    help = ('Find opponents for a team among hundreds of teams whose players hold bookings over '
+            'several weeks, time it and check every option against the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--teams', type=int, default=400)
+        parser.add_argument('--players', type=int, default=6, help='Players per team')
+        parser.add_argument('--grounds', type=int, default=10)
+        parser.add_argument('--days', type=int, default=28)
+        parser.add_argument('--iterations', type=int, default=10)
+
+    def handle(self, *args, **options):
+        # Everything is seeded inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            teams, grounds, start, end = self.seed(options)
+            self.run(teams, grounds, start, end, options)
+            transaction.set_rollback(True)
+
+    def seed(self, options):
+        rng = random.Random(7)
+        start = timezone.localdate() + timedelta(days=1)
+        end = start + timedelta(days=options['days'] - 1)
+        futsal = Futsal.objects.create(name='Bench Futsal', location='Bench', contact='9800000000')
+        grounds = Ground.objects.bulk_create(
+            Ground(futsal=futsal, name=f'Ground {g}', price_per_hour=1000) for g in range(options['grounds'])
+        )
+        GroundSchedule.objects.bulk_create(
+            GroundSchedule(ground=ground, weekday=weekday, open_time=time(6), close_time=time(22))
+            for ground in grounds for weekday in range(7)
+        )
+
+        users = User.objects.bulk_create(
+            User(username=f'bench_player_{n}') for n in range(options['teams'] * options['players'])
+        )
+        teams = Team.objects.bulk_create(
+            Team(name=f'Bench Team {i}', captain=users[i * options['players']], matches_count=rng.randint(0, 60))
+            for i in range(options['teams'])
+        )
+        Team.members.through.objects.bulk_create(
+            Team.members.through(team_id=team.id, user_id=users[i * options['players'] + p].id)
+            for i, team in enumerate(teams) for p in range(options['players'])
+        )
+
+        # Each player books a few hours a week somewhere
+        slots, bookings = {}, []
+        for user in users:
+            for _ in range(options['days'] // 3):
+                ground = rng.choice(grounds)
+                day = start + timedelta(days=rng.randrange(options['days']))
+                hour = rng.randint(6, 21)
+                key = (ground.id, day, hour)
+                if key in slots:
+                    continue
+                slots[key] = TimeSlot(ground=ground, date=day, start_time=time(hour),
+                                      end_time=time(hour + 1), is_booked=True)
+                bookings.append((user, key))
+        TimeSlot.objects.bulk_create(slots.values(), batch_size=5000)
+        Booking.objects.bulk_create(
+            (Booking(user=user, ground_id=key[0], time_slot=slots[key], status='CONFIRMED')
+             for user, key in bookings),
+            batch_size=5000,
+        )
+        availability.rebuild([ground.id for ground in grounds])
+        self.stdout.write(f'Seeded {len(teams)} teams, {len(users)} players, {len(bookings)} bookings')
+        return teams, Ground.objects.filter(futsal=futsal).only('id', 'name'), start, end
+
+    def run(self, teams, grounds, start, end, options):
+        team = teams[0]
+        timings = []
+        for _ in range(options['iterations']):
+            began = timer.perf_counter()
+            with CaptureQueriesContext(connection) as queries:
+                found = opponents.find(team, grounds, start, end, candidates=len(teams), limit=len(teams))
+            timings.append(timer.perf_counter() - began)
+        self.stdout.write(
+            f'{len(teams) - 1} teams over {options["days"]} days: {len(found)} opponents with options in '
+            f'{statistics.median(timings) * 1000:.0f} ms and {len(queries)} queries'
+        )
+
+        gaps = [abs(opponent.matches_count - team.matches_count) for opponent, _ in found]
+        if gaps != sorted(gaps):
+            raise CommandError('Opponents are not ordered by matches played')
+        players = opponents.rosters([team.id] + [opponent.id for opponent, _ in found])
+        for opponent, options_found in found:
+            both = players[team.id] | players[opponent.id]
+            for option in options_found:
+                slot = (option['date'], time.fromisoformat(option['start_time']))
+                if Booking.objects.filter(
+                    user_id__in=both, status='CONFIRMED', time_slot__date=slot[0], time_slot__start_time=slot[1]
+                ).exists():
+                    raise CommandError(f'{option} clashes with a booking of {team.name} or {opponent.name}')
+                if TimeSlot.objects.filter(
+                    ground_id=option['ground'], date=slot[0], start_time=slot[1], is_booked=True
+                ).exists():
+                    raise CommandError(f'{option} is already booked')
+        self.stdout.write(self.style.SUCCESS('Every option is free and clear of both rosters'))
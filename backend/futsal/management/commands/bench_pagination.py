@@ -0,0 +1,64 @@
+import statistics
+import time as timer
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from futsal.models import Post, User
+from futsal.pagination import KeysetPagination
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the queries behind shallow and deep pages of posts: page numbers '
+            'vs keyset cursors')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=100000)
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per page and mode')
+
+    def handle(self, *args, **options):
+        # Everything is seeded inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            user = User.objects.create(username='bench_pagination')
+            for offset in range(0, options['posts'], 5000):
+                Post.objects.bulk_create(
+                    Post(author=user, title=f'Bench post {offset + i}', content='Bench')
+                    for i in range(min(5000, options['posts'] - offset))
+                )
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Post._meta.db_table}')
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        paginator = KeysetPagination()
+        page_size = paginator.page_size
+        ordered = Post.objects.order_by(*paginator.ordering)
+
+        last_page = options['posts'] // page_size
+        for page in (1, 10, last_page // 10, last_page):
+            numbered = self.measure(PageNumberPagination, {'page': page}, options['iterations'])
+            if page == 1:
+                cursor = ''
+            else:
+                # The cursor a client would hold after scrolling to this page
+                row = ordered[(page - 1) * page_size - 1]
+                cursor = paginator.encode_cursor([getattr(row, name.lstrip('-')) for name in paginator.ordering])
+            keyset = self.measure(KeysetPagination, {'cursor': cursor}, options['iterations'])
+            self.stdout.write(
+                f'page {page:>6}   ?page= {numbered * 1000:>8.1f} ms   ?cursor= {keyset * 1000:>8.1f} ms'
+            )
+
+    def measure(self, pagination_class, params, iterations):
+        # Serialization is the same either way, only the paging queries are timed
+        request = Request(APIRequestFactory().get('/api/posts/', params))
+        queryset = Post.objects.order_by(*KeysetPagination.ordering)
+        timings = []
+        for _ in range(iterations):
+            started = timer.perf_counter()
+            pagination_class().paginate_queryset(queryset, request)
+            timings.append(timer.perf_counter() - started)
+        return statistics.median(timings)
@@ -0,0 +1,80 @@
+import random
+import statistics
+import time as timer
+
+from django.contrib.postgres.search import SearchQuery
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from rest_framework.test import APIClient
+
+from futsal.models import Post, User
+
+WORDS = (
+    'futsal match goal keeper striker defender tournament league weekend evening ground booking '
+    'team players looking score win draw penalty corner highlight training session friendly '
+    'kathmandu lalitpur bhaktapur indoor outdoor turf rain final semi quarter trophy captain'
+).split()
+TERMS = ['goal', 'penalty', '"friendly match"', 'tournament final', 'keeper -training']
+
+
+class Command(BaseCommand):
+    help = 'Benchmark post search: SearchFilter (ILIKE) vs the full-text search vector'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=100000)
+        parser.add_argument('--iterations', type=int, default=20, help='Requests per term and mode')
+
+    def handle(self, *args, **options):
+        # Everything is seeded inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            user = self.seed(options['posts'])
+            self.run(user, options)
+            transaction.set_rollback(True)
+
+    def seed(self, posts):
+        user = User.objects.create(username='bench_post_search')
+        rng = random.Random(42)
+        # Mostly unrelated chatter so that, like in a real feed, a term matches a small share of posts
+        filler = [''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(4, 9))) for _ in range(20000)]
+        started = timer.perf_counter()
+        for offset in range(0, posts, 5000):
+            Post.objects.bulk_create(
+                Post(author=user, title=self.text(rng, filler, 5), content=self.text(rng, filler, 40))
+                for _ in range(min(5000, posts - offset))
+            )
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Post._meta.db_table}')
+        self.stdout.write(f'Seeded {posts} posts in {timer.perf_counter() - started:.1f}s')
+        return user
+
+    def text(self, rng, filler, words):
+        return ' '.join(rng.choice(WORDS) if rng.random() < 0.01 else rng.choice(filler) for _ in range(words))
+
+    def run(self, user, options):
+        client = APIClient()
+        client.force_authenticate(user)
+
+        for term in TERMS:
+            # SearchFilter knows no phrases or exclusions, give it the first plain word
+            plain = next(word for word in term.strip('"').split() if not word.startswith('-'))
+            ilike = self.measure(client, {'search': plain}, options['iterations'])
+            fts = self.measure(client, {'q': term}, options['iterations'])
+            self.stdout.write(
+                f'{term:<20} search={plain:<12} {ilike * 1000:>8.1f} ms   q {fts * 1000:>8.1f} ms   '
+                f'x{ilike / fts:.1f}'
+            )
+
+        query = SearchQuery('goal', search_type='websearch', config='english')
+        plan = Post.objects.filter(search_vector=query).explain()
+        uses_index = 'post_search_vector_idx' in plan
+        self.stdout.write(self.style.SUCCESS(
+            'Full-text search uses the GIN index' if uses_index else 'Full-text search does not use the GIN index'
+        ))
+
+    def measure(self, client, params, iterations):
+        timings = []
+        for _ in range(iterations):
+            started = timer.perf_counter()
+            client.get('/api/posts/', params)
+            timings.append(timer.perf_counter() - started)
+        return statistics.median(timings)
@@ -0,0 +1,28 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from futsal import media
+
+
+class Command(BaseCommand):
+    help = 'Delete uploaded files and image variants that no row refers to any more'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Files looked up per query')
+        parser.add_argument('--grace-hours', type=float, default=None,
+                            help='Keep unreferenced files younger than this (default MEDIA_ORPHAN_GRACE)')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the orphans')
+        parser.add_argument('--every', type=float, default=0,
+                            help='Keep running and collect every N seconds')
+
+    def handle(self, *args, **options):
+        grace = timedelta(hours=options['grace_hours']) if options['grace_hours'] is not None else None
+        while True:
+            checked, deleted = media.collect_orphans(options['batch_size'], grace, options['dry_run'])
+            verb = 'Found' if options['dry_run'] else 'Deleted'
+            self.stdout.write(f'{verb} {deleted} orphaned files among {checked}')
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,79 @@
+from datetime import date, time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.functions import ExtractHour, ExtractIsoWeekDay
+
+from futsal import availability
+from futsal.models import Ground, GroundSchedule, TimeSlot
+
+
+class Command(BaseCommand):
+    help = 'Give unscheduled grounds a weekly schedule and drop their pre-generated slots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--open', type=int, default=6,
+                            help='Opening hour used when a ground has no upcoming slots')
+        parser.add_argument('--close', type=int, default=21,
+                            help='Closing hour used when a ground has no upcoming slots')
+        parser.add_argument('--prune', action='store_true',
+                            help='Delete unbooked slots that no booking refers to')
+
+    def handle(self, *args, **options):
+        grounds = list(Ground.objects.filter(schedules__isnull=True))
+        if not grounds:
+            self.stdout.write('Every ground already has a schedule')
+            return
+
+        schedules = []
+        for ground in grounds:
+            hours = self.upcoming_hours(ground)
+            if not hours:
+                default = set(range(options['open'], options['close']))
+                hours = {weekday: default for weekday in range(7)}
+            for weekday, weekday_hours in hours.items():
+                for open_hour, close_hour in self.intervals(weekday_hours):
+                    schedules.append(GroundSchedule(
+                        ground=ground,
+                        weekday=weekday,
+                        open_time=time(open_hour, 0),
+                        close_time=time(close_hour % 24, 0),
+                    ))
+
+        with transaction.atomic():
+            GroundSchedule.objects.bulk_create(schedules)
+            pruned = 0
+            if options['prune']:
+                pruned, _ = TimeSlot.objects.filter(
+                    ground__in=grounds, is_booked=False, booking__isnull=True
+                ).delete()
+            availability.rebuild(ground_ids=[ground.id for ground in grounds])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {len(schedules)} schedule entries for {len(grounds)} grounds'
+        ))
+        if options['prune']:
+            self.stdout.write(self.style.SUCCESS(f'Pruned {pruned} pre-generated slots'))
+
+    def upcoming_hours(self, ground):
+        """Hours each weekday already has slots for, from today on"""
+        hours = {}
+        rows = (
+            TimeSlot.objects.filter(ground=ground, date__gte=date.today())
+            .annotate(weekday=ExtractIsoWeekDay('date'), hour=ExtractHour('start_time'))
+            .values_list('weekday', 'hour')
+            .distinct()
+        )
+        for weekday, hour in rows:
+            hours.setdefault(weekday - 1, set()).add(hour)
+        return hours
+
+    def intervals(self, hours):
+        """Group hours into contiguous (open, close) ranges"""
+        ranges = []
+        for hour in sorted(hours):
+            if ranges and ranges[-1][1] == hour:
+                ranges[-1][1] = hour + 1
+            else:
+                ranges.append([hour, hour + 1])
+        return ranges
@@ -1,55 +1,98 @@
-from django.core.management.base import BaseCommand
-from futsal.models import Ground, TimeSlot
-from datetime import datetime, timedelta, time
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.utils import timezone
+
+from futsal import availability
+from futsal.models import Ground, GroundAvailability, TimeSlot
+
 
 class Command(BaseCommand):
-    help = 'Create time slots for all grounds'
-
-    def handle(self, *args, **kwargs):
-        grounds = Ground.objects.all()
-        
-        if not grounds.exists():
-            self.stdout.write(self.style.ERROR('No grounds found! Please create grounds first.'))
-            return
-        
-        # Time slots from 6 AM to 9 PM (every hour)
-        time_slots = [
-            (time(6, 0), time(7, 0)),
-            (time(7, 0), time(8, 0)),
-            (time(8, 0), time(9, 0)),
-            (time(9, 0), time(10, 0)),
-            (time(10, 0), time(11, 0)),
-            (time(11, 0), time(12, 0)),
-            (time(12, 0), time(13, 0)),
-            (time(13, 0), time(14, 0)),
-            (time(14, 0), time(15, 0)),
-            (time(15, 0), time(16, 0)),
-            (time(16, 0), time(17, 0)),
-            (time(17, 0), time(18, 0)),
-            (time(18, 0), time(19, 0)),
-            (time(19, 0), time(20, 0)),
-            (time(20, 0), time(21, 0)),
-        ]
-        
-        created_count = 0
-        
-        for ground in grounds:
-            self.stdout.write(f'Creating time slots for {ground.name} at {ground.futsal.name}...')
-            
-            # Create time slots for next 14 days
-            for day in range(14):
-                date = datetime.now().date() + timedelta(days=day)
-                
-                for start_time, end_time in time_slots:
-                    slot, created = TimeSlot.objects.get_or_create(
-                        ground=ground,
-                        date=date,
-                        start_time=start_time,
-                        defaults={'end_time': end_time}
-                    )
-                    if created:
-                        created_count += 1
-        
-        self.stdout.write(self.style.SUCCESS(f'Successfully created {created_count} time slots!'))
-        self.stdout.write(self.style.SUCCESS(f'Time slots created for next 14 days'))
-        self.stdout.write(self.style.SUCCESS(f'Grounds covered: {grounds.count()}'))
\ No newline at end of file
+    help = ('Keep a rolling window of time slots for grounds that have no weekly schedule. '
+            'Idempotent, safe to run from cron every night.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=14, help='How many days ahead to cover')
+        parser.add_argument('--open', type=int, default=6, help='First slot starts at this hour')
+        parser.add_argument('--close', type=int, default=21, help='Last slot ends at this hour')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows per INSERT')
+        parser.add_argument('--workers', type=int, default=4, help='Grounds processed in parallel')
+        parser.add_argument('--no-prune', action='store_true',
+                            help='Keep expired unbooked slots')
+
+    def handle(self, *args, **options):
+        if options['days'] < 1:
+            raise CommandError('--days must be at least 1')
+        if not 0 <= options['open'] < options['close'] <= 24:
+            raise CommandError('--open and --close must satisfy 0 <= open < close <= 24')
+
+        # Scheduled grounds get their slots from GroundSchedule, nothing to pre-create
+        ground_ids = list(Ground.objects.filter(schedules__isnull=True).values_list('id', flat=True))
+
+        started = timer.perf_counter()
+        created = 0
+        if ground_ids:
+            with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+                created = sum(pool.map(lambda ground_id: self.fill(ground_id, options), ground_ids))
+        else:
+            self.stdout.write(self.style.WARNING('No unscheduled grounds found'))
+        elapsed = timer.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {created} time slots for {len(ground_ids)} grounds in {elapsed:.2f}s '
+            f'({created / elapsed if elapsed else 0:.0f} rows/sec)'
+        ))
+
+        if not options['no_prune']:
+            started = timer.perf_counter()
+            pruned = self.prune(options['chunk_size'])
+            elapsed = timer.perf_counter() - started
+            self.stdout.write(self.style.SUCCESS(
+                f'Pruned {pruned} expired unbooked slots in {elapsed:.2f}s '
+                f'({pruned / elapsed if elapsed else 0:.0f} rows/sec)'
+            ))
+
+    def fill(self, ground_id, options):
+        """Insert the missing slots of one ground, returns how many were created"""
+        today = timezone.localdate()
+        dates = [today + timedelta(days=day) for day in range(options['days'])]
+        hours = range(options['open'], options['close'])
+        window = TimeSlot.objects.filter(ground_id=ground_id, date__range=(dates[0], dates[-1]))
+
+        try:
+            before = window.count()
+            slots = [
+                TimeSlot(
+                    ground_id=ground_id,
+                    date=day,
+                    start_time=time(hour, 0),
+                    end_time=(datetime.combine(day, time(hour, 0)) + timedelta(hours=1)).time(),
+                )
+                for day in dates for hour in hours
+            ]
+            # Existing slots hit the unique constraint and are skipped
+            TimeSlot.objects.bulk_create(slots, batch_size=options['chunk_size'], ignore_conflicts=True)
+            created = window.count() - before
+            if created:
+                availability.rebuild([ground_id], dates)
+            return created
+        finally:
+            connections.close_all()
+
+    def prune(self, chunk_size):
+        """Drop past slots nobody booked, and the index rows of past days"""
+        today = timezone.localdate()
+        expired = TimeSlot.objects.filter(date__lt=today, is_booked=False, booking__isnull=True)
+
+        pruned = 0
+        while True:
+            ids = list(expired.values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            TimeSlot.objects.filter(id__in=ids).delete()
+            pruned += len(ids)
+        GroundAvailability.objects.filter(date__lt=today).delete()
+        return pruned
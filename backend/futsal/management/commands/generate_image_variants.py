@@ -0,0 +1,71 @@
+import time as timer
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from futsal import images
+
+
+def process(job):
+    model, pk, field, variants_field = job
+    close_old_connections()
+    try:
+        return images.generate(model, pk, field, variants_field)
+    except Exception as e:
+        return e
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = ('Render resized WebP and JPEG variants of profile pictures and post images that have none, '
+            'or of every image with --all, on a pool of workers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Re-render images that already have variants')
+        parser.add_argument('--workers', type=int, default=4, help='Images rendered in parallel')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows read per query')
+
+    def handle(self, *args, **options):
+        started = timer.perf_counter()
+        done = failed = original_bytes = variant_bytes = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            for model, targets in images.TARGETS.items():
+                for field, variants_field in targets:
+                    for jobs, sources in self.batches(model, field, variants_field, options):
+                        for result, source in zip(pool.map(process, jobs), sources):
+                            if isinstance(result, Exception):
+                                failed += 1
+                                self.stderr.write(f'{source}: {result}')
+                            elif result is not None:
+                                done += 1
+                                original_bytes += default_storage.size(source)
+                                variant_bytes += default_storage.size(result['medium']['webp'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered variants of {done} images in {timer.perf_counter() - started:.1f}s, {failed} failed'
+        ))
+        if done:
+            self.stdout.write(
+                f'Originals {original_bytes / 1024:.0f} KiB, medium WebP variants {variant_bytes / 1024:.0f} KiB '
+                f'({variant_bytes / original_bytes:.0%})'
+            )
+
+    def batches(self, model, field, variants_field, options):
+        """Lists of jobs for rows whose image has no variants (or all rows with an image)"""
+        rows = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True}).order_by('pk')
+        last_pk = None
+        while True:
+            batch = rows if last_pk is None else rows.filter(pk__gt=last_pk)
+            batch = list(batch.values_list('pk', field, variants_field)[:options['batch_size']])
+            if not batch:
+                return
+            last_pk = batch[-1][0]
+            todo = [
+                (pk, name) for pk, name, variants in batch
+                if options['all'] or (variants or {}).get('source') != name
+            ]
+            if todo:
+                yield [(model, pk, field, variants_field) for pk, _ in todo], [name for _, name in todo]
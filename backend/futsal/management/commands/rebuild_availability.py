@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from futsal import availability
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-ground availability index from time slots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ground', type=int, action='append', dest='grounds',
+                            help='Only rebuild this ground (repeatable)')
+
+    def handle(self, *args, **options):
+        rows = availability.rebuild(ground_ids=options['grounds'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} availability rows'))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from futsal import standings
+from futsal.models import Tournament
+
+
+class Command(BaseCommand):
+    help = 'Recompute tournament standings from the fixtures, after imports or bulk result updates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tournament', type=int, action='append', help='Tournament id, repeatable (default: all)')
+
+    def handle(self, *args, **options):
+        tournaments = Tournament.objects.order_by('id')
+        if options['tournament']:
+            tournaments = tournaments.filter(id__in=options['tournament'])
+        rows = 0
+        for tournament in tournaments.iterator():
+            # One transaction per tournament, results elsewhere are not held up
+            rows += standings.rebuild(tournament)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {rows} standings rows'))
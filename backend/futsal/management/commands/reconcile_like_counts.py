@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from futsal import likes
+from futsal.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Flush buffered likes and recount Post.likes_count where it drifted from the likes table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Posts checked per UPDATE')
+
+    def handle(self, *args, **options):
+        likes.flush()
+
+        actual = Coalesce(Subquery(
+            likes.Like.objects.filter(post=OuterRef('pk')).values('post').annotate(n=Count('*')).values('n')
+        ), 0)
+        fixed = 0
+        last_id = 0
+        while True:
+            ids = list(
+                Post.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not ids:
+                break
+            # Only rows whose counter is off are written
+            fixed += (
+                Post.objects.filter(id__in=ids).annotate(actual=actual)
+                .exclude(likes_count=F('actual')).update(likes_count=actual)
+            )
+            last_id = ids[-1]
+        self.stdout.write(self.style.SUCCESS(f'Fixed the like count of {fixed} posts'))
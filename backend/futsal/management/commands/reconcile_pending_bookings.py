@@ -0,0 +1,72 @@
+import time as timer
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from futsal import khalti, payments
+from futsal.models import PaymentVerification, PendingBooking
+
+
+class Command(BaseCommand):
+    help = ('Look up abandoned Khalti checkouts and confirm the paid ones, discarding '
+            'the rest. Safe to run from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=15,
+                            help='Only checkouts started at least this many minutes ago')
+        parser.add_argument('--expire-after', type=int, default=60,
+                            help='Discard still pending payments after this many minutes')
+        parser.add_argument('--batch-size', type=int, default=200, help='Pending bookings per batch')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent Khalti lookups')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        expire_before = now - timedelta(minutes=options['expire_after'])
+        # Checkouts with a verification belong to the payment worker, or were settled
+        # for good (FAILED, REFUND_DUE) and must not be looked up and confirmed later
+        stale = (
+            PendingBooking.objects.filter(created_at__lt=now - timedelta(minutes=options['older_than']))
+            .exclude(Exists(PaymentVerification.objects.filter(booking_ref=OuterRef('booking_ref'))))
+            .order_by('created_at', 'id')
+        )
+
+        outcomes = Counter()
+        started = timer.perf_counter()
+        last = None
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                batch = stale
+                if last is not None:
+                    # Keyset pagination, kept rows are not picked up again
+                    batch = batch.filter(created_at__gte=last.created_at).exclude(
+                        created_at=last.created_at, id__lte=last.id
+                    )
+                batch = list(batch[:options['batch_size']])
+                if not batch:
+                    break
+                # Only the lookups run in the pool, the database work stays on this thread
+                for pending, result in zip(batch, pool.map(self.lookup, batch)):
+                    if isinstance(result, khalti.KhaltiError):
+                        outcomes['unreachable'] += 1
+                        continue
+                    status_code, payment_data = result
+                    outcomes[payments.reconcile_pending(pending, status_code, payment_data, expire_before)] += 1
+                last = batch[-1]
+        elapsed = timer.perf_counter() - started
+
+        total = sum(outcomes.values())
+        self.stdout.write(', '.join(f'{name} {count}' for name, count in sorted(outcomes.items())) or 'Nothing to do')
+        self.stdout.write(self.style.SUCCESS(
+            f'Reconciled {total} pending bookings in {elapsed:.2f}s '
+            f'({total / elapsed if elapsed else 0:.0f}/sec)'
+        ))
+
+    def lookup(self, pending):
+        try:
+            return khalti.get_client().lookup(pending.pidx)
+        except khalti.KhaltiError as e:
+            return e
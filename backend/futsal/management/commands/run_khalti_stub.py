@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from futsal.khalti_stub import KhaltiStub
+
+
+class Command(BaseCommand):
+    help = 'Run a local Khalti stub, point KHALTI_BASE_URL at the printed URL'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every answer')
+        parser.add_argument('--status', default='Completed', help='Status reported by lookups')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of 503 answers')
+
+    def handle(self, *args, **options):
+        stub = KhaltiStub(
+            port=options['port'],
+            latency=options['latency'],
+            lookup_status=options['status'],
+            failure_rate=options['failure_rate'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Khalti stub listening on {stub.base_url}'))
+        try:
+            stub.server.serve_forever()
+        except KeyboardInterrupt:
+            stub.stop()
@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from futsal import payments
+
+
+def process(job):
+    close_old_connections()
+    try:
+        payments.process_verification(job)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = 'Verify queued Khalti payments and create their bookings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help='Payments verified in parallel')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--stale-after', type=int, default=300,
+                            help='Requeue jobs stuck in PROCESSING for this many seconds')
+        parser.add_argument('--once', action='store_true', help='Drain the due jobs and exit')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        stale_after = timedelta(seconds=options['stale_after'])
+        self.stdout.write(self.style.SUCCESS(f'Payment worker started with {workers} workers'))
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                payments.requeue_stale(stale_after)
+                jobs = payments.claim_verifications(limit=workers * 4)
+                if jobs:
+                    started = time.perf_counter()
+                    list(pool.map(process, jobs))
+                    self.stdout.write(f'Processed {len(jobs)} payments in {time.perf_counter() - started:.2f}s')
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['poll'])
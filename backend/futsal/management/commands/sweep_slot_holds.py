@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from futsal import holds
+
+
+class Command(BaseCommand):
+    help = 'Delete expired slot holds'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--every', type=float, default=0,
+                            help='Keep running and sweep every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            swept = holds.sweep(options['batch_size'])
+            if swept:
+                self.stdout.write(f'Swept {swept} expired holds')
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,53 @@
+import math
+import time as timer
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.settings import api_settings
+from rest_framework.test import APIClient
+
+from futsal import catalog
+from futsal.models import Futsal, Ground, User
+
+
+class Command(BaseCommand):
+    help = ('Fill the shared catalog cache with the venue and ground responses the app asks '
+            'for, e.g. after a deploy or a catalog change')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost',
+                            help='Host the app is reached at, cached responses embed absolute URLs')
+        parser.add_argument('--pages', type=int, default=5, help='Pages of the venue list to warm')
+
+    def handle(self, *args, **options):
+        if not catalog.is_shared():
+            raise CommandError('The catalog cache is per process (no REDIS_URL), '
+                               'warming it here would only warm this command')
+        # Ground endpoints need a login, any staff account will do
+        staff = User.objects.filter(is_staff=True, is_active=True).first()
+        client = APIClient(HTTP_HOST=options['host'])
+
+        futsal_ids = list(Futsal.objects.filter(is_active=True).values_list('id', flat=True))
+        pages = min(math.ceil(len(futsal_ids) / api_settings.PAGE_SIZE), options['pages'])
+        # The app asks for the first page without ?page=
+        paths = ['/api/futsals/'] + [f'/api/futsals/?page={page}' for page in range(2, pages + 1)]
+        paths += [f'/api/futsals/{pk}/' for pk in futsal_ids]
+        if staff:
+            client.force_authenticate(staff)
+            paths += ['/api/grounds/']
+            paths += [f'/api/grounds/{pk}/' for pk in Ground.objects.values_list('id', flat=True)]
+        else:
+            self.stdout.write(self.style.WARNING('No staff user, ground responses are not warmed'))
+
+        started = timer.perf_counter()
+        warmed = 0
+        for path in paths:
+            response = client.get(path)
+            if response.status_code != 200:
+                raise CommandError(f'{path} answered {response.status_code}')
+            warmed += 1
+        elapsed = timer.perf_counter() - started
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Warmed {warmed} catalog responses in {elapsed:.2f}s (version {catalog.version()})'
+        ))
+        self.stdout.write(str(catalog.stats()))
@@ -0,0 +1,73 @@
+"""Finding free agents, players looking for a team.
+
+Only a small share of users have ``is_looking_for_team`` set, so the
+lookups run on a partial index that covers just those rows. Gender and the
+age band filter in the WHERE clause. Position and home futsal rank instead:
+players matching both come first, then those matching one, each tier most
+experienced first. Pages come from keyset pagination on
+(-relevance, -matches_played, id) and only the columns shown are fetched,
+so a page is one top-N sort over the matching free agents, never a load of
+all of them into Python.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
+
+User = get_user_model()
+
+FREE_AGENT_FIELDS = [
+    'id', 'username', 'full_name', 'preferred_position', 'gender', 'date_of_birth',
+    'futsal_id', 'matches_played', 'profile_picture', 'profile_picture_variants',
+]
+
+
+def _years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        # 29 February in a year that has none
+        return day.replace(year=day.year - years, day=28)
+
+
+def birth_date_range(min_age=None, max_age=None, today=None):
+    """(earliest, latest) date of birth for an age band, either end may be None"""
+    today = today or timezone.localdate()
+    latest = _years_before(today, min_age) if min_age is not None else None
+    # Somebody turning max_age + 1 tomorrow is still max_age today
+    earliest = _years_before(today, max_age + 1) if max_age is not None else None
+    return earliest, latest
+
+
+def _matches(condition, weight):
+    if condition is None:
+        return Value(0)
+    return Case(When(condition, then=Value(weight)), default=Value(0), output_field=IntegerField())
+
+
+def free_agents(position=None, gender=None, futsal_id=None, min_age=None, max_age=None, exclude=None):
+    """Queryset of free agents in the gender and age band given, annotated with ``relevance``
+
+    ``relevance`` is 2 for the wanted position plus 1 for the home futsal.
+    """
+    players = User.objects.filter(is_looking_for_team=True).only(*FREE_AGENT_FIELDS)
+    if exclude is not None:
+        players = players.exclude(id=exclude)
+    if gender:
+        players = players.filter(gender=gender)
+    earliest, latest = birth_date_range(min_age, max_age)
+    if earliest is not None:
+        players = players.filter(date_of_birth__gt=earliest)
+    if latest is not None:
+        players = players.filter(date_of_birth__lte=latest)
+    return players.annotate(relevance=(
+        _matches(Q(preferred_position=position) if position else None, 2)
+        + _matches(Q(futsal_id=futsal_id) if futsal_id is not None else None, 1)
+    ))
+
+
+def age(date_of_birth, today=None):
+    """Age in whole years, None without a date of birth"""
+    if date_of_birth is None:
+        return None
+    today = today or timezone.localdate()
+    return today.year - date_of_birth.year - ((today.month, today.day) < (date_of_birth.month, date_of_birth.day))
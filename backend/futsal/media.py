@@ -0,0 +1,213 @@
+"""Content-addressed media files.
+
+Every upload is stored under the SHA-256 of its bytes,
+``<top directory>/<aa>/<sha256><ext>`` (``posts/3f/3f9c...e1.jpg``), so
+identical uploads share one file and a name never changes content. Two
+things follow from that:
+
+- files are never deleted when a row lets go of them, another row may use
+  the same file. ``collect_media_orphans`` deletes files no row refers to
+  in batches, once they are older than ``MEDIA_ORPHAN_GRACE`` so uploads
+  whose row is not committed yet are left alone;
+- responses for hashed names are cached for a year as ``immutable``. With
+  ``MEDIA_OFFLOAD`` set the web server sends the bytes (X-Accel-Redirect
+  or X-Sendfile) and Django only checks the path.
+
+Django streams the bytes itself only with DEBUG on. In production either
+set ``MEDIA_OFFLOAD`` or let the web server serve ``MEDIA_ROOT`` at
+``MEDIA_URL`` directly, without the cache headers above. For
+``MEDIA_OFFLOAD=x-accel`` nginx needs an internal location at
+``MEDIA_ACCEL_PREFIX``::
+
+    location /protected-media/ {
+        internal;
+        alias /srv/matchly/backend/media/;
+    }
+
+and for ``MEDIA_OFFLOAD=x-sendfile`` Apache needs mod_xsendfile allowed to
+read ``MEDIA_ROOT``::
+
+    XSendFile On
+    XSendFilePath /srv/matchly/backend/media
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import tempfile
+from urllib.parse import quote
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db.models import FileField, Q
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils import timezone
+from django.utils.http import http_date
+
+TEMP_PREFIX = '.upload-'
+OFFLOADS = ('', 'x-accel', 'x-sendfile')
+HASHED_NAME = re.compile(r'(^|/)[0-9a-f]{2}/[0-9a-f]{64}(\.\w+)?$')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Names from before content addressing say nothing about the content
+MUTABLE = 'public, max-age=3600'
+
+
+def hashed_name(name, content):
+    """Content-addressed name of ``content`` uploaded as ``name``"""
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    digest = digest.hexdigest()
+    parts = name.replace('\\', '/').split('/')
+    top = parts[0] if len(parts) > 1 else ''
+    extension = posixpath.splitext(parts[-1])[1].lower()
+    return posixpath.join(top, digest[:2], digest + extension)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """File system storage that names files by the hash of their content"""
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = hashed_name(name, content)
+        if max_length and len(name) > max_length:
+            raise SuspiciousFileOperation(f'Storage can not find an available filename for "{name}".')
+        full_path = self.path(name)
+        if os.path.isfile(full_path):
+            # Same bytes already stored, fresh mtime keeps the orphan collector off it
+            os.utime(full_path)
+            return name
+        return self._save(name, content)
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        if self.directory_permissions_mode is not None:
+            old_umask = os.umask(0o777 & ~self.directory_permissions_mode)
+            try:
+                os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+            finally:
+                os.umask(old_umask)
+        else:
+            os.makedirs(directory, exist_ok=True)
+
+        # Written aside and linked into place, a half-written file is never visible
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as temp:
+                for chunk in content.chunks():
+                    temp.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            try:
+                os.link(temp_path, full_path)
+            except FileExistsError:
+                # The same upload raced us here
+                os.utime(full_path)
+        finally:
+            os.unlink(temp_path)
+        return name
+
+
+def _walk(directory=''):
+    directories, files = default_storage.listdir(directory)
+    for name in files:
+        yield posixpath.join(directory, name)
+    for sub in directories:
+        yield from _walk(posixpath.join(directory, sub))
+
+
+def _file_fields():
+    """(model, field name) of every file field of the app"""
+    return [
+        (model, field.name)
+        for model in apps.get_app_config('futsal').get_models()
+        for field in model._meta.get_fields()
+        if isinstance(field, FileField)
+    ]
+
+
+def referenced(names):
+    """The subset of ``names`` some row refers to, as a file or an image variant"""
+    from . import images
+
+    names = list(names)
+    found = set()
+    for model, field in _file_fields():
+        found.update(model.objects.filter(**{f'{field}__in': names}).values_list(field, flat=True))
+    for model, targets in images.TARGETS.items():
+        for _, variants_field in targets:
+            lookups = Q()
+            for size in images.SIZES:
+                for image_format in images.FORMATS:
+                    lookups |= Q(**{f'{variants_field}__{size}__{image_format}__in': names})
+            for variants in model.objects.filter(lookups).values_list(variants_field, flat=True):
+                for size in images.SIZES:
+                    found.update(variants.get(size, {}).get(image_format) for image_format in images.FORMATS)
+    return found & set(names)
+
+
+def collect_orphans(batch_size=500, grace=None, dry_run=False):
+    """Delete stored files no row refers to, returns (files checked, files deleted)"""
+    grace = settings.MEDIA_ORPHAN_GRACE if grace is None else grace
+    cutoff = timezone.now() - grace
+    checked = deleted = 0
+
+    def sweep(batch):
+        nonlocal deleted
+        for name in set(batch) - referenced(batch):
+            # Checked again right before deleting, a repeat upload refreshes the mtime
+            if default_storage.get_modified_time(name) >= cutoff:
+                continue
+            if not dry_run:
+                default_storage.delete(name)
+            deleted += 1
+
+    batch = []
+    for name in _walk():
+        checked += 1
+        if default_storage.get_modified_time(name) >= cutoff:
+            continue
+        batch.append(name)
+        if len(batch) == batch_size:
+            sweep(batch)
+            batch = []
+    if batch:
+        sweep(batch)
+    return checked, deleted
+
+
+def file_response(path):
+    """Response for a media file, headers only when the web server sends the bytes"""
+    try:
+        full_path = default_storage.path(path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path) or os.path.basename(path).startswith(TEMP_PREFIX):
+        raise Http404
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    if settings.MEDIA_OFFLOAD == 'x-accel':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + quote(path)
+    elif settings.MEDIA_OFFLOAD == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = full_path
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    if HASHED_NAME.search(path):
+        response['Cache-Control'] = IMMUTABLE
+        response['ETag'] = f'"{posixpath.splitext(posixpath.basename(path))[0]}"'
+    else:
+        response['Cache-Control'] = MUTABLE
+        response['Last-Modified'] = http_date(os.path.getmtime(full_path))
+    return response
@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-18 04:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_index(apps, schema_editor):
+    TimeSlot = apps.get_model('futsal', 'TimeSlot')
+    GroundAvailability = apps.get_model('futsal', 'GroundAvailability')
+
+    rows = {}
+    for slot_id, ground_id, date, start_time, is_booked in TimeSlot.objects.values_list(
+        'id', 'ground_id', 'date', 'start_time', 'is_booked'
+    ).iterator(chunk_size=5000):
+        row = rows.setdefault((ground_id, date), GroundAvailability(
+            ground_id=ground_id, date=date, slot_ids={}
+        ))
+        bit = 1 << start_time.hour
+        row.open_mask |= bit
+        if is_booked:
+            row.booked_mask |= bit
+        row.slot_ids[str(start_time.hour)] = slot_id
+    GroundAvailability.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0008_pendingbooking_delete_rewardtracker'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroundAvailability',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('open_mask', models.IntegerField(default=0)),
+                ('booked_mask', models.IntegerField(default=0)),
+                ('slot_ids', models.JSONField(default=dict)),
+                ('ground', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability', to='futsal.ground')),
+            ],
+            options={
+                'unique_together': {('ground', 'date')},
+            },
+        ),
+        migrations.RunPython(build_index, migrations.RunPython.noop),
+    ]
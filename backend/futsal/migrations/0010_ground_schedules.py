@@ -0,0 +1,42 @@
+# Generated by Django 6.0 on 2026-10-18 04:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0009_groundavailability'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroundSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.IntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('open_time', models.TimeField()),
+                ('close_time', models.TimeField()),
+                ('ground', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to='futsal.ground')),
+            ],
+            options={
+                'ordering': ['ground', 'weekday', 'open_time'],
+                'unique_together': {('ground', 'weekday', 'open_time')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ScheduleException',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('open_time', models.TimeField(blank=True, null=True)),
+                ('close_time', models.TimeField(blank=True, null=True)),
+                ('note', models.CharField(blank=True, max_length=200)),
+                ('ground', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='schedule_exceptions', to='futsal.ground')),
+            ],
+            options={
+                'unique_together': {('ground', 'date', 'open_time')},
+            },
+        ),
+    ]
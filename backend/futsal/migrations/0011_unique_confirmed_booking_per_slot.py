@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0010_ground_schedules'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='booking',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'CONFIRMED')), fields=('time_slot',), name='unique_confirmed_booking_per_slot'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 6.0 on 2026-10-18 04:27
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0011_unique_confirmed_booking_per_slot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentVerification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('booking_ref', models.CharField(max_length=100, unique=True)),
+                ('pidx', models.CharField(max_length=200)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('PROCESSING', 'Processing'), ('CONFIRMED', 'Confirmed'), ('FAILED', 'Failed')], default='QUEUED', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('message', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'QUEUED')), fields=['next_attempt_at'], name='payment_verification_due_idx')],
+            },
+        ),
+    ]
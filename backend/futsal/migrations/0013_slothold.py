@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 04:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0012_paymentverification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('booking_ref', models.CharField(db_index=True, max_length=100)),
+                ('date', models.DateField()),
+                ('start_time', models.TimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('ground', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='slot_holds', to='futsal.ground')),
+                ('time_slot', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='hold', to='futsal.timeslot')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ground', 'date'], name='futsal_slot_ground__6ccf26_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 04:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0013_slothold'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pendingbooking',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
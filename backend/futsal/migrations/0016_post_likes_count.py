@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 04:33
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_likes(apps, schema_editor):
+    Post = apps.get_model('futsal', 'Post')
+    Like = Post.likes.through
+    Post.objects.update(likes_count=Coalesce(Subquery(
+        Like.objects.filter(post=OuterRef('pk')).values('post').annotate(n=Count('*')).values('n')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0015_comment_post_recent_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_likes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 04:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0017_post_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='futsal',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='futsal',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='futsal',
+            index=models.Index(fields=['latitude', 'longitude'], name='futsal_lat_lng_idx'),
+        ),
+    ]
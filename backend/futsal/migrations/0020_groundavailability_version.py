@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0019_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groundavailability',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.0 on 2026-10-18 04:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0020_groundavailability_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LoyaltyEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('EARNED', 'Paid booking'), ('REDEEMED', 'Free booking')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('booking', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='loyalty_entry', to='futsal.booking')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='loyalty_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-created_at'], name='loyalty_user_created_idx')],
+            },
+        ),
+    ]
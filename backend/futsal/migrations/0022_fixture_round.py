@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-18 04:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0021_loyaltyentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fixture',
+            name='round',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='fixture',
+            index=models.Index(fields=['ground', 'match_date'], name='fixture_ground_date_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0 on 2026-10-18 04:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0022_fixture_round'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Standing',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('played', models.IntegerField(default=0)),
+                ('won', models.IntegerField(default=0)),
+                ('drawn', models.IntegerField(default=0)),
+                ('lost', models.IntegerField(default=0)),
+                ('goals_for', models.IntegerField(default=0)),
+                ('goals_against', models.IntegerField(default=0)),
+                ('points', models.IntegerField(default=0)),
+                ('head_to_head', models.JSONField(blank=True, default=dict)),
+                ('team', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='futsal.team')),
+                ('tournament', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='futsal.tournament')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('tournament', 'team'), name='unique_standing_per_team')],
+            },
+        ),
+    ]
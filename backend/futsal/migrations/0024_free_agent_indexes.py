@@ -0,0 +1,26 @@
+# Generated by Django 6.0 on 2026-10-18 04:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('futsal', '0023_standing'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_looking_for_team', True)), fields=['-matches_played', 'id'], name='user_free_agent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_looking_for_team', True)), fields=['preferred_position', '-matches_played', 'id'], name='user_free_agent_position_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(condition=models.Q(('is_looking_for_team', True)), fields=['futsal', '-matches_played', 'id'], name='user_free_agent_futsal_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 05:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0025_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='paymentverification',
+            name='status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('PROCESSING', 'Processing'), ('CONFIRMED', 'Confirmed'), ('FAILED', 'Failed'), ('REFUND_DUE', 'Refund due')], default='QUEUED', max_length=20),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0 on 2026-10-18 05:37
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0026_payment_verification_refund_due'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_free_agent_position_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='user',
+            name='user_free_agent_futsal_idx',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-18 05:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def stamp_active_holds(apps, schema_editor):
+    TimeSlot = apps.get_model('futsal', 'TimeSlot')
+    SlotHold = apps.get_model('futsal', 'SlotHold')
+    TimeSlot.objects.filter(hold__isnull=False).update(held_until=Subquery(
+        SlotHold.objects.filter(time_slot=OuterRef('pk')).values('created_at')[:1]
+    ) + settings.SLOT_HOLD_TTL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0027_free_agent_relevance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timeslot',
+            name='held_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(stamp_active_holds, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 6.0 on 2026-10-18 05:44
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('futsal', '0028_timeslot_held_until'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='user',
+            options={},
+        ),
+    ]
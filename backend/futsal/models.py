@@ -1,5 +1,8 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.utils import timezone
 
 # Custom User Model
@@ -31,6 +34,8 @@ class User(AbstractUser):
     is_blocked = models.BooleanField(default=False)
     futsal = models.ForeignKey('Futsal', on_delete=models.SET_NULL, null=True, blank=True)
     profile_picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True)
+    # Resized copies made by futsal.images
+    profile_picture_variants = models.JSONField(default=dict, blank=True)
     date_of_birth = models.DateField(null=True, blank=True)
     gender = models.CharField(max_length=10, choices=GENDER_CHOICES, blank=True, null=True)
     full_name = models.CharField(max_length=255, blank=True, null=True)
@@ -44,15 +49,25 @@ class User(AbstractUser):
     
     def __str__(self):
         return self.username
+
+    class Meta:
+        indexes = [
+            # Matchmaking only ever reads free agents, a small share of all users
+            models.Index(
+                fields=['-matches_played', 'id'],
+                condition=models.Q(is_looking_for_team=True),
+                name='user_free_agent_idx',
+            ),
+        ]
     
     # ADD THIS METHOD
     def is_eligible_for_reward(self):
         """Check if user is eligible for a free booking"""
-        return self.bookings_since_reward >= 7
+        return self.bookings_since_reward >= settings.LOYALTY_REWARD_AFTER
     
     def get_reward_progress(self):
         """Get progress towards next reward (e.g., 5/7)"""
-        return min(self.bookings_since_reward, 7)
+        return min(self.bookings_since_reward, settings.LOYALTY_REWARD_AFTER)
 
 # Futsal Venue
 class Futsal(models.Model):
@@ -61,9 +76,17 @@ class Futsal(models.Model):
     description = models.TextField(blank=True)
     contact = models.CharField(max_length=15)
     image = models.ImageField(upload_to='futsals/', null=True, blank=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Bounding-box prefilter of nearby searches
+            models.Index(fields=['latitude', 'longitude'], name='futsal_lat_lng_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -86,14 +109,78 @@ class TimeSlot(models.Model):
     start_time = models.TimeField()
     end_time = models.TimeField()
     is_booked = models.BooleanField(default=False)
+    # End of the active checkout hold, on the row so a booking claim rechecks it under lock
+    held_until = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         unique_together = ('ground', 'date', 'start_time')
+        indexes = [
+            # Keyset pagination of /timeslots/
+            models.Index(fields=['date', 'start_time', 'id'], name='timeslot_date_start_id_idx'),
+        ]
 
     def __str__(self):
         return f"{self.ground} - {self.date} {self.start_time}-{self.end_time}"
 
 
+# Weekly opening hours of a ground; slots are generated from these on the fly
+class GroundSchedule(models.Model):
+    WEEKDAY_CHOICES = [
+        (0, 'Monday'),
+        (1, 'Tuesday'),
+        (2, 'Wednesday'),
+        (3, 'Thursday'),
+        (4, 'Friday'),
+        (5, 'Saturday'),
+        (6, 'Sunday'),
+    ]
+
+    ground = models.ForeignKey(Ground, on_delete=models.CASCADE, related_name='schedules')
+    weekday = models.IntegerField(choices=WEEKDAY_CHOICES)
+    open_time = models.TimeField()
+    close_time = models.TimeField()  # 00:00 means midnight
+
+    class Meta:
+        unique_together = ('ground', 'weekday', 'open_time')
+        ordering = ['ground', 'weekday', 'open_time']
+
+    def __str__(self):
+        return f"{self.ground} - {self.get_weekday_display()} {self.open_time}-{self.close_time}"
+
+
+# Replaces the weekly hours of a ground on one date
+class ScheduleException(models.Model):
+    ground = models.ForeignKey(Ground, on_delete=models.CASCADE, related_name='schedule_exceptions')
+    date = models.DateField()
+    open_time = models.TimeField(null=True, blank=True)  # leave both empty to close for the day
+    close_time = models.TimeField(null=True, blank=True)
+    note = models.CharField(max_length=200, blank=True)
+
+    class Meta:
+        unique_together = ('ground', 'date', 'open_time')
+
+    def __str__(self):
+        if self.open_time and self.close_time:
+            return f"{self.ground} - {self.date} {self.open_time}-{self.close_time}"
+        return f"{self.ground} - {self.date} closed"
+
+
+# Availability index: one row per ground and date, one bit per hourly slot
+class GroundAvailability(models.Model):
+    ground = models.ForeignKey(Ground, on_delete=models.CASCADE, related_name='availability')
+    date = models.DateField()
+    open_mask = models.IntegerField(default=0)  # bit n set -> a slot starts at n:00
+    booked_mask = models.IntegerField(default=0)  # bit n set -> that slot is booked
+    slot_ids = models.JSONField(default=dict)  # {"n": TimeSlot id}
+    version = models.PositiveBigIntegerField(default=0)  # grows on every change, never reused
+
+    class Meta:
+        unique_together = ('ground', 'date')
+
+    def __str__(self):
+        return f"{self.ground_id} - {self.date}"
+
+
 # Team
 class Team(models.Model):
     name = models.CharField(max_length=100)
@@ -144,6 +231,19 @@ class Booking(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        constraints = [
+            # At most one confirmed booking per slot, enforced by the database
+            models.UniqueConstraint(
+                fields=['time_slot'],
+                condition=models.Q(status='CONFIRMED'),
+                name='unique_confirmed_booking_per_slot',
+            ),
+        ]
+        indexes = [
+            # Keyset pagination of /bookings/, per user and for staff
+            models.Index(fields=['user', '-created_at', 'id'], name='booking_user_created_id_idx'),
+            models.Index(fields=['-created_at', 'id'], name='booking_created_id_idx'),
+        ]
 # Tournament
 class Tournament(models.Model):
     name = models.CharField(max_length=200)
@@ -173,10 +273,40 @@ class Fixture(models.Model):
     team2_score = models.IntegerField(null=True, blank=True)
     winner = models.ForeignKey(Team, on_delete=models.SET_NULL, null=True, blank=True, related_name='won_fixtures')
     is_completed = models.BooleanField(default=False)
+    round = models.PositiveSmallIntegerField(default=1)
 
     def __str__(self):
         return f"{self.tournament.name}: {self.team1.name} vs {self.team2.name}"
 
+    class Meta:
+        indexes = [
+            # The scheduler looks up fixtures already on a ground for a date range
+            models.Index(fields=['ground', 'match_date'], name='fixture_ground_date_idx'),
+        ]
+
+
+# Tournament table, maintained by futsal.standings
+class Standing(models.Model):
+    tournament = models.ForeignKey(Tournament, on_delete=models.CASCADE, related_name='standings')
+    team = models.ForeignKey(Team, on_delete=models.CASCADE, related_name='standings')
+    played = models.IntegerField(default=0)
+    won = models.IntegerField(default=0)
+    drawn = models.IntegerField(default=0)
+    lost = models.IntegerField(default=0)
+    goals_for = models.IntegerField(default=0)
+    goals_against = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+    # {opponent_id: {"played", "points", "goals_for", "goals_against"}} for tie-breakers
+    head_to_head = models.JSONField(default=dict, blank=True)
+
+    def __str__(self):
+        return f"{self.tournament_id} - {self.team_id}: {self.points}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tournament', 'team'], name='unique_standing_per_team'),
+        ]
+
 
 # Community Post
 class Post(models.Model):
@@ -192,18 +322,36 @@ class Post(models.Model):
     title = models.CharField(max_length=200)
     content = models.TextField()
     image = models.ImageField(upload_to='posts/', null=True, blank=True)
+    # Resized copies made by futsal.images
+    image_variants = models.JSONField(default=dict, blank=True)
     likes = models.ManyToManyField(User, related_name='liked_posts', blank=True)
+    # Maintained by futsal.likes, repaired by reconcile_like_counts
+    likes_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Kept up to date by PostgreSQL on every write, titles weigh more than content
+    search_vector = models.GeneratedField(
+        expression=(
+            SearchVector('title', weight='A', config='english')
+            + SearchVector('content', weight='B', config='english')
+        ),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            GinIndex(fields=['search_vector'], name='post_search_vector_idx'),
+            # Keyset pagination of /posts/
+            models.Index(fields=['-created_at', 'id'], name='post_created_id_idx'),
+        ]
 
     def __str__(self):
         return self.title
 
     def total_likes(self):
-        return self.likes.count()
+        return self.likes_count
 
 
 # Comment on Post
@@ -215,6 +363,10 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Latest comments of a post for the feed preview
+            models.Index(fields=['post', '-created_at'], name='comment_post_recent_idx'),
+        ]
 
     def __str__(self):
         return f"Comment by {self.author.username} on {self.post.title}"
@@ -227,7 +379,80 @@ class PendingBooking(models.Model):
     ground_id = models.IntegerField()
     pidx = models.CharField(max_length=200)
     total_amount = models.IntegerField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     
     class Meta:
-        db_table = 'pending_bookings'
\ No newline at end of file
+        db_table = 'pending_bookings'
+
+
+class PaymentVerification(models.Model):
+    """Khalti callback waiting for the payment worker to verify it"""
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('PROCESSING', 'Processing'),
+        ('CONFIRMED', 'Confirmed'),
+        ('FAILED', 'Failed'),
+        # Paid, but a slot was gone: final, the PendingBooking is kept for the refund
+        ('REFUND_DUE', 'Refund due'),
+    ]
+
+    booking_ref = models.CharField(max_length=100, unique=True)
+    pidx = models.CharField(max_length=200)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='QUEUED')
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    message = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # The worker only ever looks for due, queued jobs
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(status='QUEUED'),
+                name='payment_verification_due_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.booking_ref} - {self.status}"
+
+
+class SlotHold(models.Model):
+    """Keeps a slot out of availability while its checkout is being paid"""
+    time_slot = models.OneToOneField(TimeSlot, on_delete=models.CASCADE, related_name='hold')
+    booking_ref = models.CharField(max_length=100, db_index=True)
+    # Copied from the slot so availability reads never join TimeSlot
+    ground = models.ForeignKey(Ground, on_delete=models.CASCADE, related_name='slot_holds')
+    date = models.DateField()
+    start_time = models.TimeField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['ground', 'date'])]
+
+    def __str__(self):
+        return f"{self.booking_ref} - {self.time_slot_id}"
+
+
+class LoyaltyEntry(models.Model):
+    """Append-only record of a booking that earned or redeemed loyalty"""
+    KIND_CHOICES = [
+        ('EARNED', 'Paid booking'),
+        ('REDEEMED', 'Free booking'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='loyalty_entries')
+    # Unique, so a booking can never be counted twice
+    booking = models.OneToOneField(
+        Booking, on_delete=models.SET_NULL, null=True, blank=True, related_name='loyalty_entry'
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', '-created_at'], name='loyalty_user_created_idx')]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.kind}"
@@ -0,0 +1,122 @@
+"""Opponent finder: teams to play and the slots both sides can make.
+
+Availability is reduced to one bitmask per day, with bit n set for the slot
+starting at n:00 as in the availability index. Checking an opponent is
+then a few integer ANDs per day, not a comparison of slot lists:
+
+- one query ORs the hour bits of the confirmed bookings of every rostered
+  player, per player and day (``BIT_OR`` in PostgreSQL);
+- one query (``availability.ground_days``) gives the free ground hours;
+- a team is busy whenever any of its players is, and the options against
+  an opponent are the free ground hours outside both teams' busy hours.
+"""
+from collections import defaultdict
+
+from django.contrib.postgres.aggregates import BitOr
+from django.db.models import F, Func, IntegerField
+from django.db.models.functions import Abs
+from django.utils import timezone
+
+from . import availability
+from .models import Booking, Team
+
+
+class HourBit(Func):
+    """The availability bit of a slot starting at a time column's hour"""
+    template = '(1 << EXTRACT(HOUR FROM %(expressions)s)::integer)'
+    output_field = IntegerField()
+
+
+def rosters(team_ids):
+    """{team_id: {user_id}} of members and captain"""
+    players = defaultdict(set)
+    for team_id, user_id in Team.members.through.objects.filter(team_id__in=team_ids).values_list(
+        'team_id', 'user_id'
+    ):
+        players[team_id].add(user_id)
+    for team_id, captain_id in Team.objects.filter(id__in=team_ids).values_list('id', 'captain_id'):
+        players[team_id].add(captain_id)
+    return players
+
+
+def busy_hours(players, start, end):
+    """{team_id: {date: mask}} of the hours a player of each team has booked"""
+    by_player = defaultdict(dict)
+    for user_id, day, mask in (
+        Booking.objects.filter(
+            user_id__in={user_id for team in players.values() for user_id in team},
+            status='CONFIRMED',
+            time_slot__date__range=(start, end),
+        )
+        .values('user_id', 'time_slot__date')
+        .annotate(mask=BitOr(HourBit('time_slot__start_time')))
+        .order_by()
+        .values_list('user_id', 'time_slot__date', 'mask')
+    ):
+        by_player[user_id][day] = mask
+
+    busy = {}
+    for team_id, team in players.items():
+        days = defaultdict(int)
+        for user_id in team:
+            for day, mask in by_player.get(user_id, {}).items():
+                days[day] |= mask
+        busy[team_id] = days
+    return busy
+
+
+def free_ground_hours(grounds, start, end):
+    """({date: mask}, {(date, hour): [ground]}) of the open, unbooked hours still ahead"""
+    now = timezone.localtime()
+    masks = defaultdict(int)
+    grounds_at = defaultdict(list)
+    for ground, days in availability.ground_days(grounds, start, end):
+        for day, (open_mask, booked_mask, slot_ids) in days.items():
+            free = open_mask & ~booked_mask
+            if day == now.date():
+                free &= ~((2 << now.hour) - 1)
+            masks[day] |= free
+            for hour in availability.hours_in(free):
+                grounds_at[(day, hour)].append((ground, slot_ids))
+    return masks, grounds_at
+
+
+def find(team, grounds, start, end, candidates=300, limit=10, per_opponent=5):
+    """Opponents for ``team``, closest in matches played first, each with its earliest common slots
+
+    Only the ``candidates`` teams closest in ``matches_count`` are checked.
+    Returns ``[(opponent, [option])]`` for up to ``limit`` opponents that
+    have at least one option.
+    """
+    opponents = list(
+        Team.objects.filter(is_active=True).exclude(id=team.id)
+        .annotate(gap=Abs(F('matches_count') - team.matches_count))
+        .order_by('gap', 'id')
+        .only('id', 'name', 'matches_count')[:candidates]
+    )
+    players = rosters([team.id] + [opponent.id for opponent in opponents])
+    busy = busy_hours(players, start, end)
+    free, grounds_at = free_ground_hours(grounds, start, end)
+    days = sorted(free)
+
+    found = []
+    mine = busy[team.id]
+    for opponent in opponents:
+        # Somebody on both rosters cannot play against themselves
+        if players[opponent.id] & players[team.id]:
+            continue
+        theirs = busy.get(opponent.id, {})
+        options = []
+        for day in days:
+            for hour in availability.hours_in(free[day] & ~(mine.get(day, 0) | theirs.get(day, 0))):
+                ground, slot_ids = grounds_at[(day, hour)][0]
+                options.append(availability.slot_data(ground, day, hour, False, slot_ids))
+                if len(options) == per_opponent:
+                    break
+            if len(options) == per_opponent:
+                break
+        if options:
+            found.append((opponent, options))
+            if len(found) == limit:
+                break
+    return found
@@ -0,0 +1,152 @@
+"""Keyset pagination for infinite scroll.
+
+Page numbers cost a ``COUNT(*)`` per page and an ``OFFSET`` that grows with
+every page. Clients that send ``?cursor=`` (empty for the first page) get
+keyset pages instead: the cursor carries the ordering values of the last
+row, and the next page starts right after it on a composite index, so
+page 1000 costs the same as page 1. Requests without ``cursor`` keep the
+page number responses.
+
+Keyset pages always use the paginator's ordering, e.g. post search results
+come newest first rather than by rank.
+"""
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Forward-only pages ordered by ``ordering``, whose last field must be unique"""
+    ordering = ('-created_at', 'id')
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request, queryset.model)
+        if position is not None:
+            queryset = queryset.filter(self.after(position))
+
+        rows = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = [
+                getattr(rows[-1], name.lstrip('-')) for name in self.ordering
+            ]
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def after(self, position):
+        """Rows strictly after ``position`` in ``ordering``
+
+        The range on the first field is implied by the OR below, spelling it
+        out lets PostgreSQL start the index scan at the cursor.
+        """
+        first, value = self.ordering[0], position[0]
+        bound = Q(**{f"{first.lstrip('-')}__{'lte' if first.startswith('-') else 'gte'}": value})
+
+        after = Q()
+        for i, name in enumerate(self.ordering):
+            step = Q(**{other.lstrip('-'): position[j] for j, other in enumerate(self.ordering[:i])})
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            after |= step & Q(**{f"{name.lstrip('-')}__{lookup}": position[i]})
+        return bound & after
+
+    def encode_cursor(self, position):
+        raw = json.dumps([value.isoformat() if hasattr(value, 'isoformat') else value for value in position])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self, request, model):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if not isinstance(raw, list) or len(raw) != len(self.ordering):
+                raise ValueError
+            return [
+                self.field_value(model, name.lstrip('-'), value)
+                for name, value in zip(self.ordering, raw)
+            ]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def field_value(self, model, name, value):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # An annotation, kept as the JSON number it was encoded as
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError(name)
+            return value
+        return field.to_python(value)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class SlotKeysetPagination(KeysetPagination):
+    ordering = ('date', 'start_time', 'id')
+
+
+class FreeAgentPagination(KeysetPagination):
+    # Best match for the filters first, then the most experienced
+    ordering = ('-relevance', '-matches_played', 'id')
+
+
+class OptionalKeysetPagination(PageNumberPagination):
+    """Page numbers by default, keyset pages when the request carries ``cursor``"""
+    keyset_class = KeysetPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # Lists built in Python (e.g. slots from the availability index) stay on page numbers
+        self.keyset = None
+        if self.keyset_class.cursor_query_param in request.query_params and isinstance(queryset, QuerySet):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class OptionalSlotKeysetPagination(OptionalKeysetPagination):
+    keyset_class = SlotKeysetPagination
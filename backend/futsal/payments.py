@@ -0,0 +1,196 @@
+"""Turning paid checkouts into bookings.
+
+Khalti callbacks are only recorded as PaymentVerification jobs. The
+``run_payment_worker`` command claims due jobs, looks the payment up and
+creates the bookings, retrying with backoff while Khalti is unreachable or
+the payment is still pending.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import availability, holds, khalti, loyalty
+from .models import Booking, PaymentVerification, PendingBooking, SlotHold, TimeSlot
+
+# Lookup statuses after which the payment can still complete
+PENDING_STATUSES = {'Pending', 'Initiated'}
+UNBOOKABLE = 'Payment received but a slot is no longer available, it will be refunded'
+
+
+class SlotsUnavailable(Exception):
+    """A slot of the cart was booked by somebody else in the meantime"""
+
+
+class AlreadyConfirmed(Exception):
+    """The pending booking was confirmed (or discarded) by another request"""
+
+
+def confirm_pending_booking(pending, transaction_id):
+    """Create the bookings of a paid PendingBooking
+
+    Runs in one transaction with a fixed number of queries however many
+    slots are in the cart: one delete to claim the pending row, one locked
+    fetch of the slots, a check for foreign holds, one bulk insert, one bulk
+    update, the loyalty ledger and the release of the cart's holds.
+    """
+    with transaction.atomic():
+        # Deleting first claims the row, a concurrent callback deletes nothing
+        deleted, _ = PendingBooking.objects.filter(id=pending.id).delete()
+        if not deleted:
+            raise AlreadyConfirmed(pending.booking_ref)
+
+        slots = list(
+            TimeSlot.objects.select_for_update()
+            .filter(id__in=pending.time_slot_ids)
+            .only('id', 'ground_id', 'date', 'start_time', 'is_booked')
+        )
+        if len(slots) != len(set(pending.time_slot_ids)) or any(slot.is_booked for slot in slots):
+            raise SlotsUnavailable(pending.booking_ref)
+        # Our hold may have lapsed and been taken over by another checkout
+        if SlotHold.objects.filter(
+            time_slot__in=slots, created_at__gte=holds.hold_cutoff()
+        ).exclude(booking_ref=pending.booking_ref).exists():
+            raise SlotsUnavailable(pending.booking_ref)
+
+        bookings = Booking.objects.bulk_create([
+            Booking(
+                user_id=pending.user_id,
+                time_slot=slot,
+                ground_id=slot.ground_id,
+                amount_paid=pending.total_amount / 100,
+                payment_status='PAID',
+                status='CONFIRMED',
+                notes=f'Khalti Payment - {transaction_id}',
+            )
+            for slot in slots
+        ])
+        TimeSlot.objects.filter(id__in=[slot.id for slot in slots]).update(is_booked=True)
+        # Paid through Khalti, so every slot counts towards the next free booking
+        loyalty.record(bookings)
+        # The booked event below supersedes the hold, no point announcing the release
+        holds.release(pending.booking_ref, notify=False)
+
+    availability.mark_booked(*slots)
+    return bookings
+
+
+def claim_verifications(limit):
+    """Mark up to ``limit`` due jobs as PROCESSING and return them
+
+    ``skip_locked`` lets several workers poll the queue without blocking or
+    picking up the same job.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            PaymentVerification.objects.select_for_update(skip_locked=True)
+            .filter(status='QUEUED', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:limit]
+        )
+        PaymentVerification.objects.filter(id__in=[job.id for job in jobs]).update(
+            status='PROCESSING', attempts=F('attempts') + 1, updated_at=now
+        )
+    return jobs
+
+
+def requeue_stale(older_than):
+    """Give jobs of a worker that died mid-way back to the queue"""
+    return PaymentVerification.objects.filter(
+        status='PROCESSING', updated_at__lt=timezone.now() - older_than
+    ).update(status='QUEUED')
+
+
+def _finish(job, status, message=''):
+    # The reconciler may have settled the payment while we were at it
+    finished = PaymentVerification.objects.filter(id=job.id, status='PROCESSING').update(
+        status=status, message=message[:255], updated_at=timezone.now()
+    )
+    if finished and status in ('FAILED', 'REFUND_DUE'):
+        # Nobody is going to book these slots, hand them back
+        holds.release(job.booking_ref)
+
+
+def _retry(job, message):
+    attempts = job.attempts + 1
+    if attempts >= settings.PAYMENT_MAX_ATTEMPTS:
+        return _finish(job, 'FAILED', message)
+    delay = settings.PAYMENT_RETRY_DELAY * 2 ** (attempts - 1)
+    PaymentVerification.objects.filter(id=job.id, status='PROCESSING').update(
+        status='QUEUED',
+        message=message[:255],
+        next_attempt_at=timezone.now() + timedelta(seconds=delay),
+        updated_at=timezone.now(),
+    )
+
+
+def process_verification(job):
+    """Look a queued payment up and confirm or fail it"""
+    pending = PendingBooking.objects.filter(booking_ref=job.booking_ref).first()
+    if pending is None:
+        return _finish(job, 'FAILED', 'Booking data not found')
+
+    try:
+        # Always the pidx we initiated, never the one from the callback URL
+        status_code, payment_data = khalti.get_client().lookup(pending.pidx)
+    except khalti.KhaltiError as e:
+        return _retry(job, f'Gateway unavailable: {e}')
+
+    payment_status = payment_data.get('status')
+    if status_code == 200 and payment_status == 'Completed':
+        try:
+            confirm_pending_booking(pending, payment_data.get('transaction_id'))
+        except AlreadyConfirmed:
+            pass
+        except SlotsUnavailable:
+            return _finish(job, 'REFUND_DUE', UNBOOKABLE)
+        return _finish(job, 'CONFIRMED', 'Booking confirmed!')
+    if status_code >= 500 or payment_status in PENDING_STATUSES:
+        return _retry(job, f'Payment {payment_status or status_code}')
+    return _finish(job, 'FAILED', f'Payment verification failed: {payment_status or status_code}')
+
+
+def reconcile_pending(pending, status_code, payment_data, expire_before):
+    """Settle a stale PendingBooking from its lookup result
+
+    Returns ``'confirmed'``, ``'discarded'``, ``'unbookable'`` or ``'kept'``.
+    A payment that is still pending is kept until it was created before
+    ``expire_before``.
+    """
+    payment_status = payment_data.get('status')
+    if status_code == 200 and payment_status == 'Completed':
+        try:
+            confirm_pending_booking(pending, payment_data.get('transaction_id'))
+        except AlreadyConfirmed:
+            pass
+        except SlotsUnavailable:
+            # Paid but unbookable, settled for good so later runs leave it alone
+            # and the PendingBooking stays around for the refund
+            holds.release(pending.booking_ref)
+            _settle(pending, 'REFUND_DUE', UNBOOKABLE)
+            return 'unbookable'
+        _settle(pending, 'CONFIRMED', 'Booking confirmed!')
+        return 'confirmed'
+
+    if status_code >= 500:
+        return 'kept'
+    if payment_status in PENDING_STATUSES and pending.created_at >= expire_before:
+        return 'kept'
+
+    with transaction.atomic():
+        deleted, _ = PendingBooking.objects.filter(id=pending.id).delete()
+        if not deleted:
+            return 'kept'
+        holds.release(pending.booking_ref)
+    _settle(pending, 'FAILED', f'Payment verification failed: {payment_status or status_code}')
+    return 'discarded'
+
+
+def _settle(pending, status, message):
+    # The callback may never have come, the outcome is recorded all the same
+    PaymentVerification.objects.update_or_create(
+        booking_ref=pending.booking_ref,
+        defaults={'pidx': pending.pidx, 'status': status, 'message': message[:255]},
+    )
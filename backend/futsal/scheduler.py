@@ -0,0 +1,301 @@
+"""Tournament fixture generation.
+
+Pairings come from the circle method for round robin, or from a seeded
+bracket for knockout. A knockout bracket is generated one round at a time,
+because the next round depends on results.
+
+Matches are then packed into the free hourly slots of the chosen grounds by
+list scheduling. The slots are walked in time order. Each slot takes the
+most urgent matches that are ready:
+
+- both teams have played all their earlier rounds, and
+- both teams have rested since their last game.
+
+Urgency means the lowest round first, then the teams with the most games
+left. That is O(slots x teams) instead of a search over assignments, and
+every team always has a ready match until all are placed, so the walk never
+gets stuck.
+
+Every fixture books its slot like a booking would, so the hour drops out of
+public availability. Moving or deleting a fixture frees it again.
+"""
+from collections import defaultdict, deque
+from datetime import time
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import availability, holds, standings
+from .models import Booking, Fixture, TimeSlot, Tournament
+
+FORMATS = ('round_robin', 'knockout')
+
+
+class SchedulingError(Exception):
+    """The fixtures cannot be generated, or do not fit in the free slots"""
+
+
+def round_robin_pairs(team_ids):
+    """Rounds of (home, away) pairs in which every team meets every other once"""
+    teams = list(team_ids)
+    if len(teams) % 2:
+        # The team drawn against None sits the round out
+        teams.append(None)
+    rounds = []
+    for number in range(len(teams) - 1):
+        pairs = []
+        for i in range(len(teams) // 2):
+            home, away = teams[i], teams[-1 - i]
+            if home is None or away is None:
+                continue
+            # Swap sides every other round, or the fixed team would always be at home
+            pairs.append((away, home) if i == 0 and number % 2 else (home, away))
+        rounds.append(pairs)
+        # Rotate every team but the first one place
+        teams = [teams[0], teams[-1]] + teams[1:-1]
+    return rounds
+
+
+def knockout_pairs(team_ids):
+    """The first round of a bracket, best seeds first in ``team_ids``
+
+    The top seeds get a bye if the field is not a power of two, so that the
+    second round has exactly one.
+    """
+    teams = list(team_ids)
+    size = 1
+    while size < len(teams):
+        size *= 2
+    playing = teams[size - len(teams):]
+    return [(playing[i], playing[-1 - i]) for i in range(len(playing) // 2)]
+
+
+def free_slots(grounds, start, end, after):
+    """{(date, hour): [ground_id]} for the open, unbooked hours without a fixture, later than ``after``"""
+    taken = {
+        (ground_id, match_date, match_time.hour)
+        for ground_id, match_date, match_time in Fixture.objects.filter(
+            ground__in=grounds, match_date__range=(start, end)
+        ).values_list('ground_id', 'match_date', 'match_time')
+    }
+    slots = defaultdict(list)
+    for ground, days in availability.ground_days(grounds.only('id'), start, end):
+        for day, (open_mask, booked_mask, _) in days.items():
+            for hour in availability.hours_in(open_mask & ~booked_mask):
+                if (day, hour) > after and (ground.id, day, hour) not in taken:
+                    slots[(day, hour)].append(ground.id)
+    return slots
+
+
+def assign(rounds, slots, rest_hours=1, last_played=None):
+    """List-schedule the matches of ``rounds`` into ``slots``
+
+    ``rounds`` is a list of pair lists, ``slots`` as from ``free_slots``.
+    A team plays at most once every ``rest_hours + 1`` hours on a day,
+    counting from ``last_played`` ({team: (date, hour)}) for earlier games.
+    Returns ``(round_index, home, away, ground_id, date, hour)`` tuples, or
+    raises SchedulingError naming how many matches did not fit.
+    """
+    matches = [
+        (index, home, away)
+        for index, pairs in enumerate(rounds)
+        for home, away in pairs
+    ]
+    # Each team plays its matches in round order
+    queues = defaultdict(deque)
+    for number, (_, home, away) in enumerate(matches):
+        queues[home].append(number)
+        queues[away].append(number)
+    ready = {
+        number for number, (_, home, away) in enumerate(matches)
+        if queues[home][0] == number and queues[away][0] == number
+    }
+    last_played = dict(last_played or {})
+
+    def rested(team, day, hour):
+        last = last_played.get(team)
+        return last is None or last[0] != day or hour - last[1] > rest_hours
+
+    scheduled = []
+    for (day, hour), ground_ids in sorted(slots.items()):
+        if not ready:
+            break
+        candidates = sorted(
+            (
+                number for number in ready
+                if rested(matches[number][1], day, hour) and rested(matches[number][2], day, hour)
+            ),
+            key=lambda number: (
+                matches[number][0],
+                -(len(queues[matches[number][1]]) + len(queues[matches[number][2]])),
+                number,
+            ),
+        )
+        # A team heads at most one ready match, so nobody plays twice in this slot
+        for number, ground_id in zip(candidates, ground_ids):
+            index, home, away = matches[number]
+            scheduled.append((index, home, away, ground_id, day, hour))
+            ready.discard(number)
+            for team in (home, away):
+                queues[team].popleft()
+                last_played[team] = (day, hour)
+            for team in (home, away):
+                if queues[team]:
+                    following = queues[team][0]
+                    _, other_home, other_away = matches[following]
+                    if queues[other_home][0] == following and queues[other_away][0] == following:
+                        ready.add(following)
+
+    if len(scheduled) < len(matches):
+        raise SchedulingError(
+            f'{len(matches) - len(scheduled)} of {len(matches)} matches do not fit in the free '
+            f'slots of these grounds before the end of the tournament'
+        )
+    return scheduled
+
+
+def _slot_match(fixtures):
+    match = Q()
+    for fixture in fixtures:
+        match |= Q(ground_id=fixture.ground_id, date=fixture.match_date, start_time=time(fixture.match_time.hour))
+    return match
+
+
+def book_slots(fixtures):
+    """Book the slot of each fixture, creating the TimeSlot rows of schedule-driven grounds
+
+    Raises SchedulingError if a slot is closed, booked or held meanwhile.
+    Call it inside the transaction that writes the fixtures.
+    """
+    fixtures = [fixture for fixture in fixtures if fixture.ground_id]
+    if not fixtures:
+        return []
+    try:
+        slot_ids = set(availability.materialize_hours(
+            (fixture.ground_id, fixture.match_date, fixture.match_time.hour) for fixture in fixtures
+        ).values())
+    except ValueError as e:
+        raise SchedulingError(str(e))
+    booked = TimeSlot.objects.filter(holds.not_held(), id__in=slot_ids, is_booked=False).update(is_booked=True)
+    if booked != len(slot_ids):
+        raise SchedulingError('A slot was booked by somebody else meanwhile, try again')
+    slots = list(TimeSlot.objects.filter(id__in=slot_ids).only('ground_id', 'date', 'start_time'))
+    availability.mark_booked(*slots)
+    return slots
+
+
+def release_slots(fixtures):
+    """Free the slots booked for ``fixtures``, unless a booking or another fixture uses them"""
+    fixtures = [fixture for fixture in fixtures if fixture.ground_id]
+    if not fixtures:
+        return []
+    slots = TimeSlot.objects.filter(_slot_match(fixtures), is_booked=True).exclude(
+        id__in=Booking.objects.filter(status='CONFIRMED').values('time_slot_id')
+    )
+    others = set(
+        Fixture.objects.filter(
+            ground_id__in={fixture.ground_id for fixture in fixtures},
+            match_date__in={fixture.match_date for fixture in fixtures},
+        ).exclude(id__in=[fixture.id for fixture in fixtures if fixture.id]).values_list(
+            'ground_id', 'match_date', 'match_time__hour'
+        )
+    )
+    slots = [
+        slot for slot in slots.select_for_update().order_by('id')
+        if (slot.ground_id, slot.date, slot.start_time.hour) not in others
+    ]
+    TimeSlot.objects.filter(id__in=[slot.id for slot in slots]).update(is_booked=False)
+    availability.mark_free(*slots)
+    return slots
+
+
+def _seeds(tournament):
+    """Registered team ids in registration order"""
+    through = Tournament.registered_teams.through
+    return list(
+        through.objects.filter(tournament=tournament).order_by('id').values_list('team_id', flat=True)
+    )
+
+
+def _next_knockout_round(tournament, seeds):
+    """(round number, pairs) of the next knockout round, from the results of the last one"""
+    fixtures = list(tournament.fixtures.order_by('round', 'id'))
+    if not fixtures:
+        return 1, knockout_pairs(seeds)
+
+    last_round = fixtures[-1].round
+    current = [fixture for fixture in fixtures if fixture.round == last_round]
+    if any(not fixture.is_completed or fixture.winner_id is None for fixture in current):
+        raise SchedulingError(f'Round {last_round} needs a winner in every match first')
+
+    entrants = {fixture.winner_id for fixture in current}
+    if last_round == 1:
+        # Teams with a bye join in the second round
+        played = {team for fixture in current for team in (fixture.team1_id, fixture.team2_id)}
+        entrants |= set(seeds) - played
+    if len(entrants) < 2:
+        raise SchedulingError('The tournament already has a winner')
+    # Re-seed: the best remaining seed meets the worst
+    ordered = [team for team in seeds if team in entrants]
+    return last_round + 1, [(ordered[i], ordered[-1 - i]) for i in range(len(ordered) // 2)]
+
+
+def generate(tournament, format, grounds, rest_hours=1):
+    """Pair the registered teams of ``tournament`` and schedule the matches on ``grounds``
+
+    Round robin generates every match at once, knockout the next round.
+    All fixtures are written with one bulk insert and their slots booked in
+    the same transaction, nothing is written if they do not all fit.
+    """
+    if format not in FORMATS:
+        raise SchedulingError(f'Unknown format, use one of: {", ".join(FORMATS)}')
+
+    with transaction.atomic():
+        # One generation per tournament at a time
+        tournament = Tournament.objects.select_for_update().get(id=tournament.id)
+        seeds = _seeds(tournament)
+        if len(seeds) < 2:
+            raise SchedulingError('At least two teams have to be registered')
+
+        if format == 'round_robin':
+            if tournament.fixtures.exists():
+                raise SchedulingError('The tournament already has fixtures')
+            first_round, rounds = 1, round_robin_pairs(seeds)
+        else:
+            first_round, pairs = _next_knockout_round(tournament, seeds)
+            rounds = [pairs]
+
+        now = timezone.localtime()
+        after = (now.date(), now.hour)
+        # A new knockout round starts after the previous one, and its teams need their rest
+        last_played = {}
+        for fixture in tournament.fixtures.order_by('match_date', 'match_time'):
+            played = (fixture.match_date, fixture.match_time.hour)
+            after = max(after, played)
+            last_played[fixture.team1_id] = last_played[fixture.team2_id] = played
+        start = max(tournament.start_date, now.date())
+        if start > tournament.end_date:
+            raise SchedulingError('The tournament is already over')
+
+        # Every team shows in the table from the start, not only once it has a result
+        standings.ensure(tournament.id, seeds)
+        slots = free_slots(grounds, start, tournament.end_date, after)
+        scheduled = assign(rounds, slots, rest_hours, last_played)
+        fixtures = Fixture.objects.bulk_create(
+            [
+                Fixture(
+                    tournament=tournament,
+                    team1_id=home,
+                    team2_id=away,
+                    ground_id=ground_id,
+                    match_date=day,
+                    match_time=time(hour),
+                    round=first_round + index,
+                )
+                for index, home, away, ground_id, day, hour in scheduled
+            ],
+            batch_size=1000,
+        )
+        book_slots(fixtures)
+        return fixtures
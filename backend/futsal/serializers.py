@@ -1,11 +1,34 @@
-from rest_framework import serializers
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
 from .models import *
+from . import availability, holds, images, matchmaking
 
 User = get_user_model()
 
+class ImageVariantField(serializers.Field):
+    """URL of the ``size`` variant of an image, or all its variants without a size
+
+    Reads ``image_field`` and ``<image_field>_variants`` of the source object.
+    """
+    def __init__(self, image_field, size=None, **kwargs):
+        self.image_field = image_field
+        self.size = size
+        super().__init__(read_only=True, **kwargs)
+    
+    def to_representation(self, owner):
+        request = self.context.get('request')
+        source = getattr(owner, self.image_field)
+        variants = getattr(owner, f'{self.image_field}_variants')
+        if self.size is None:
+            return images.urls(request, source, variants)
+        return images.url(request, source, variants, self.size)
+
 class UserSerializer(serializers.ModelSerializer):
     profile_picture_url = serializers.SerializerMethodField()
+    profile_picture_variants = ImageVariantField('profile_picture', source='*')
     reward_progress = serializers.SerializerMethodField()  
     is_eligible_for_reward = serializers.SerializerMethodField() 
     class Meta:
@@ -22,6 +45,7 @@ class UserSerializer(serializers.ModelSerializer):
             'role',
             'profile_picture',
             'profile_picture_url',
+            'profile_picture_variants',
             'matches_played', 
             'is_looking_for_team',
             'total_bookings',  
@@ -35,6 +59,13 @@ class UserSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'matches_played', 'is_blocked', 'total_bookings', 
                             'bookings_since_reward', 'total_rewards_claimed']
     
+    def update(self, instance, validated_data):
+        # Only the fields sent, the counters may have moved since the user was loaded
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        instance.save(update_fields=list(validated_data))
+        return instance
+    
         #added this method to get full url of profile picture
     def get_profile_picture_url(self, obj):
         """Generate full URL for profile picture"""
@@ -47,13 +78,26 @@ class UserSerializer(serializers.ModelSerializer):
         """Returns progress like 5 out of 7"""
         return {
             'current': obj.get_reward_progress(),
-            'target': 7
+            'target': settings.LOYALTY_REWARD_AFTER
         }
     
     def get_is_eligible_for_reward(self, obj):
         """Returns True if user can claim free booking"""
         return obj.is_eligible_for_reward()
 
+class FreeAgentSerializer(serializers.ModelSerializer):
+    """The few profile fields matchmaking shows for each player"""
+    age = serializers.SerializerMethodField()
+    profile_picture_url = ImageVariantField('profile_picture', 'small', source='*')
+    
+    class Meta:
+        model = User
+        fields = ['id', 'username', 'full_name', 'preferred_position', 'gender', 'age',
+                  'futsal', 'matches_played', 'profile_picture_url']
+    
+    def get_age(self, obj):
+        return matchmaking.age(obj.date_of_birth)
+
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, min_length=6)
     
@@ -86,6 +130,25 @@ class GroundSerializer(serializers.ModelSerializer):
         model = Ground
         fields = '__all__'
 
+class TimeSlotField(serializers.PrimaryKeyRelatedField):
+    """Slot reference that also accepts virtual slot ids
+
+    A virtual id is validated here but stays an int, the serializer creates
+    its TimeSlot row in ``create()`` so a failed or dry validation writes
+    nothing.
+    """
+    def to_internal_value(self, data):
+        try:
+            slot_id = int(data)
+            if slot_id < 0:
+                _, day, _ = availability.parse_virtual_slot_id(slot_id)
+                if not availability.bookable_date(day):
+                    raise serializers.ValidationError('This time slot is outside the booking window.')
+                return slot_id
+        except (TypeError, ValueError):
+            self.fail('does_not_exist', pk_value=data)
+        return super().to_internal_value(data)
+
 class TimeSlotSerializer(serializers.ModelSerializer):
     ground_name = serializers.CharField(source='ground.name', read_only=True)
     
@@ -100,6 +163,11 @@ class FutsalSerializer(serializers.ModelSerializer):
         model = Futsal
         fields = '__all__'
 
+class NearbyFutsalSerializer(FutsalSerializer):
+    distance_km = serializers.FloatField(read_only=True)
+    # Only present when the search was limited to a date
+    free_slots = serializers.IntegerField(read_only=True)
+
 class TeamSerializer(serializers.ModelSerializer):
     captain_name = serializers.CharField(source='captain.username', read_only=True)
     member_count = serializers.IntegerField(read_only=True)  
@@ -122,10 +190,16 @@ class TeamSerializer(serializers.ModelSerializer):
             'captain': {'required': False}
         }
 
+class SlotAlreadyBooked(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = {'error': 'This time slot is already booked'}
+    default_code = 'slot_already_booked'
+
 class BookingSerializer(serializers.ModelSerializer):
     user_name = serializers.CharField(source='user.username', read_only=True)
     ground_name = serializers.CharField(source='ground.name', read_only=True)
     futsal_name = serializers.CharField(source='ground.futsal.name', read_only=True)
+    time_slot = TimeSlotField(queryset=TimeSlot.objects.all())
     time_slot_detail = TimeSlotSerializer(source='time_slot', read_only=True)
     
     class Meta:
@@ -135,14 +209,49 @@ class BookingSerializer(serializers.ModelSerializer):
                   'payment_status', 'amount_paid', 'is_reward_booking', 
                   'booking_date', 'notes']
         read_only_fields = ['id', 'booking_date']
+        # The slot claim in create() and the database constraint decide, answering 409
+        validators = []
     
     def create(self, validated_data):
-        booking = Booking.objects.create(**validated_data)
-        # Marking time slot as booked
-        time_slot = booking.time_slot
-        time_slot.is_booked = True
-        time_slot.save()
+        # The claim and the booking commit together, a crash in between
+        # cannot leave the slot booked without a booking
+        with transaction.atomic():
+            time_slot = validated_data['time_slot'] = self._materialize(validated_data['time_slot'])
+            
+            # One conditional UPDATE claims the slot. Racing a checkout that holds
+            # it, PostgreSQL rechecks the row after the hold commits and skips it
+            claimed = TimeSlot.objects.filter(holds.not_held(), id=time_slot.id, is_booked=False).update(
+                is_booked=True
+            )
+            if not claimed:
+                raise SlotAlreadyBooked()
+            
+            try:
+                with transaction.atomic():
+                    booking = Booking.objects.create(**validated_data)
+            except IntegrityError:
+                # Another CONFIRMED booking already holds this slot
+                raise SlotAlreadyBooked()
+            
+            time_slot.is_booked = True
+            availability.mark_booked(time_slot)
         return booking
+    
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            if 'time_slot' in validated_data:
+                validated_data['time_slot'] = self._materialize(validated_data['time_slot'])
+            return super().update(instance, validated_data)
+    
+    def _materialize(self, time_slot):
+        """The TimeSlot for a validated slot, creating the row of a virtual one"""
+        if isinstance(time_slot, TimeSlot):
+            return time_slot
+        try:
+            slot_id = availability.materialize([time_slot])[0]
+        except ValueError:
+            raise serializers.ValidationError({'time_slot': ['This time slot is not open.']})
+        return TimeSlot.objects.get(id=slot_id)
 
 class TournamentSerializer(serializers.ModelSerializer):
     registered_teams_count = serializers.SerializerMethodField()
@@ -164,9 +273,21 @@ class FixtureSerializer(serializers.ModelSerializer):
         model = Fixture
         fields = '__all__'
 
+class StandingSerializer(serializers.ModelSerializer):
+    team_name = serializers.CharField(source='team.name', read_only=True)
+    goal_difference = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Standing
+        fields = ['team', 'team_name', 'played', 'won', 'drawn', 'lost', 'goals_for',
+                  'goals_against', 'goal_difference', 'points']
+    
+    def get_goal_difference(self, obj):
+        return obj.goals_for - obj.goals_against
+
 class CommentSerializer(serializers.ModelSerializer):
     author_name = serializers.CharField(source='author.username', read_only=True)
-    author_picture = serializers.ImageField(source='author.profile_picture', read_only=True)
+    author_picture = ImageVariantField('profile_picture', 'small', source='author')
     
     class Meta:
         model = Comment
@@ -175,8 +296,9 @@ class CommentSerializer(serializers.ModelSerializer):
 
 class PostSerializer(serializers.ModelSerializer):
     author_name = serializers.CharField(source='author.username', read_only=True)
-    author_picture = serializers.ImageField(source='author.picture', read_only=True)
-    likes_count = serializers.SerializerMethodField()
+    author_picture = ImageVariantField('profile_picture', 'small', source='author')
+    image_variants = ImageVariantField('image', source='*')
+    likes_count = serializers.IntegerField(read_only=True)
     comments_count = serializers.SerializerMethodField()
     comments = CommentSerializer(many=True, read_only=True)
     is_liked = serializers.SerializerMethodField()
@@ -184,13 +306,10 @@ class PostSerializer(serializers.ModelSerializer):
     class Meta:
         model = Post
         fields = ['id', 'author', 'author_name', 'author_picture', 'post_type', 
-                  'title', 'content', 'image', 'likes_count', 'comments_count', 
+                  'title', 'content', 'image', 'image_variants', 'likes_count', 'comments_count', 
                   'comments', 'is_liked', 'created_at', 'updated_at']
         read_only_fields = ['id', 'author', 'created_at', 'updated_at']
     
-    def get_likes_count(self, obj):
-        return obj.total_likes()
-    
     def get_comments_count(self, obj):
         return obj.comments.count()
     
@@ -198,4 +317,24 @@ class PostSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.likes.filter(id=request.user.id).exists()
-        return False
\ No newline at end of file
+        return False
+
+
+class FeedPostSerializer(serializers.ModelSerializer):
+    """Read-only feed entry, counts and is_liked come from queryset annotations"""
+    author_name = serializers.CharField(source='author.username', read_only=True)
+    author_picture = ImageVariantField('profile_picture', 'small', source='author')
+    # Sized for a phone screen, image_variants has the others
+    image = ImageVariantField('image', 'medium', source='*')
+    image_variants = ImageVariantField('image', source='*')
+    likes_count = serializers.IntegerField(read_only=True)
+    comments_count = serializers.IntegerField(read_only=True)
+    is_liked = serializers.BooleanField(read_only=True)
+    latest_comments = CommentSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = Post
+        fields = ['id', 'author', 'author_name', 'author_picture', 'post_type',
+                  'title', 'content', 'image', 'image_variants', 'likes_count', 'comments_count',
+                  'latest_comments', 'is_liked', 'created_at', 'updated_at']
+        read_only_fields = fields
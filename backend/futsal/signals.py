@@ -0,0 +1,59 @@
+from django.db import connection, transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import catalog, images, standings
+from .models import Fixture, Futsal, Ground, Post, User
+
+
+@receiver([post_save, post_delete], sender=Futsal)
+@receiver([post_save, post_delete], sender=Ground)
+def invalidate_catalog(sender, **kwargs):
+    """Cached venue and ground responses are stale once a venue or ground changes"""
+    # After commit, or a request could cache the old rows under the new version
+    transaction.on_commit(catalog.invalidate)
+
+
+@receiver(pre_save, sender=Fixture)
+def remember_fixture_result(sender, instance, raw=False, **kwargs):
+    """Keep what the stored fixture counts in the standings, to take it back after the save"""
+    instance._standing_before = None
+    if raw or instance.pk is None:
+        return
+    stored = Fixture.objects.filter(pk=instance.pk)
+    if connection.in_atomic_block:
+        # Two edits of one fixture must not both take back the same old result
+        stored = stored.select_for_update()
+    stored = stored.only(
+        'tournament_id', 'team1_id', 'team2_id', 'team1_score', 'team2_score', 'is_completed'
+    ).first()
+    if stored is not None:
+        instance._standing_before = (stored.tournament_id, standings.result(stored))
+
+
+@receiver(post_save, sender=Fixture)
+def update_standings(sender, instance, raw=False, **kwargs):
+    """Move the standings from the fixture's old result to its new one"""
+    if raw:
+        return
+    before_tournament, before = getattr(instance, '_standing_before', None) or (instance.tournament_id, None)
+    after = standings.result(instance)
+    if before_tournament == instance.tournament_id:
+        standings.apply(instance.tournament_id, before, after)
+    else:
+        standings.apply(before_tournament, before, None)
+        standings.apply(instance.tournament_id, None, after)
+
+
+@receiver(post_delete, sender=Fixture)
+def remove_from_standings(sender, instance, **kwargs):
+    """A deleted fixture no longer counts"""
+    standings.apply(instance.tournament_id, standings.result(instance), None)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Post)
+def refresh_image_variants(sender, instance, raw=False, update_fields=None, **kwargs):
+    """New uploads get resized variants in the background"""
+    if not raw:
+        images.refresh(instance, update_fields)
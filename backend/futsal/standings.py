@@ -0,0 +1,165 @@
+"""Tournament standings, kept up to date one fixture at a time.
+
+A completed Fixture with both scores entered counts towards the Standing
+rows of its two teams. When a Fixture is saved or deleted, the signal
+handlers take back what its previous state counted and add what its new
+state counts. A result therefore costs two row updates however many
+fixtures the tournament has, and the standings endpoint reads only the
+Standing table.
+
+Queryset ``update()``/``delete()`` and ``bulk_create()`` send no signals.
+Run ``rebuild_standings`` after those.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+
+from .models import Fixture, Standing, Tournament
+
+POINTS_FOR_WIN = 3
+POINTS_FOR_DRAW = 1
+
+COUNTERS = ['played', 'won', 'drawn', 'lost', 'goals_for', 'goals_against', 'points']
+
+
+def result(fixture):
+    """(team1_id, team2_id, team1_score, team2_score) if ``fixture`` counts, else None"""
+    if fixture is None or not fixture.is_completed:
+        return None
+    if fixture.team1_score is None or fixture.team2_score is None:
+        return None
+    return fixture.team1_id, fixture.team2_id, fixture.team1_score, fixture.team2_score
+
+
+def _line(goals_for, goals_against):
+    """Counter changes for one team of one result"""
+    won, drawn = goals_for > goals_against, goals_for == goals_against
+    return {
+        'played': 1,
+        'won': int(won),
+        'drawn': int(drawn),
+        'lost': int(not won and not drawn),
+        'goals_for': goals_for,
+        'goals_against': goals_against,
+        'points': POINTS_FOR_WIN if won else POINTS_FOR_DRAW if drawn else 0,
+    }
+
+
+def _sides(counted):
+    team1, team2, score1, score2 = counted
+    return ((team1, team2, _line(score1, score2)), (team2, team1, _line(score2, score1)))
+
+
+def ensure(tournament_id, team_ids):
+    """Create empty rows for teams that have none yet"""
+    Standing.objects.bulk_create(
+        [Standing(tournament_id=tournament_id, team_id=team_id) for team_id in team_ids],
+        ignore_conflicts=True,
+    )
+
+
+def apply(tournament_id, before, after):
+    """Swap the result ``before`` for ``after`` (either may be None) in the table"""
+    if before == after:
+        return
+    changes = defaultdict(lambda: defaultdict(int))
+    head_to_head = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    for counted, sign in ((before, -1), (after, 1)):
+        if counted is None:
+            continue
+        for team, opponent, line in _sides(counted):
+            for name, value in line.items():
+                changes[team][name] += sign * value
+                if name in ('played', 'points', 'goals_for', 'goals_against'):
+                    head_to_head[team][str(opponent)][name] += sign * value
+
+    with transaction.atomic():
+        _lock(tournament_id)
+        if after is not None:
+            # Not for deletes, which may be cascading from the tournament or a team
+            ensure(tournament_id, after[:2])
+        for row in Standing.objects.filter(tournament_id=tournament_id, team_id__in=changes):
+            for name, value in changes[row.team_id].items():
+                setattr(row, name, getattr(row, name) + value)
+            for opponent, values in head_to_head[row.team_id].items():
+                record = row.head_to_head.get(opponent, {})
+                for name, value in values.items():
+                    record[name] = record.get(name, 0) + value
+                if record.get('played'):
+                    row.head_to_head[opponent] = record
+                else:
+                    row.head_to_head.pop(opponent, None)
+            row.save(update_fields=COUNTERS + ['head_to_head'])
+
+
+def _lock(tournament_id):
+    """Serialize changes to the table of one tournament until the transaction ends"""
+    list(Tournament.objects.select_for_update().filter(id=tournament_id).values_list('id'))
+
+
+def rebuild(tournament):
+    """Recompute every row of ``tournament`` from its fixtures"""
+    with transaction.atomic():
+        _lock(tournament.id)
+        rows = _tally(tournament)
+        Standing.objects.filter(tournament=tournament).delete()
+        Standing.objects.bulk_create(rows)
+    return len(rows)
+
+
+def _tally(tournament):
+    """Unsaved Standing rows for ``tournament`` computed from its fixtures"""
+    rows = {}
+
+    def row(team_id):
+        if team_id not in rows:
+            rows[team_id] = Standing(tournament=tournament, team_id=team_id, head_to_head={})
+        return rows[team_id]
+
+    for team_id in tournament.registered_teams.values_list('id', flat=True):
+        row(team_id)
+    for fixture in Fixture.objects.filter(tournament=tournament).only(
+        'team1_id', 'team2_id', 'team1_score', 'team2_score', 'is_completed'
+    ):
+        counted = result(fixture)
+        if counted is None:
+            continue
+        for team, opponent, line in _sides(counted):
+            standing = row(team)
+            for name, value in line.items():
+                setattr(standing, name, getattr(standing, name) + value)
+            record = standing.head_to_head.setdefault(str(opponent), {})
+            for name in ('played', 'points', 'goals_for', 'goals_against'):
+                record[name] = record.get(name, 0) + line[name]
+    return list(rows.values())
+
+
+def ordered(rows):
+    """Rows in table order
+
+    Points first, then among teams level on points: head-to-head points,
+    head-to-head goal difference, goal difference, goals scored.
+    """
+    tied = defaultdict(set)
+    for standing in rows:
+        tied[standing.points].add(str(standing.team_id))
+
+    def mini_league(standing):
+        # Only games against the other teams on the same points count
+        points = goal_difference = 0
+        for opponent, record in standing.head_to_head.items():
+            if opponent in tied[standing.points]:
+                points += record['points']
+                goal_difference += record['goals_for'] - record['goals_against']
+        return points, goal_difference
+
+    def key(standing):
+        return (
+            -standing.points,
+            *(-value for value in mini_league(standing)),
+            -(standing.goals_for - standing.goals_against),
+            -standing.goals_for,
+            standing.team_id,
+        )
+
+    return sorted(rows, key=key)
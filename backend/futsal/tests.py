@@ -1,3 +1,1667 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import os
+import shutil
+import socket
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, StringIO
+from datetime import date, time, timedelta
+from threading import Barrier, Thread
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
+from asgiref.sync import async_to_sync, sync_to_async
 
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.db.models import Count
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches
+from django.utils import timezone
+from PIL import Image
+from rest_framework.test import APIClient
+
+from . import (
+    availability, catalog, geo, holds, images, khalti, likes, live, loyalty, matchmaking, media, payments,
+    scheduler, standings,
+)
+from .models import (
+    Booking, Comment, Fixture, Futsal, Ground, GroundAvailability, GroundSchedule, PaymentVerification,
+    PendingBooking, Post, SlotHold, Standing, Team, TimeSlot, Tournament, User,
+)
+from .khalti_stub import KhaltiStub
+from .serializers import BookingSerializer, SlotAlreadyBooked, TimeSlotSerializer
+
+
+def make_ground(hours):
+    """A ground with an indexed slot at each of ``hours`` tomorrow"""
+    futsal = Futsal.objects.create(name='Test Futsal', location='Test', contact='9800000000')
+    ground = Ground.objects.create(futsal=futsal, name='Test Ground', price_per_hour=1000)
+    day = timezone.localdate() + timedelta(days=1)
+    slots = TimeSlot.objects.bulk_create(
+        TimeSlot(ground=ground, date=day, start_time=time(hour), end_time=time(hour + 1)) for hour in hours
+    )
+    availability.rebuild([ground.id], [day])
+    return ground, slots
+
+
+class AvailabilityIndexTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground(range(6, 12))
+        self.other, _ = make_ground(range(6, 12))
+        self.day = timezone.localdate() + timedelta(days=1)
+        TimeSlot.objects.filter(id__in=[self.slots[0].id, self.slots[3].id]).update(is_booked=True)
+        availability.rebuild([self.ground.id], [self.day])
+
+    def test_lookup_matches_timeslot(self):
+        expected = TimeSlotSerializer(
+            TimeSlot.objects.filter(ground=self.ground, date=self.day, is_booked=False).order_by('start_time'),
+            many=True,
+        ).data
+        with self.assertNumQueries(1):
+            found = availability.slots_for(self.day, futsal=self.ground.futsal)
+        fields = ('id', 'ground', 'date', 'start_time', 'end_time', 'is_booked')
+        self.assertEqual(
+            [{field: slot[field] for field in fields} for slot in found],
+            [{field: slot[field] for field in fields} for slot in expected],
+        )
+
+    def test_mark_moves_the_bit_and_version(self):
+        row = GroundAvailability.objects.get(ground=self.ground)
+        slot = self.slots[1]
+        availability.mark_booked(slot)
+        booked = GroundAvailability.objects.get(id=row.id)
+        self.assertEqual(booked.booked_mask, row.booked_mask | 1 << 7)
+        self.assertGreater(booked.version, row.version)
+        availability.mark_free(slot)
+        self.assertEqual(GroundAvailability.objects.get(id=row.id).booked_mask, row.booked_mask)
+
+    def test_targeted_rebuild_leaves_other_rows_alone(self):
+        untouched = GroundAvailability.objects.get(ground=self.other)
+        TimeSlot.objects.filter(id=self.slots[-1].id).delete()
+        availability.rebuild([self.ground.id], [self.day])
+        open_mask = GroundAvailability.objects.get(ground=self.ground).open_mask
+        self.assertEqual(open_mask, sum(1 << hour for hour in range(6, 11)))
+        self.assertEqual(GroundAvailability.objects.get(id=untouched.id).version, untouched.version)
+
+        # A day that lost every slot loses its row
+        TimeSlot.objects.filter(ground=self.ground).delete()
+        availability.rebuild([self.ground.id], [self.day])
+        self.assertFalse(GroundAvailability.objects.filter(ground=self.ground).exists())
+
+
+class CreateTimeslotsTests(TransactionTestCase):
+    def setUp(self):
+        futsal = Futsal.objects.create(name='Test Futsal', location='Test', contact='9800000000')
+        self.ground = Ground.objects.create(futsal=futsal, name='Test Ground', price_per_hour=1000)
+
+    def run_command(self, *args):
+        call_command('create_timeslots', *args, stdout=StringIO())
+
+    def test_invalid_options_are_refused(self):
+        for args in (['--days', '0'], ['--open', '-1'], ['--open', '20', '--close', '20'], ['--close', '25']):
+            with self.subTest(args=args), self.assertRaises(CommandError):
+                self.run_command(*args)
+        self.assertFalse(TimeSlot.objects.exists())
+
+    def test_fills_the_window_once_and_prunes_the_past(self):
+        today = timezone.localdate()
+        past = TimeSlot.objects.create(ground=self.ground, date=today - timedelta(days=1),
+                                       start_time=time(6), end_time=time(7))
+        self.run_command('--days', '3', '--open', '22', '--close', '24')
+        slots = TimeSlot.objects.filter(ground=self.ground).order_by('date', 'start_time')
+        self.assertEqual(
+            [(slot.date, slot.start_time, slot.end_time) for slot in slots],
+            [
+                (today + timedelta(days=day), time(hour), time((hour + 1) % 24))
+                for day in range(3) for hour in (22, 23)
+            ],
+        )
+        self.assertFalse(TimeSlot.objects.filter(id=past.id).exists())
+        self.assertEqual(
+            set(GroundAvailability.objects.values_list('date', 'open_mask')),
+            {(today + timedelta(days=day), 1 << 22 | 1 << 23) for day in range(3)},
+        )
+
+        self.run_command('--days', '3', '--open', '22', '--close', '24')
+        self.assertEqual(TimeSlot.objects.count(), 6)
+
+        # Grounds with a weekly schedule are left alone
+        GroundSchedule.objects.create(ground=self.ground, weekday=0, open_time=time(6), close_time=time(22))
+        self.run_command('--days', '5')
+        self.assertEqual(TimeSlot.objects.count(), 6)
+
+
+class CalendarTests(TestCase):
+    def setUp(self):
+        self.slotted, self.slots = make_ground([18, 19])
+        self.futsal = self.slotted.futsal
+        self.scheduled = Ground.objects.create(futsal=self.futsal, name='Scheduled Ground', price_per_hour=1500)
+        self.day = self.slots[0].date
+        for offset in range(3):
+            weekday = (self.day + timedelta(days=offset)).weekday()
+            GroundSchedule.objects.create(ground=self.scheduled, weekday=weekday,
+                                          open_time=time(20), close_time=time(22))
+        TimeSlot.objects.filter(id=self.slots[1].id).update(is_booked=True)
+        availability.rebuild([self.slotted.id], [self.day])
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='player', password='x'))
+
+    def calendar(self, start, end):
+        return self.client.get(f'/api/futsals/{self.futsal.id}/calendar/', {'start': start, 'end': end})
+
+    def test_every_ground_and_day_in_one_response(self):
+        end = self.day + timedelta(days=2)
+        response = self.calendar(self.day, end)
+        self.assertEqual(response.status_code, 200)
+        grounds = {ground['id']: ground['days'] for ground in response.json()['grounds']}
+        self.assertEqual(grounds[self.slotted.id], {
+            self.day.isoformat(): {'free': {'18': self.slots[0].id}, 'booked': [19]},
+        })
+        self.assertEqual(set(grounds[self.scheduled.id]), {
+            (self.day + timedelta(days=offset)).isoformat() for offset in range(3)
+        })
+        self.assertEqual(grounds[self.scheduled.id][self.day.isoformat()], {
+            'free': {
+                str(hour): availability.virtual_slot_id(self.scheduled.id, self.day, hour) for hour in (20, 21)
+            },
+            'booked': [],
+        })
+
+    def test_query_count_does_not_grow_with_the_range(self):
+        with CaptureQueriesContext(connections['default']) as short:
+            self.calendar(self.day, self.day)
+        with self.assertNumQueries(len(short)):
+            self.calendar(self.day, self.day + timedelta(days=30))
+
+    def test_range_is_validated(self):
+        self.assertEqual(self.calendar(self.day, self.day - timedelta(days=1)).status_code, 400)
+        self.assertEqual(self.calendar(self.day, self.day + timedelta(days=31)).status_code, 400)
+        self.assertEqual(self.calendar('tomorrow', self.day).status_code, 400)
+
+
+class ConditionalAvailabilityTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground([18, 19])
+        self.futsal = self.ground.futsal
+        self.day = self.slots[0].date
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def slots_response(self, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get(f'/api/futsals/{self.futsal.id}/available_slots/', {'date': self.day}, **headers)
+
+    def test_unchanged_availability_is_not_sent_again(self):
+        first = self.slots_response()
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+        self.assertEqual(self.slots_response(etag).status_code, 304)
+        self.assertEqual(self.slots_response(f'"other", W/{etag}').status_code, 304)
+        self.assertEqual(self.slots_response('*').status_code, 304)
+        not_modified = self.slots_response(etag)
+        self.assertEqual((not_modified['ETag'], not_modified.content), (etag, b''))
+
+        response = self.client.post('/api/bookings/', {
+            'user': self.user.id, 'ground': self.ground.id, 'time_slot': self.slots[0].id,
+        })
+        self.assertEqual(response.status_code, 201)
+        changed = self.slots_response(etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+
+    def test_holds_and_hours_change_the_tag(self):
+        etag = self.slots_response()['ETag']
+        holds.hold_slots([self.slots[1].id], 'ref-1')
+        held = self.slots_response(etag)
+        self.assertEqual(held.status_code, 200)
+
+        GroundSchedule.objects.create(ground=self.ground, weekday=self.day.weekday(),
+                                      open_time=time(6), close_time=time(8))
+        self.assertNotEqual(self.slots_response(held['ETag'])['ETag'], held['ETag'])
+
+    def test_calendar_and_timeslots(self):
+        path = f'/api/futsals/{self.futsal.id}/calendar/'
+        params = {'start': self.day, 'end': self.day + timedelta(days=6)}
+        etag = self.client.get(path, params)['ETag']
+        self.assertEqual(self.client.get(path, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # A day outside the range leaves the tag alone
+        TimeSlot.objects.create(ground=self.ground, date=self.day + timedelta(days=10),
+                                start_time=time(6), end_time=time(7))
+        availability.rebuild([self.ground.id], [self.day + timedelta(days=10)])
+        self.assertEqual(self.client.get(path, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        params = {'ground': self.ground.id, 'date': self.day}
+        etag = self.client.get('/api/timeslots/', params)['ETag']
+        self.assertEqual(self.client.get('/api/timeslots/', params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        TimeSlot.objects.filter(id=self.slots[1].id).update(is_booked=True)
+        availability.rebuild([self.ground.id], [self.day])
+        self.assertEqual(self.client.get('/api/timeslots/', params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_catalog(self):
+        caches[settings.CATALOG_CACHE_ALIAS].clear()
+        self.addCleanup(caches[settings.CATALOG_CACHE_ALIAS].clear)
+        path = f'/api/grounds/{self.ground.id}/'
+        etag = self.client.get(path)['ETag']
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.ground.price_per_hour = 1200
+            self.ground.save()
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class NearbyFutsalTests(TestCase):
+    def setUp(self):
+        self.center = (27.7172, 85.3240)
+
+        def venue(name, latitude, longitude, **fields):
+            return Futsal.objects.create(name=name, location='Kathmandu', contact='9800000000',
+                                         latitude=latitude, longitude=longitude, **fields)
+
+        self.here = venue('Here', *self.center)
+        self.close = venue('Close', 27.7172, 85.3550)
+        venue('Far', 28.2096, 83.9856)
+        venue('Closed', 27.7180, 85.3245, is_active=False)
+        venue('Unmapped', None, None)
+        self.client = APIClient()
+
+    def nearby(self, **params):
+        params = {'lat': self.center[0], 'lng': self.center[1], **params}
+        return self.client.get('/api/futsals/nearby/', params)
+
+    def test_closest_first_within_radius(self):
+        response = self.nearby(radius=10)
+        self.assertEqual(response.status_code, 200)
+        found = [(venue['name'], round(venue['distance_km'], 1)) for venue in response.json()]
+        self.assertEqual(found, [('Here', 0.0), ('Close', 3.1)])
+        self.assertEqual([venue['name'] for venue in self.nearby(radius=10, limit=1).json()], ['Here'])
+        # Pokhara is well outside even the largest radius, inactive venues never show
+        self.assertEqual([venue['name'] for venue in self.nearby(radius=50).json()], ['Here', 'Close'])
+
+    def test_date_keeps_venues_with_free_slots(self):
+        day = timezone.localdate() + timedelta(days=1)
+        ground = Ground.objects.create(futsal=self.close, name='Ground', price_per_hour=1000)
+        GroundSchedule.objects.create(ground=ground, weekday=day.weekday(),
+                                      open_time=time(18), close_time=time(20))
+        response = self.nearby(radius=10, date=day.isoformat())
+        self.assertEqual([(venue['name'], venue['free_slots']) for venue in response.json()], [('Close', 2)])
+
+    def test_invalid_parameters(self):
+        for params in ({'lat': 91}, {'lng': 'east'}, {'radius': 0}, {'radius': 10 ** 6}, {'date': 'soon'}):
+            with self.subTest(params=params):
+                self.assertEqual(self.nearby(**params).status_code, 400)
+
+    def test_haversine_distance(self):
+        # A degree of latitude along a meridian
+        distance = Futsal.objects.filter(id=self.here.id).annotate(
+            distance=geo.distance_km(self.center[0] + 1, self.center[1])
+        ).get().distance
+        self.assertAlmostEqual(distance, geo.KM_PER_DEGREE, places=6)
+
+
+class ConcurrentBookingTests(TransactionTestCase):
+    """Many clients booking the same few slots at once"""
+
+    workers = 20
+    requests = 100
+
+    def test_no_double_bookings(self):
+        ground, slots = make_ground(range(18, 23))
+        users = User.objects.bulk_create(User(username=f'player_{i}') for i in range(self.workers))
+        start_gate = Barrier(self.workers)
+
+        def worker(w):
+            client = APIClient()
+            client.force_authenticate(users[w])
+            start_gate.wait()
+            try:
+                return [
+                    client.post('/api/bookings/', {
+                        'user': users[w].id, 'ground': ground.id, 'time_slot': slots[i % len(slots)].id,
+                    }).status_code
+                    for i in range(w, self.requests, self.workers)
+                ]
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            statuses = Counter(code for codes in pool.map(worker, range(self.workers)) for code in codes)
+
+        self.assertEqual(statuses, {201: len(slots), 409: self.requests - len(slots)})
+        doubles = (
+            Booking.objects.filter(time_slot__in=slots, status='CONFIRMED')
+            .values('time_slot').annotate(n=Count('id')).filter(n__gt=1)
+        )
+        self.assertFalse(doubles.exists())
+        self.assertEqual(TimeSlot.objects.filter(id__in=[slot.id for slot in slots], is_booked=True).count(),
+                         len(slots))
+        row = GroundAvailability.objects.get(ground=ground)
+        self.assertEqual(row.booked_mask, row.open_mask)
+
+    def test_hold_and_booking_never_both_win(self):
+        ground, slots = make_ground(range(6, 22))
+        user = User.objects.create_user(username='player', password='x')
+        start_gate = Barrier(2)
+
+        def book(slot):
+            client = APIClient()
+            client.force_authenticate(user)
+            start_gate.wait()
+            try:
+                return client.post('/api/bookings/', {
+                    'user': user.id, 'ground': ground.id, 'time_slot': slot.id,
+                }).status_code
+            finally:
+                connections.close_all()
+
+        def hold(slot):
+            start_gate.wait()
+            try:
+                holds.hold_slots([slot.id], f'ref-{slot.id}')
+                return 'held'
+            except holds.SlotsHeld:
+                return 'refused'
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            for slot in slots:
+                booked, held = pool.submit(book, slot), pool.submit(hold, slot)
+                self.assertIn((booked.result(), held.result()), [(201, 'refused'), (409, 'held')])
+        self.assertFalse(SlotHold.objects.filter(time_slot__is_booked=True).exists())
+
+
+class BookingClaimTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground([18, 19])
+        self.user = User.objects.create_user(username='player', password='x')
+
+    def book(self, slot):
+        serializer = BookingSerializer(data={'user': self.user.id, 'ground': self.ground.id, 'time_slot': slot.id})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        with CaptureQueriesContext(connections['default']) as queries:
+            try:
+                serializer.save()
+                outcome = 'booked'
+            except SlotAlreadyBooked:
+                outcome = 'conflict'
+        slot_writes = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "futsal_timeslot"')]
+        self.assertFalse([query['sql'] for query in queries if 'FOR UPDATE' in query['sql']])
+        return outcome, slot_writes
+
+    def test_claim_is_a_single_conditional_update(self):
+        outcome, slot_writes = self.book(self.slots[0])
+        self.assertEqual((outcome, len(slot_writes)), ('booked', 1))
+        self.assertIn('NOT "futsal_timeslot"."is_booked"', slot_writes[0])
+        self.assertIn('held_until', slot_writes[0])
+
+        outcome, slot_writes = self.book(self.slots[0])
+        self.assertEqual((outcome, len(slot_writes)), ('conflict', 1))
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_active_holds_block_the_claim_until_they_lapse(self):
+        holds.hold_slots([self.slots[1].id], 'ref-1')
+        self.assertEqual(self.book(self.slots[1])[0], 'conflict')
+
+        TimeSlot.objects.filter(id=self.slots[1].id).update(held_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.book(self.slots[1])[0], 'booked')
+
+    def test_release_clears_the_hold(self):
+        holds.hold_slots([self.slots[1].id], 'ref-1')
+        holds.release('ref-1')
+        self.assertIsNone(TimeSlot.objects.get(id=self.slots[1].id).held_until)
+        self.assertEqual(self.book(self.slots[1])[0], 'booked')
+
+
+class CancelBookingTests(TestCase):
+    def setUp(self):
+        self.ground, (self.slot,) = make_ground([18])
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/bookings/', {
+            'user': self.user.id, 'ground': self.ground.id, 'time_slot': self.slot.id,
+        })
+        self.assertEqual(response.status_code, 201)
+        self.booking = Booking.objects.get(id=response.data['id'])
+
+    def test_cancel_frees_the_slot_once(self):
+        self.assertEqual(self.client.post(f'/api/bookings/{self.booking.id}/cancel/').status_code, 200)
+        self.slot.refresh_from_db()
+        self.assertFalse(self.slot.is_booked)
+        self.assertEqual(self.client.post(f'/api/bookings/{self.booking.id}/cancel/').status_code, 400)
+
+    def test_completed_booking_keeps_its_slot(self):
+        Booking.objects.filter(id=self.booking.id).update(status='COMPLETED')
+        self.assertEqual(self.client.post(f'/api/bookings/{self.booking.id}/cancel/').status_code, 400)
+        self.slot.refresh_from_db()
+        self.assertTrue(self.slot.is_booked)
+        self.assertEqual(GroundAvailability.objects.get(ground=self.ground).booked_mask, 1 << 18)
+
+
+class VirtualSlotBookingTests(TestCase):
+    def setUp(self):
+        futsal = Futsal.objects.create(name='Test Futsal', location='Test', contact='9800000000')
+        self.ground = Ground.objects.create(futsal=futsal, name='Test Ground', price_per_hour=1000)
+        self.day = timezone.localdate() + timedelta(days=1)
+        GroundSchedule.objects.create(ground=self.ground, weekday=self.day.weekday(),
+                                      open_time=time(6), close_time=time(22))
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def data(self, hour):
+        return {
+            'user': self.user.id, 'ground': self.ground.id,
+            'time_slot': availability.virtual_slot_id(self.ground.id, self.day, hour),
+        }
+
+    def test_validation_writes_nothing(self):
+        serializer = BookingSerializer(data=self.data(18))
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        invalid = BookingSerializer(data={**self.data(18), 'status': 'UNKNOWN'})
+        self.assertFalse(invalid.is_valid())
+        self.assertFalse(TimeSlot.objects.exists())
+        self.assertFalse(GroundAvailability.objects.exists())
+
+    def test_booking_creates_the_slot(self):
+        response = self.client.post('/api/bookings/', self.data(18))
+        self.assertEqual(response.status_code, 201)
+        slot = TimeSlot.objects.get()
+        self.assertEqual((slot.date, slot.start_time, slot.is_booked), (self.day, time(18), True))
+        self.assertEqual(GroundAvailability.objects.get().booked_mask, 1 << 18)
+
+    def test_closed_hour_is_refused(self):
+        response = self.client.post('/api/bookings/', self.data(23))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(TimeSlot.objects.exists())
+
+    def test_past_date_is_refused(self):
+        yesterday = timezone.localdate() - timedelta(days=1)
+        GroundSchedule.objects.create(ground=self.ground, weekday=yesterday.weekday(),
+                                      open_time=time(6), close_time=time(22))
+        slot_id = availability.virtual_slot_id(self.ground.id, yesterday, 18)
+        response = self.client.post('/api/bookings/', {**self.data(18), 'time_slot': slot_id})
+        self.assertEqual(response.status_code, 400)
+        with self.assertRaises(ValueError):
+            availability.materialize([slot_id])
+        self.assertFalse(TimeSlot.objects.exists())
+
+    @override_settings(BOOKING_HORIZON_DAYS=7)
+    def test_date_beyond_horizon_is_refused(self):
+        far = self.day + timedelta(days=7)
+        response = self.client.post('/api/bookings/', {
+            **self.data(18), 'time_slot': availability.virtual_slot_id(self.ground.id, far, 18),
+        })
+        self.assertEqual(response.status_code, 400)
+        # Centuries apart, refused before anything is computed for the span
+        with self.assertNumQueries(0), self.assertRaises(ValueError):
+            availability.materialize([
+                availability.virtual_slot_id(self.ground.id, self.day, 18),
+                availability.virtual_slot_id(self.ground.id, date(2400, 1, 7), 18),
+            ])
+        self.assertFalse(TimeSlot.objects.exists())
+
+    def test_far_apart_days_only_compute_those_days(self):
+        later = self.day + timedelta(days=70)
+        real = availability.materialize([
+            availability.virtual_slot_id(self.ground.id, self.day, 18),
+            availability.virtual_slot_id(self.ground.id, later, 18),
+        ])
+        self.assertEqual(sorted(TimeSlot.objects.values_list('date', flat=True)), [self.day, later])
+        self.assertEqual(len(set(real)), 2)
+        days = dict(next(availability.ground_days(Ground.objects.filter(id=self.ground.id),
+                                                  self.day, later, dates=[self.day, later]))[1])
+        self.assertEqual(set(days), {self.day, later})
+
+
+@override_settings(LOYALTY_REWARD_AFTER=3)
+class LoyaltyTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground(range(6, 12))
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def book(self, slot):
+        return self.client.post('/api/bookings/', {
+            'user': self.user.id, 'ground': self.ground.id, 'time_slot': slot.id,
+        })
+
+    def counters(self):
+        self.user.refresh_from_db()
+        return self.user.total_bookings, self.user.bookings_since_reward, self.user.total_rewards_claimed
+
+    def test_every_fourth_booking_is_free(self):
+        responses = [self.book(slot) for slot in self.slots[:5]]
+        self.assertEqual([response.status_code for response in responses], [201] * 5)
+        self.assertEqual(
+            [booking.is_free_booking for booking in Booking.objects.order_by('id')],
+            [False, False, False, True, False],
+        )
+        self.assertEqual(self.counters(), (4, 1, 1))
+        self.assertEqual(
+            list(self.user.loyalty_entries.order_by('id').values_list('kind', flat=True)),
+            ['EARNED', 'EARNED', 'EARNED', 'REDEEMED', 'EARNED'],
+        )
+
+    def test_a_reward_is_claimed_once(self):
+        User.objects.filter(id=self.user.id).update(bookings_since_reward=4)
+        self.assertTrue(loyalty.claim_reward(self.user.id))
+        self.assertFalse(loyalty.claim_reward(self.user.id))
+        # The booking beyond the threshold counts toward the next reward
+        self.assertEqual(self.counters(), (0, 1, 1))
+
+        loyalty.refund_reward(self.user.id)
+        self.assertEqual(self.counters(), (0, 4, 0))
+
+    def test_failed_booking_gives_the_reward_back(self):
+        User.objects.filter(id=self.user.id).update(bookings_since_reward=3)
+        TimeSlot.objects.filter(id=self.slots[0].id).update(is_booked=True)
+        self.assertNotEqual(self.book(self.slots[0]).status_code, 201)
+        self.assertEqual(self.counters(), (0, 3, 0))
+        self.assertFalse(self.user.loyalty_entries.exists())
+
+    def test_record_counts_per_user(self):
+        other = User.objects.create_user(username='other', password='x')
+        bookings = Booking.objects.bulk_create([
+            Booking(user=self.user, ground=self.ground, time_slot=self.slots[0]),
+            Booking(user=self.user, ground=self.ground, time_slot=self.slots[1]),
+            Booking(user=self.user, ground=self.ground, time_slot=self.slots[2], is_free_booking=True),
+            Booking(user=other, ground=self.ground, time_slot=self.slots[3]),
+        ])
+        # Savepoint, one insert, one UPDATE per user, release
+        with self.assertNumQueries(5):
+            loyalty.record(bookings)
+        self.assertEqual(self.counters(), (2, 2, 0))
+        other.refresh_from_db()
+        self.assertEqual((other.total_bookings, other.bookings_since_reward), (1, 1))
+
+
+class FixtureSlotTests(TestCase):
+    def setUp(self):
+        futsal = Futsal.objects.create(name='Test Futsal', location='Test', contact='9800000000')
+        self.ground = Ground.objects.create(futsal=futsal, name='Test Ground', price_per_hour=1000)
+        self.day = timezone.localdate() + timedelta(days=1)
+        GroundSchedule.objects.create(ground=self.ground, weekday=self.day.weekday(),
+                                      open_time=time(18), close_time=time(20))
+        self.admin = User.objects.create_user(username='admin', password='x', is_staff=True)
+        self.tournament = Tournament.objects.create(name='Cup', start_date=self.day, end_date=self.day)
+        for name in ('A', 'B'):
+            self.tournament.registered_teams.add(Team.objects.create(name=name, captain=self.admin))
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def free_hours(self):
+        return [slot['start_time'] for slot in availability.slots_for(self.day, id=self.ground.id)]
+
+    def book(self, hour):
+        return self.client.post('/api/bookings/', {
+            'user': self.admin.id, 'ground': self.ground.id,
+            'time_slot': availability.virtual_slot_id(self.ground.id, self.day, hour),
+        })
+
+    def test_generated_fixture_hour_is_not_bookable(self):
+        (fixture,) = scheduler.generate(self.tournament, 'round_robin', Ground.objects.filter(id=self.ground.id))
+        self.assertEqual(fixture.match_time, time(18))
+        self.assertTrue(TimeSlot.objects.get(date=self.day, start_time=time(18)).is_booked)
+        self.assertEqual(self.free_hours(), ['19:00:00'])
+        self.assertEqual(self.book(18).status_code, 409)
+        self.assertFalse(Booking.objects.exists())
+
+        response = self.client.delete(f'/api/fixtures/{fixture.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.free_hours(), ['18:00:00', '19:00:00'])
+        self.assertEqual(self.book(18).status_code, 201)
+
+    def test_moved_fixture_swaps_its_slot(self):
+        (fixture,) = scheduler.generate(self.tournament, 'round_robin', Ground.objects.filter(id=self.ground.id))
+        response = self.client.patch(f'/api/fixtures/{fixture.id}/', {'match_time': '19:00'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.free_hours(), ['18:00:00'])
+
+        # A booked hour can not take the fixture
+        self.assertEqual(self.book(18).status_code, 201)
+        response = self.client.patch(f'/api/fixtures/{fixture.id}/', {'match_time': '18:00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.free_hours(), [])
+
+
+class SchedulerTests(SimpleTestCase):
+    day = date(2030, 1, 7)
+
+    def slots(self, hours, grounds=(1, 2)):
+        return {(self.day, hour): list(grounds) for hour in hours}
+
+    def test_round_robin_meets_everyone_once(self):
+        for size in (2, 5, 6):
+            rounds = scheduler.round_robin_pairs(range(size))
+            self.assertEqual(len(rounds), size - 1 if size % 2 == 0 else size)
+            pairs = [frozenset(pair) for pairs in rounds for pair in pairs]
+            self.assertEqual(len(pairs), size * (size - 1) // 2)
+            self.assertEqual(len(set(pairs)), len(pairs))
+            for pairs in rounds:
+                teams = [team for pair in pairs for team in pair]
+                self.assertEqual(len(teams), len(set(teams)))
+
+    def test_knockout_gives_the_top_seeds_a_bye(self):
+        self.assertEqual(scheduler.knockout_pairs(range(1, 9)), [(1, 8), (2, 7), (3, 6), (4, 5)])
+        # Two byes for six teams leave four in the second round
+        self.assertEqual(scheduler.knockout_pairs(range(1, 7)), [(3, 6), (4, 5)])
+        self.assertEqual(scheduler.knockout_pairs([1, 2, 3]), [(2, 3)])
+
+    def test_assign_keeps_round_order_and_rest(self):
+        rounds = scheduler.round_robin_pairs([1, 2, 3, 4])
+        scheduled = scheduler.assign(rounds, self.slots(range(10, 16)), rest_hours=1)
+        self.assertEqual(len(scheduled), 6)
+        self.assertEqual(len({(ground, day, hour) for _, _, _, ground, day, hour in scheduled}), 6)
+        for team in (1, 2, 3, 4):
+            games = sorted((hour, index) for index, home, away, _, _, hour in scheduled if team in (home, away))
+            self.assertEqual([index for _, index in games], [0, 1, 2])
+            hours = [hour for hour, _ in games]
+            self.assertTrue(all(later - earlier > 1 for earlier, later in zip(hours, hours[1:])))
+
+    def test_assign_counts_earlier_games(self):
+        scheduled = scheduler.assign([[(1, 2)]], self.slots(range(10, 13)), last_played={1: (self.day, 10)})
+        self.assertEqual(scheduled[0][-1], 12)
+
+    def test_assign_fails_if_the_matches_do_not_fit(self):
+        rounds = scheduler.round_robin_pairs([1, 2, 3, 4])
+        with self.assertRaisesMessage(scheduler.SchedulingError, '2 of 6 matches do not fit'):
+            scheduler.assign(rounds, self.slots(range(10, 14)), rest_hours=1)
+
+
+class KnockoutTests(TestCase):
+    def setUp(self):
+        futsal = Futsal.objects.create(name='Test Futsal', location='Test', contact='9800000000')
+        self.ground = Ground.objects.create(futsal=futsal, name='Test Ground', price_per_hour=1000)
+        self.day = timezone.localdate() + timedelta(days=1)
+        GroundSchedule.objects.create(ground=self.ground, weekday=self.day.weekday(),
+                                      open_time=time(18), close_time=time(23))
+        self.admin = User.objects.create_user(username='admin', password='x', is_staff=True)
+        self.tournament = Tournament.objects.create(name='Cup', start_date=self.day, end_date=self.day)
+        self.teams = [Team.objects.create(name=name, captain=self.admin) for name in ('A', 'B', 'C')]
+        for team in self.teams:
+            self.tournament.registered_teams.add(team)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def generate(self):
+        return self.client.post(f'/api/tournaments/{self.tournament.id}/generate_fixtures/',
+                                {'format': 'knockout'}, format='json')
+
+    def test_one_round_at_a_time(self):
+        first, second, third = self.teams
+        response = self.generate()
+        self.assertEqual(response.status_code, 201)
+        (semi,) = Fixture.objects.all()
+        self.assertEqual((semi.round, semi.team1_id, semi.team2_id), (1, second.id, third.id))
+
+        response = self.generate()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('needs a winner', response.data['error'])
+
+        Fixture.objects.filter(id=semi.id).update(is_completed=True, winner=third)
+        self.assertEqual(self.generate().status_code, 201)
+        final = Fixture.objects.get(round=2)
+        # The top seed had a bye and meets the winner, who needs an hour of rest
+        self.assertEqual((final.team1_id, final.team2_id), (first.id, third.id))
+        self.assertGreater(final.match_time.hour - semi.match_time.hour, 1)
+
+        Fixture.objects.filter(id=final.id).update(is_completed=True, winner=first)
+        self.assertIn('already has a winner', self.generate().data['error'])
+
+    def test_unknown_format(self):
+        response = self.client.post(f'/api/tournaments/{self.tournament.id}/generate_fixtures/',
+                                    {'format': 'swiss'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Fixture.objects.exists())
+
+
+class StandingsTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_user(username='admin', password='x', is_staff=True)
+        day = timezone.localdate()
+        self.tournament = Tournament.objects.create(name='League', start_date=day, end_date=day)
+        self.a, self.b, self.c, self.d = [Team.objects.create(name=name, captain=self.admin) for name in 'ABCD']
+        self.tournament.registered_teams.add(self.a, self.b, self.c, self.d)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def play(self, home, away, score1, score2):
+        return Fixture.objects.create(
+            tournament=self.tournament, team1=home, team2=away, match_date=self.tournament.start_date,
+            match_time=time(18), team1_score=score1, team2_score=score2, is_completed=True,
+        )
+
+    def table(self):
+        response = self.client.get(f'/api/tournaments/{self.tournament.id}/standings/')
+        return [(row['team_name'], row['played'], row['points'], row['goal_difference']) for row in response.data]
+
+    def snapshot(self):
+        return sorted(
+            Standing.objects.filter(tournament=self.tournament).values_list(
+                'team_id', *standings.COUNTERS, 'head_to_head'
+            )
+        )
+
+    def test_results_update_the_table(self):
+        self.play(self.a, self.b, 2, 1)
+        self.play(self.c, self.d, 1, 1)
+        self.assertEqual(self.table(), [('A', 1, 3, 1), ('C', 1, 1, 0), ('D', 1, 1, 0), ('B', 1, 0, -1)])
+
+    def test_edit_and_delete_take_the_old_result_back(self):
+        fixture = self.play(self.a, self.b, 2, 1)
+        fixture.team1_score, fixture.team2_score = 0, 3
+        fixture.save()
+        self.assertEqual(self.table()[:2], [('B', 1, 3, 3), ('A', 1, 0, -3)])
+
+        fixture.is_completed = False
+        fixture.save()
+        self.assertTrue(all(row[1:] == (0, 0, 0) for row in self.table()))
+
+        fixture.is_completed = True
+        fixture.save()
+        fixture.delete()
+        self.assertTrue(all(row[1:] == (0, 0, 0) for row in self.table()))
+        self.assertFalse(Standing.objects.exclude(head_to_head={}).exists())
+
+    def test_head_to_head_decides_between_teams_level_on_points(self):
+        self.play(self.a, self.b, 1, 0)
+        self.play(self.b, self.c, 5, 0)
+        self.play(self.a, self.d, 0, 1)
+        # B has the best goal difference, but lost to A, who lost to D
+        self.assertEqual([row[0] for row in self.table()], ['D', 'A', 'B', 'C'])
+
+    def test_rebuild_matches_the_incremental_table(self):
+        fixture = self.play(self.a, self.b, 2, 1)
+        self.play(self.c, self.d, 0, 2)
+        fixture.team2_score = 2
+        fixture.save()
+        incremental = self.snapshot()
+        call_command('rebuild_standings', stdout=StringIO())
+        self.assertEqual(self.snapshot(), incremental)
+
+        # A queryset update sends no signals, the rebuild picks it up
+        Fixture.objects.filter(id=fixture.id).update(team1_score=4)
+        call_command('rebuild_standings', '--tournament', str(self.tournament.id), stdout=StringIO())
+        self.assertEqual(self.table()[0], ('A', 1, 3, 2))
+
+
+class OpponentFinderTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground([18, 19, 20])
+        self.day = self.slots[0].date
+        self.captain = User.objects.create_user(username='captain', password='x')
+        self.team = Team.objects.create(name='Mine', captain=self.captain)
+        self.close = self.make_team('Close', matches=2)
+        self.far = self.make_team('Far', matches=10)
+        # Sharing a player with my team rules a team out
+        self.shared = self.make_team('Shared', matches=0)
+        self.shared.members.add(self.captain)
+        self.client = APIClient()
+        self.client.force_authenticate(self.captain)
+
+    def make_team(self, name, matches):
+        captain = User.objects.create_user(username=name.lower(), password='x')
+        return Team.objects.create(name=name, captain=captain, matches_count=matches)
+
+    def book_elsewhere(self, user, hour):
+        """A confirmed booking of ``user`` at ``hour`` on a ground of another venue"""
+        elsewhere, (slot,) = make_ground([hour])
+        Booking.objects.create(user=user, ground=elsewhere, time_slot=slot, status='CONFIRMED')
+
+    def find(self, **params):
+        return self.client.get(f'/api/teams/{self.team.id}/opponents/', {
+            'from': self.day, 'days': 1, 'futsal': self.ground.futsal_id, **params,
+        })
+
+    def hours(self, response):
+        return [
+            (entry['team']['name'], [option['start_time'][:2] for option in entry['options']])
+            for entry in response.data
+        ]
+
+    def test_closest_opponents_with_common_free_hours(self):
+        self.book_elsewhere(self.close.captain, 19)
+        player = User.objects.create_user(username='player', password='x')
+        self.team.members.add(player)
+        self.book_elsewhere(player, 20)
+        TimeSlot.objects.filter(id=self.slots[0].id).update(is_booked=True)
+        availability.rebuild([self.ground.id], [self.day])
+
+        response = self.find()
+        self.assertEqual(response.status_code, 200)
+        # Close is busy at 19 and my team at 20, 18 is booked
+        self.assertEqual(self.hours(response), [('Far', ['19'])])
+
+    def test_options_are_slots_of_the_ground(self):
+        (close, _) = self.find(limit=2).data
+        self.assertEqual(close['team']['name'], 'Close')
+        self.assertEqual([option['id'] for option in close['options']], [slot.id for slot in self.slots])
+        self.assertEqual(len(self.find(limit=1).data), 1)
+
+    def test_query_count_does_not_grow_with_the_teams(self):
+        with CaptureQueriesContext(connections['default']) as few:
+            self.find()
+        for n in range(5):
+            team = self.make_team(f'Extra {n}', matches=n)
+            self.book_elsewhere(team.captain, 18)
+        with self.assertNumQueries(len(few)):
+            response = self.find(limit=50)
+        self.assertEqual(len(response.data), 7)
+
+    def test_members_only_and_validation(self):
+        outsider = APIClient()
+        outsider.force_authenticate(self.far.captain)
+        self.assertEqual(outsider.get(f'/api/teams/{self.team.id}/opponents/').status_code, 403)
+        self.assertEqual(self.find(days=60).status_code, 400)
+        self.assertEqual(self.find(limit='ten').status_code, 400)
+        self.assertEqual(self.find(**{'from': 'soon'}).status_code, 400)
+
+
+class ConfirmPendingTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground(range(10, 16))
+        self.user = User.objects.create_user(username='player', password='x')
+
+    def pending(self, ref, slots):
+        holds.hold_slots([slot.id for slot in slots], ref)
+        return PendingBooking.objects.create(
+            booking_ref=ref, user=self.user, time_slot_ids=[slot.id for slot in slots],
+            ground_id=self.ground.id, pidx=f'pidx-{ref}', total_amount=100000 * len(slots),
+        )
+
+    def test_query_count_does_not_grow_with_the_cart(self):
+        small, large = self.pending('ref-1', self.slots[:1]), self.pending('ref-2', self.slots[1:])
+        with CaptureQueriesContext(connections['default']) as queries:
+            payments.confirm_pending_booking(small, 'txn-1')
+        with self.assertNumQueries(len(queries)):
+            bookings = payments.confirm_pending_booking(large, 'txn-2')
+
+        self.assertEqual(len(bookings), 5)
+        self.assertEqual(Booking.objects.filter(status='CONFIRMED', payment_status='PAID').count(), 6)
+        self.assertFalse(TimeSlot.objects.filter(is_booked=False).exists())
+        self.assertFalse(SlotHold.objects.exists())
+        self.assertFalse(PendingBooking.objects.exists())
+        self.assertEqual(User.objects.get(id=self.user.id).total_bookings, 6)
+        booked_mask = GroundAvailability.objects.get(ground=self.ground).booked_mask
+        self.assertEqual(booked_mask, sum(1 << hour for hour in range(10, 16)))
+
+    def test_a_taken_slot_books_nothing(self):
+        pending = self.pending('ref-1', self.slots[:2])
+        TimeSlot.objects.filter(id=self.slots[1].id).update(is_booked=True)
+        with self.assertRaises(payments.SlotsUnavailable):
+            payments.confirm_pending_booking(pending, 'txn-1')
+        self.assertFalse(Booking.objects.exists())
+        self.assertTrue(PendingBooking.objects.filter(id=pending.id).exists())
+        self.assertFalse(TimeSlot.objects.get(id=self.slots[0].id).is_booked)
+
+    def test_second_confirmation_is_refused(self):
+        pending = self.pending('ref-1', self.slots[:1])
+        payments.confirm_pending_booking(pending, 'txn-1')
+        with self.assertRaises(payments.AlreadyConfirmed):
+            payments.confirm_pending_booking(pending, 'txn-1')
+        self.assertEqual(Booking.objects.count(), 1)
+
+
+class FakeKhalti:
+    """Answers every lookup with ``answer``, a (status_code, data) pair or an exception"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.looked_up = []
+
+    def lookup(self, pidx):
+        self.looked_up.append(pidx)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+class PaymentWorkerTests(TestCase):
+    def setUp(self):
+        self.ground, self.slots = make_ground([18])
+        self.user = User.objects.create_user(username='player', password='x')
+        holds.hold_slots([self.slots[0].id], 'ref-1')
+        PendingBooking.objects.create(
+            booking_ref='ref-1', user=self.user, time_slot_ids=[self.slots[0].id],
+            ground_id=self.ground.id, pidx='pidx-1', total_amount=100000,
+        )
+        self.job = PaymentVerification.objects.create(booking_ref='ref-1', pidx='pidx-from-callback')
+        previous = khalti.get_client()
+        self.addCleanup(khalti.set_client, previous)
+
+    def run_job(self, answer):
+        khalti.set_client(FakeKhalti(answer))
+        (job,) = payments.claim_verifications(limit=10)
+        self.assertEqual(payments.claim_verifications(limit=10), [])
+        payments.process_verification(job)
+        return PaymentVerification.objects.get(id=job.id)
+
+    def test_completed_payment_books_the_cart(self):
+        job = self.run_job((200, {'status': 'Completed', 'transaction_id': 'txn-1'}))
+        self.assertEqual((job.status, job.attempts), ('CONFIRMED', 1))
+        # The pidx we initiated, not the one the callback carried
+        self.assertEqual(khalti.get_client().looked_up, ['pidx-1'])
+        self.assertTrue(Booking.objects.filter(time_slot=self.slots[0], status='CONFIRMED').exists())
+
+    def test_pending_payment_and_outages_back_off(self):
+        job = self.run_job((200, {'status': 'Pending'}))
+        self.assertEqual((job.status, job.attempts), ('QUEUED', 1))
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(payments.claim_verifications(limit=10), [])
+
+        PaymentVerification.objects.filter(id=job.id).update(next_attempt_at=timezone.now())
+        job = self.run_job(khalti.KhaltiError('connection refused'))
+        self.assertEqual((job.status, job.attempts), ('QUEUED', 2))
+        self.assertIn('Gateway unavailable', job.message)
+        self.assertTrue(SlotHold.objects.filter(booking_ref='ref-1').exists())
+
+    @override_settings(PAYMENT_MAX_ATTEMPTS=1)
+    def test_giving_up_releases_the_holds(self):
+        job = self.run_job(khalti.KhaltiError('connection refused'))
+        self.assertEqual(job.status, 'FAILED')
+        self.assertFalse(SlotHold.objects.exists())
+        self.assertIsNone(TimeSlot.objects.get(id=self.slots[0].id).held_until)
+
+    def test_failed_payment_is_final(self):
+        job = self.run_job((200, {'status': 'User canceled'}))
+        self.assertEqual(job.status, 'FAILED')
+        self.assertFalse(Booking.objects.exists())
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_stale_jobs_are_requeued(self):
+        (job,) = payments.claim_verifications(limit=10)
+        PaymentVerification.objects.filter(id=job.id).update(updated_at=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(payments.requeue_stale(timedelta(minutes=5)), 1)
+        self.assertEqual([job.id for job in payments.claim_verifications(limit=10)], [self.job.id])
+
+
+class ReconcilePendingTests(TestCase):
+    def setUp(self):
+        self.ground, (self.slot,) = make_ground([18])
+        self.user = User.objects.create_user(username='player', password='x')
+        self.pending = PendingBooking.objects.create(
+            booking_ref='ref-1', user=self.user, time_slot_ids=[self.slot.id],
+            ground_id=self.ground.id, pidx='pidx-1', total_amount=100000,
+        )
+        PendingBooking.objects.filter(id=self.pending.id).update(created_at=timezone.now() - timedelta(hours=1))
+
+    def test_paid_but_unbookable_is_settled_for_good(self):
+        TimeSlot.objects.filter(id=self.slot.id).update(is_booked=True)
+        outcome = payments.reconcile_pending(
+            self.pending, 200, {'status': 'Completed', 'transaction_id': 'txn-1'}, timezone.now()
+        )
+        self.assertEqual(outcome, 'unbookable')
+        verification = PaymentVerification.objects.get(booking_ref='ref-1')
+        self.assertEqual((verification.status, verification.pidx), ('REFUND_DUE', 'pidx-1'))
+        # Kept for the refund, but never looked up again even once the slot is free
+        self.assertTrue(PendingBooking.objects.filter(booking_ref='ref-1').exists())
+        TimeSlot.objects.filter(id=self.slot.id).update(is_booked=False)
+        out = StringIO()
+        call_command('reconcile_pending_bookings', '--older-than', '0', stdout=out)
+        self.assertIn('Nothing to do', out.getvalue())
+        self.assertFalse(Booking.objects.exists())
+
+    def test_confirmed_without_callback_is_recorded(self):
+        outcome = payments.reconcile_pending(
+            self.pending, 200, {'status': 'Completed', 'transaction_id': 'txn-1'}, timezone.now()
+        )
+        self.assertEqual(outcome, 'confirmed')
+        self.assertEqual(PaymentVerification.objects.get(booking_ref='ref-1').status, 'CONFIRMED')
+        self.assertTrue(Booking.objects.filter(time_slot=self.slot, status='CONFIRMED').exists())
+
+
+class FeedQueryTests(TestCase):
+    """The feed costs the same number of queries however much there is to show"""
+
+    def seed(self, posts, comments):
+        Post.objects.all().delete()
+        posts = Post.objects.bulk_create(
+            Post(author=self.users[i % len(self.users)], title=f'Post {i}', content='Content')
+            for i in range(posts)
+        )
+        Comment.objects.bulk_create(
+            Comment(post=post, author=self.users[c % len(self.users)], content='Comment')
+            for post in posts for c in range(comments)
+        )
+        Post.likes.through.objects.bulk_create(
+            Post.likes.through(post=post, user=user) for post in posts[::2] for user in self.users
+        )
+
+    def setUp(self):
+        self.users = User.objects.bulk_create(User(username=f'player_{i}') for i in range(10))
+        self.client = APIClient()
+        self.client.force_authenticate(self.users[0])
+
+    def test_queries_do_not_grow_with_posts_comments_and_likes(self):
+        for posts, comments in ((5, 2), (50, 20)):
+            self.seed(posts, comments)
+            with self.assertNumQueries(3):
+                response = self.client.get('/api/posts/feed/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.data['results']), min(posts, 20))
+            self.assertEqual(len(response.data['results'][0]['latest_comments']), min(comments, 3))
+
+
+class PostSearchTests(TestCase):
+    def setUp(self):
+        author = User.objects.create_user(username='player', password='x')
+        for title, content in (
+            ('Goalkeeper wanted', 'Friendly match on Friday evening'),
+            ('Friday league', 'We are looking for goalkeepers and a defender'),
+            ('Boots for sale', 'Barely used, size 42'),
+        ):
+            Post.objects.create(author=author, title=title, content=content)
+        self.client = APIClient()
+        self.client.force_authenticate(author)
+
+    def titles(self, q, path='/api/posts/'):
+        response = self.client.get(path, {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [post['title'] for post in response.json()['results']]
+
+    def test_stemmed_matches_ranked_title_first(self):
+        self.assertEqual(self.titles('goalkeeper'), ['Goalkeeper wanted', 'Friday league'])
+        self.assertEqual(self.titles('goalkeeper', '/api/posts/feed/'), ['Goalkeeper wanted', 'Friday league'])
+
+    def test_websearch_syntax(self):
+        self.assertEqual(self.titles('goalkeeper -league'), ['Goalkeeper wanted'])
+        self.assertEqual(self.titles('"barely used"'), ['Boots for sale'])
+        self.assertEqual(self.titles('boots or defender'), ['Boots for sale', 'Friday league'])
+        # Stray operators are not an error
+        self.assertEqual(self.titles('"goalkeeper -'), ['Goalkeeper wanted', 'Friday league'])
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def walk(self, path, page_size, **params):
+        """Ids of every row reached by following ``next`` from the first keyset page"""
+        ids, params = [], {**params, 'cursor': '', 'page_size': page_size}
+        while True:
+            response = self.client.get(path, params)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertNotIn('count', page)
+            self.assertLessEqual(len(page['results']), page_size)
+            ids += [row['id'] for row in page['results']]
+            if not page['next']:
+                return ids
+            params = parse_qs(urlparse(page['next']).query)
+
+    def test_posts_with_tied_timestamps(self):
+        posts = Post.objects.bulk_create(
+            Post(author=self.user, title=f'Post {n}', content='Content') for n in range(25)
+        )
+        # Half of them share one timestamp, only the id tells them apart
+        Post.objects.filter(id__in=[post.id for post in posts[::2]]).update(created_at=timezone.now())
+        expected = list(Post.objects.order_by('-created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/posts/', 4), expected)
+
+        # Without a cursor the page-number responses are unchanged
+        response = self.client.get('/api/posts/')
+        self.assertEqual((response.json()['count'], len(response.json()['results'])), (25, 20))
+
+    def test_bookings_are_the_callers_own(self):
+        ground, slots = make_ground(range(6, 13))
+        other = User.objects.create_user(username='other', password='x')
+        Booking.objects.bulk_create(
+            Booking(user=self.user if slot.start_time.hour % 2 else other, ground=ground, time_slot=slot)
+            for slot in slots
+        )
+        own = Booking.objects.filter(user=self.user).order_by('-created_at', 'id')
+        expected = list(own.values_list('id', flat=True))
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(self.walk('/api/bookings/', 2), expected)
+
+    def test_timeslots_in_time_order(self):
+        ground, _ = make_ground([20, 18, 19])
+        TimeSlot.objects.create(ground=ground, date=timezone.localdate() + timedelta(days=2),
+                                start_time=time(6), end_time=time(7))
+        expected = list(TimeSlot.objects.order_by('date', 'start_time', 'id').values_list('id', flat=True))
+        self.assertEqual(self.walk('/api/timeslots/', 3), expected)
+
+    def test_bad_cursor_and_page_size(self):
+        self.assertEqual(self.client.get('/api/posts/', {'cursor': 'bm9wZQ'}).status_code, 404)
+        Post.objects.bulk_create(Post(author=self.user, title=f'Post {n}', content='Content') for n in range(120))
+        response = self.client.get('/api/posts/', {'cursor': '', 'page_size': 1000})
+        self.assertEqual(len(response.json()['results']), 100)
+
+
+class CatalogCacheTests(TestCase):
+    def setUp(self):
+        cache = caches[settings.CATALOG_CACHE_ALIAS]
+        cache.clear()
+        catalog._local.clear()
+        catalog._stats.clear()
+        catalog._version = None
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_venue_is_cached_until_it_changes(self):
+        ground, _ = make_ground([18])
+        futsal = ground.futsal
+        first = self.client.get(f'/api/futsals/{futsal.id}/')
+        with self.assertNumQueries(0):
+            second = self.client.get(f'/api/futsals/{futsal.id}/')
+        self.assertEqual(second.json(), first.json())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            futsal.name = 'Renamed'
+            futsal.save()
+        self.assertEqual(self.client.get(f'/api/futsals/{futsal.id}/').json()['name'], 'Renamed')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ground.name = 'Court 2'
+            ground.save()
+        self.assertEqual(self.client.get(f'/api/grounds/{ground.id}/').json()['name'], 'Court 2')
+        self.assertEqual(catalog.stats()['invalidations'], 2)
+
+    def test_query_string_and_host_are_part_of_the_key(self):
+        Futsal.objects.create(name='Arena', location='Baneshwor', contact='9800000000')
+        Futsal.objects.create(name='Dome', location='Lalitpur', contact='9800000001')
+        self.assertEqual(len(self.client.get('/api/futsals/', {'search': 'Arena'}).json()['results']), 1)
+        self.assertEqual(len(self.client.get('/api/futsals/').json()['results']), 2)
+        self.assertEqual(catalog.stats()['misses'], 2)
+        self.client.get('/api/futsals/', HTTP_HOST='testserver')
+        self.client.get('/api/futsals/', HTTP_HOST='localhost')
+        self.assertEqual((catalog.stats()['shared_hits'], catalog.stats()['misses']), (1, 3))
+
+    def test_shared_cache_keeps_a_local_copy(self):
+        build = mock.Mock(return_value='value')
+        with mock.patch.object(catalog, 'is_shared', return_value=True):
+            self.assertEqual(catalog.get_or_build('key', build), 'value')
+            self.assertEqual(catalog.get_or_build('key', build), 'value')
+            # Another process only finds it in the shared cache
+            catalog._local.clear()
+            catalog.get_or_build('key', build)
+            self.assertEqual(build.call_count, 1)
+
+            # A bump by another process is seen once the local copy of the version expires
+            caches[settings.CATALOG_CACHE_ALIAS].incr(catalog.VERSION_KEY)
+            catalog.get_or_build('key', build)
+            self.assertEqual(build.call_count, 1)
+            with override_settings(CATALOG_LOCAL_TTL=0):
+                catalog.get_or_build('key', build)
+            self.assertEqual(build.call_count, 2)
+
+        stats = catalog.stats()
+        self.assertEqual((stats['local_hits'], stats['shared_hits'], stats['misses']), (2, 1, 2))
+        self.assertEqual(stats['hit_ratio'], 0.6)
+
+    def test_process_cache_skips_the_local_tier(self):
+        self.assertFalse(catalog.is_shared())
+        cache = caches[settings.CATALOG_CACHE_ALIAS]
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            catalog.get_or_build('key', lambda: 'value')
+        self.assertEqual(cache_set.call_args.kwargs['timeout'], settings.CATALOG_PROCESS_CACHE_TIMEOUT)
+        self.assertEqual(catalog._local, {})
+
+    def test_stats_are_for_admins(self):
+        self.assertEqual(self.client.get('/api/catalog-cache-stats/').status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get('/api/catalog-cache-stats/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['shared'])
+
+
+class LikeToggleTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='player', password='x')
+        self.post = Post.objects.create(author=self.user, title='Post', content='Content')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.addCleanup(likes.flush)
+
+    def test_toggle_is_written_right_away(self):
+        response = self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual((response.data['message'], response.data['likes_count']), ('Liked', 1))
+        self.assertTrue(likes.Like.objects.filter(post=self.post, user=self.user).exists())
+        entry = self.client.get('/api/posts/feed/').data['results'][0]
+        self.assertEqual((entry['is_liked'], entry['likes_count']), (True, 1))
+
+        # The unlike may be served by a process that never saw the like
+        likes._pending.clear()
+        response = self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual(response.data['message'], 'Unliked')
+        self.assertFalse(likes.Like.objects.filter(post=self.post, user=self.user).exists())
+
+    def test_flush_writes_the_counter(self):
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual(likes.flush(), 1)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.likes_count, 1)
+        self.assertEqual(likes.flush(), 0)
+
+
+class LiveStreamTests(TransactionTestCase):
+    subscribers = 300
+
+    def setUp(self):
+        self.ground, self.slots = make_ground([18, 19])
+        self.day = self.slots[0].date
+        broker = live.Broker()
+        patcher = mock.patch.object(live, 'broker', broker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(broker.stop)
+
+    async def stream(self, count, events):
+        app = get_asgi_application()
+        path = f'/api/futsals/{self.ground.futsal_id}/live/'
+        snapshots = asyncio.Semaphore(0)
+        arrivals = asyncio.Queue()
+        disconnect = asyncio.Event()
+        statuses = []
+
+        def client(index):
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    statuses.append(message['status'])
+                elif message['type'] == 'http.response.body':
+                    chunk = message.get('body', b'').decode()
+                    if chunk.startswith('event: snapshot'):
+                        snapshots.release()
+                    elif chunk.startswith('event: '):
+                        arrivals.put_nowait((index, chunk.split('\n', 1)[0]))
+
+            return app({
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'root_path': '',
+                'query_string': f'date={self.day.isoformat()}'.encode(), 'headers': [(b'host', b'localhost')],
+                'client': ('127.0.0.1', 10000 + index), 'server': ('localhost', 80),
+            }, receive, send)
+
+        tasks = [asyncio.create_task(client(index)) for index in range(count)]
+        for _ in range(count):
+            await asyncio.wait_for(snapshots.acquire(), 30)
+        opened = live.broker.subscriber_count()
+
+        received = []
+        for publish in events:
+            await sync_to_async(publish)()
+            received.append(Counter([await asyncio.wait_for(arrivals.get(), 30) for _ in range(count)]))
+
+        disconnect.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), 30)
+        return statuses, opened, received
+
+    def test_every_idle_subscriber_gets_every_event_and_is_cleaned_up(self):
+        count = self.subscribers
+        other_day = self.day + timedelta(days=1)
+        other = TimeSlot.objects.create(ground=self.ground, date=other_day, start_time=time(18), end_time=time(19))
+        availability.rebuild([self.ground.id], [other_day])
+
+        def book():
+            # Only the change on the streamed day reaches the subscribers
+            availability.mark_booked(other)
+            availability.mark_booked(self.slots[0])
+
+        statuses, opened, received = async_to_sync(self.stream)(count, [
+            book, lambda: availability.mark_free(self.slots[0]),
+        ])
+        self.assertEqual(statuses, [200] * count)
+        self.assertEqual(opened, count)
+        self.assertEqual(received, [
+            Counter({(index, 'event: booked'): 1 for index in range(count)}),
+            Counter({(index, 'event: freed'): 1 for index in range(count)}),
+        ])
+        self.assertEqual(live.broker.subscriber_count(), 0)
+
+
+class FreeAgentTests(TestCase):
+    def setUp(self):
+        self.home = Futsal.objects.create(name='Home Futsal', location='Test', contact='9800000000')
+        self.away = Futsal.objects.create(name='Away Futsal', location='Test', contact='9800000000')
+        self.user = User.objects.create_user(username='captain', password='x', futsal=self.home)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.today = timezone.localdate()
+
+    def agent(self, username, **fields):
+        return User.objects.create_user(username=username, password='x', is_looking_for_team=True, **fields)
+
+    def usernames(self, **params):
+        response = self.client.get('/api/users/looking_for_team/', params)
+        self.assertEqual(response.status_code, 200)
+        return [player['username'] for player in response.json()['results']]
+
+    def test_birth_date_range_handles_leap_days(self):
+        self.assertEqual(
+            matchmaking.birth_date_range(18, 30, today=date(2024, 2, 29)),
+            (date(1993, 2, 28), date(2006, 2, 28)),
+        )
+
+    def test_age_band_boundaries(self):
+        birthday = matchmaking._years_before
+        self.agent('turns_18_today', date_of_birth=birthday(self.today, 18))
+        self.agent('turns_18_tomorrow', date_of_birth=birthday(self.today + timedelta(days=1), 18))
+        self.agent('turns_31_tomorrow', date_of_birth=birthday(self.today + timedelta(days=1), 31))
+        self.agent('turns_31_today', date_of_birth=birthday(self.today, 31))
+        self.agent('no_birthday')
+        self.assertEqual(
+            sorted(self.usernames(min_age=18, max_age=30)), ['turns_18_today', 'turns_31_tomorrow'],
+        )
+        self.assertEqual(self.usernames(min_age=31), ['turns_31_today'])
+
+    def test_ranked_by_position_then_home_futsal(self):
+        self.agent('gk_home', preferred_position='GK', futsal=self.home, matches_played=1)
+        self.agent('gk_away', preferred_position='GK', futsal=self.away, matches_played=50)
+        self.agent('mid_home', preferred_position='MID', futsal=self.home, matches_played=5)
+        self.agent('mid_away', preferred_position='MID', futsal=self.away, matches_played=90)
+        self.agent('fwd_away', preferred_position='FWD', futsal=self.away, matches_played=10)
+        # The home futsal defaults to the caller's
+        self.assertEqual(self.usernames(position='GK'), ['gk_home', 'gk_away', 'mid_home', 'mid_away', 'fwd_away'])
+        self.assertEqual(
+            self.usernames(position='MID', futsal=self.away.id),
+            ['mid_away', 'mid_home', 'gk_away', 'fwd_away', 'gk_home'],
+        )
+
+    def test_cursor_pages_walk_every_agent_once(self):
+        for n in range(7):
+            self.agent(f'agent_{n}', preferred_position='GK' if n % 2 else 'DEF', matches_played=n % 3)
+        expected = self.usernames(position='GK', page_size=100)
+        self.assertEqual(len(expected), 7)
+
+        seen, params = [], {'position': 'GK', 'page_size': 3, 'cursor': ''}
+        while True:
+            response = self.client.get('/api/users/looking_for_team/', params)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 3)
+            seen += [player['username'] for player in page['results']]
+            if not page['next']:
+                break
+            params['cursor'] = parse_qs(urlparse(page['next']).query)['cursor'][0]
+        self.assertEqual(seen, expected)
+
+        response = self.client.get('/api/users/looking_for_team/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+
+class KhaltiCheckoutTests(TestCase):
+    def setUp(self):
+        stub = KhaltiStub().start()
+        previous = khalti.get_client()
+        khalti.set_client(khalti.KhaltiClient(base_url=stub.base_url))
+        self.addCleanup(stub.stop)
+        self.addCleanup(khalti.set_client, previous)
+        self.ground, self.slots = make_ground([18, 19])
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_checkout_books_after_verification(self):
+        response = self.client.post('/api/bookings/create_with_khalti/', {
+            'time_slots': [slot.id for slot in self.slots], 'total_amount': 200000, 'ground_id': self.ground.id,
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        booking_ref = response.json()['booking_ref']
+        pidx = response.json()['payment_url'].rsplit('pidx=', 1)[1]
+        self.assertEqual(SlotHold.objects.filter(booking_ref=booking_ref).count(), 2)
+
+        # The callback only queues the verification
+        response = self.client.get('/api/khalti-verify/', {'ref': booking_ref, 'pidx': pidx})
+        self.assertEqual((response.status_code, response.json()['status']), (202, 'queued'))
+        self.assertFalse(Booking.objects.exists())
+
+        (job,) = payments.claim_verifications(limit=10)
+        payments.process_verification(job)
+        self.assertEqual(PaymentVerification.objects.get(booking_ref=booking_ref).status, 'CONFIRMED')
+        self.assertEqual(
+            sorted(Booking.objects.filter(status='CONFIRMED').values_list('time_slot_id', flat=True)),
+            sorted(slot.id for slot in self.slots),
+        )
+        self.assertFalse(SlotHold.objects.exists())
+        self.assertEqual(GroundAvailability.objects.get(ground=self.ground).booked_mask, 1 << 18 | 1 << 19)
+
+
+class KhaltiRetryTests(SimpleTestCase):
+    def setUp(self):
+        # Reads each request, then drops the connection without answering
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(self.server.close)
+        self.requests = 0
+
+        def serve():
+            while True:
+                try:
+                    connection, _ = self.server.accept()
+                except OSError:
+                    return
+                with connection:
+                    connection.recv(65536)
+                    self.requests += 1
+
+        Thread(target=serve, daemon=True).start()
+        self.client = khalti.KhaltiClient(
+            base_url=f'http://127.0.0.1:{self.server.getsockname()[1]}/', retries=2, backoff=0
+        )
+
+    def test_initiate_is_not_retried_once_sent(self):
+        with self.assertRaises(khalti.KhaltiError):
+            self.client.initiate({'amount': 1000})
+        self.assertEqual(self.requests, 1)
+
+    def test_lookup_is_retried(self):
+        with self.assertRaises(khalti.KhaltiError):
+            self.client.lookup('pidx-1')
+        self.assertEqual(self.requests, 3)
+
+
+class ImageVariantTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(MEDIA_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='player', password='x')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def png(self, width, height, color=(200, 30, 30, 128)):
+        buffer = BytesIO()
+        Image.new('RGBA', (width, height), color).save(buffer, 'PNG')
+        return ContentFile(buffer.getvalue(), name='photo.png')
+
+    def post(self, image):
+        with mock.patch.object(images, 'schedule') as schedule:
+            post = Post.objects.create(author=self.user, title='Post', content='Content', image=image)
+        schedule.assert_called_once_with(Post, post.id, 'image', 'image_variants')
+        return post
+
+    def test_every_size_in_every_format(self):
+        with Image.open(self.png(2000, 1000)) as image:
+            rendered = images.render(image)
+        self.assertEqual({size: rendered[size][:2] for size in rendered}, {
+            'small': (160, 80), 'medium': (640, 320), 'large': (1280, 640),
+        })
+        encoded = rendered['small'][2]
+        self.assertEqual(encoded['webp'][8:12], b'WEBP')
+        self.assertEqual(encoded['jpeg'][:2], b'\xff\xd8')
+        # Never enlarged
+        with Image.open(self.png(100, 50)) as image:
+            self.assertEqual(images.render(image)['large'][:2], (100, 50))
+
+    def test_generated_variants_are_served(self):
+        post = self.post(self.png(1600, 900))
+        entry = self.client.get('/api/posts/feed/').data['results'][0]
+        self.assertTrue(entry['image'].endswith(post.image.name))
+        self.assertEqual(entry['image_variants'], {})
+
+        variants = images.generate(Post, post.id, 'image', 'image_variants')
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants, variants)
+        self.assertEqual(variants['source'], post.image.name)
+        for size in images.SIZES:
+            for image_format in images.FORMATS:
+                self.assertTrue(default_storage.exists(variants[size][image_format]))
+
+        entry = self.client.get('/api/posts/feed/').data['results'][0]
+        self.assertTrue(entry['image'].endswith(variants['medium']['webp']))
+        self.assertEqual(entry['image_variants']['large']['width'], 1280)
+        entry = self.client.get('/api/posts/feed/', {'image_format': 'jpeg'}).data['results'][0]
+        self.assertTrue(entry['image'].endswith(variants['medium']['jpeg']))
+
+    def test_refresh_only_for_changed_images(self):
+        post = self.post(self.png(300, 300))
+        images.generate(Post, post.id, 'image', 'image_variants')
+        post.refresh_from_db()
+        with mock.patch.object(images, 'schedule') as schedule:
+            post.title = 'Renamed'
+            post.save()
+            post.image = self.png(300, 300, color=(0, 0, 255, 255))
+            post.save(update_fields=['content'])
+            schedule.assert_not_called()
+            post.save()
+            schedule.assert_called_once()
+
+        post.image = None
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants, {})
+
+    def test_a_newer_upload_wins(self):
+        post = self.post(self.png(300, 300))
+        newer = self.post(self.png(300, 300, color=(0, 255, 0, 255))).image.name
+        render = images.render
+
+        def replaced_while_rendering(image):
+            Post.objects.filter(id=post.id).update(image=newer)
+            return render(image)
+
+        with mock.patch.object(images, 'render', side_effect=replaced_while_rendering):
+            self.assertIsNone(images.generate(Post, post.id, 'image', 'image_variants'))
+        post.refresh_from_db()
+        self.assertEqual((post.image.name, post.image_variants), (newer, {}))
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(MEDIA_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='player', password='x')
+
+    def age(self, name, days=2):
+        """Make a stored file look ``days`` old"""
+        then = (timezone.now() - timedelta(days=days)).timestamp()
+        os.utime(default_storage.path(name), (then, then))
+
+    def test_identical_uploads_share_one_file(self):
+        first = default_storage.save('posts/one.jpg', ContentFile(b'same bytes'))
+        second = default_storage.save('posts/two.JPG', ContentFile(b'same bytes'))
+        other = default_storage.save('posts/three.jpg', ContentFile(b'other bytes'))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        self.assertRegex(first, r'^posts/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$')
+        self.assertEqual(default_storage.open(first).read(), b'same bytes')
+        directory = os.path.dirname(default_storage.path(first))
+        self.assertFalse([name for name in os.listdir(directory) if name.startswith(media.TEMP_PREFIX)])
+
+        # Uploading it again keeps the file away from the orphan collector
+        self.age(first)
+        default_storage.save('posts/again.jpg', ContentFile(b'same bytes'))
+        self.assertGreater(default_storage.get_modified_time(first), timezone.now() - timedelta(minutes=1))
+
+    def test_collect_orphans_keeps_referenced_and_recent_files(self):
+        used = default_storage.save('posts/used.jpg', ContentFile(b'used'))
+        variant = default_storage.save('variants/small.webp', ContentFile(b'variant'))
+        orphan = default_storage.save('posts/orphan.jpg', ContentFile(b'orphan'))
+        recent = default_storage.save('posts/recent.jpg', ContentFile(b'recent'))
+        for name in (used, variant, orphan):
+            self.age(name)
+        with mock.patch.object(images, 'schedule'):
+            Post.objects.create(author=self.user, title='Post', content='Content', image=used,
+                                image_variants={'source': used, 'small': {'webp': variant}})
+
+        self.assertEqual(media.collect_orphans(dry_run=True), (4, 1))
+        self.assertEqual(media.collect_orphans(batch_size=1, dry_run=True), (4, 1))
+        self.assertTrue(default_storage.exists(orphan))
+
+        out = StringIO()
+        call_command('collect_media_orphans', stdout=out)
+        self.assertIn('Deleted 1 orphaned files among 4', out.getvalue())
+        self.assertFalse(default_storage.exists(orphan))
+        for name in (used, variant, recent):
+            self.assertTrue(default_storage.exists(name))
+
+        # Without the grace period the recent file goes too
+        self.assertEqual(media.collect_orphans(grace=timedelta(0)), (3, 1))
+        self.assertFalse(default_storage.exists(recent))
+
+
+class MediaServingTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings_override = override_settings(MEDIA_ROOT=root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.name = default_storage.save('posts/photo.jpg', ContentFile(b'jpeg bytes'))
+
+    def reload_urls(self):
+        urls = importlib.import_module(settings.ROOT_URLCONF)
+        # Put back under the original settings once the test is over
+        self.addCleanup(clear_url_caches)
+        self.addCleanup(importlib.reload, urls)
+        clear_url_caches()
+        importlib.reload(urls)
+
+    def test_offloaded_responses_carry_no_bytes(self):
+        with override_settings(MEDIA_OFFLOAD='x-accel'):
+            response = media.file_response(self.name)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+        self.assertEqual(response['Cache-Control'], media.IMMUTABLE)
+        self.assertEqual(response.content, b'')
+        with override_settings(MEDIA_OFFLOAD='x-sendfile'):
+            response = media.file_response(self.name)
+        self.assertEqual(response['X-Sendfile'], default_storage.path(self.name))
+
+    @override_settings(DEBUG=False, MEDIA_OFFLOAD='')
+    def test_django_streams_media_only_in_debug(self):
+        self.reload_urls()
+        self.assertEqual(self.client.get('/media/' + self.name).status_code, 404)
+
+    @override_settings(DEBUG=False, MEDIA_OFFLOAD='x-accel')
+    def test_offload_is_routed_outside_debug(self):
+        self.reload_urls()
+        response = self.client.get('/media/' + self.name)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.name)
+
+    @override_settings(MEDIA_OFFLOAD='nginx')
+    def test_unknown_offload_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.reload_urls()
@@ -16,6 +16,7 @@ router.register(r'posts', PostViewSet, basename='post')
 router.register(r'comments', CommentViewSet, basename='comment')
 
 urlpatterns = [
+    path('futsals/<int:futsal_id>/live/', availability_stream, name='availability_stream'),
     path('', include(router.urls)),
     path('register/', register, name='register'),
     path('token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
@@ -23,4 +24,6 @@ urlpatterns = [
     path('forgot-password/', forgot_password, name='forgot_password'),
     path('reset-password/', reset_password, name='reset_password'),
     path('khalti-verify/', khalti_payment_verify, name='khalti_verify'),
+    path('payment-status/', payment_status, name='payment_status'),
+    path('catalog-cache-stats/', catalog_cache_stats, name='catalog_cache_stats'),
 ]
\ No newline at end of file
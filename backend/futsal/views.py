@@ -1,31 +1,96 @@
+import asyncio
+import copy
+import hashlib
+import json
 import os
 import secrets
 import token
 from urllib import request
-import requests
 from decimal import Decimal
 from datetime import timedelta
 from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
 from django.shortcuts import render
+from django.db import connection, transaction
+from django.http import JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
 from dotenv import load_dotenv 
 
 # REST Framework imports
 from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.parsers import MultiPartParser, FormParser
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Q, Subquery, Value, Window
+from django.db.models.functions import Coalesce, RowNumber
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.dateparse import parse_date
+from django.utils.http import parse_etags
+from django.views.decorators.http import require_safe
 
 from .models import *
 from .serializers import *
+from .pagination import FreeAgentPagination, OptionalKeysetPagination, OptionalSlotKeysetPagination
+from . import (
+    availability, catalog, geo, holds, khalti, likes, live, loyalty, matchmaking, media, opponents, scheduler,
+    standings,
+)
 
 load_dotenv()  # Load environment variables from .env file
 User = get_user_model()
 
+MAX_CALENDAR_DAYS = 31
+MAX_NEARBY_RADIUS_KM = 50
+MAX_NEARBY_RESULTS = 100
+MAX_OPPONENT_DAYS = 28
+MAX_OPPONENT_RESULTS = 50
+SSE_HEARTBEAT = 15  # seconds between keep-alive comments on idle streams
+FEED_PREVIEW_COMMENTS = 3
+
+def conditional_response(request, etag, build):
+    """304 if the client already has ``etag``, else the data from ``build()`` tagged with it"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+        if '*' in tags or etag in tags:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    return Response(build(), headers={'ETag': etag})
+
+
+def _tagged(data):
+    """``data`` with a strong ETag of its JSON"""
+    raw = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+    return '"%s"' % hashlib.sha1(raw.encode()).hexdigest(), data
+
+
+class CachedCatalogMixin:
+    """Serve list and retrieve from the versioned catalog cache, with ETags"""
+
+    def catalog_key(self, request):
+        # Responses hold absolute URLs, so the host is part of the key
+        raw = f'{request.get_host()}{request.get_full_path()}'
+        return f'{self.basename}:{self.action}:{hashlib.sha1(raw.encode()).hexdigest()}'
+
+    def list(self, request, *args, **kwargs):
+        parent = super()
+        etag, data = catalog.get_or_build(
+            self.catalog_key(request), lambda: _tagged(parent.list(request, *args, **kwargs).data)
+        )
+        return conditional_response(request, etag, lambda: data)
+
+    def retrieve(self, request, *args, **kwargs):
+        parent = super()
+        etag, data = catalog.get_or_build(
+            self.catalog_key(request), lambda: _tagged(parent.retrieve(request, *args, **kwargs).data)
+        )
+        return conditional_response(request, etag, lambda: data)
+
+
 # User Registration  and Profile
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -57,14 +122,45 @@ class UserViewSet(viewsets.ModelViewSet):
     def toggle_looking_for_team(self, request):
         user = request.user
         user.is_looking_for_team = not user.is_looking_for_team
-        user.save()
+        # Only the flag, a full save would overwrite counters updated in the meantime
+        user.save(update_fields=['is_looking_for_team'])
         return Response({'is_looking_for_team': user.is_looking_for_team})
     
     @action(detail=False, methods=['get'])
     def looking_for_team(self, request):
-        users = User.objects.filter(is_looking_for_team=True).exclude(id=request.user.id)
-        serializer = self.get_serializer(users, many=True, context={'request': request})  # ADD context
-        return Response(serializer.data)
+        """Free agents, best match first, in cursor pages
+
+        gender, min_age and max_age filter. position and futsal (the
+        caller's home futsal by default) rank matching players first, then
+        the most experienced.
+        """
+        params = request.query_params
+        position = params.get('position')
+        if position and position not in dict(User.POSITION_CHOICES):
+            return Response({'error': 'Invalid position'}, status=status.HTTP_400_BAD_REQUEST)
+        gender = params.get('gender')
+        if gender and gender not in dict(User.GENDER_CHOICES):
+            return Response({'error': 'Invalid gender'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            futsal_id, min_age, max_age = (
+                int(params[name]) if params.get(name) else None for name in ('futsal', 'min_age', 'max_age')
+            )
+        except ValueError:
+            return Response({'error': 'futsal, min_age and max_age must be numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if any(value is not None and value < 0 for value in (min_age, max_age)):
+            return Response({'error': 'Ages cannot be negative'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        if futsal_id is None:
+            futsal_id = request.user.futsal_id
+        players = matchmaking.free_agents(
+            position=position, gender=gender, futsal_id=futsal_id,
+            min_age=min_age, max_age=max_age, exclude=request.user.id,
+        )
+        paginator = FreeAgentPagination()
+        page = paginator.paginate_queryset(players, request, view=self)
+        serializer = FreeAgentSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
         
     
     @action(detail=False, methods=['post'], parser_classes=[MultiPartParser, FormParser])
@@ -78,16 +174,10 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Delete old profile picture if exists
-        if user.profile_picture:
-            try:
-                user.profile_picture.delete(save=False)
-            except:
-                pass
-        
+        # The old file is left to collect_media_orphans, another row may share it
         # Save new profile picture
         user.profile_picture = request.FILES['profile_picture']
-        user.save()
+        user.save(update_fields=['profile_picture'])
         
         # Return updated user data with context
         serializer = self.get_serializer(user, context={'request': request})
@@ -98,16 +188,9 @@ class UserViewSet(viewsets.ModelViewSet):
         """Remove profile picture"""
         user = request.user
 
-        if user.profile_picture:
-            try:
-                # Delete the file
-                user.profile_picture.delete(save=False)
-            except:
-                pass
-
-        # Set to null
+        # Set to null, the file is left to collect_media_orphans
         user.profile_picture = None
-        user.save()
+        user.save(update_fields=['profile_picture'])
 
         # Return updated user data
         serializer = self.get_serializer(user, context={'request': request})
@@ -196,13 +279,58 @@ def reset_password(request):
             status=400
         )
 # Futsal & Grounds
-class FutsalViewSet(viewsets.ModelViewSet):
-    queryset = Futsal.objects.filter(is_active=True)
+class FutsalViewSet(CachedCatalogMixin, viewsets.ModelViewSet):
+    queryset = Futsal.objects.filter(is_active=True).order_by('id')
     serializer_class = FutsalSerializer
     permission_classes = [AllowAny]
     filter_backends = [filters.SearchFilter]
     search_fields = ['name', 'location']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            # Grounds are nested in the response
+            queryset = queryset.prefetch_related('grounds')
+        return queryset
     
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """Closest venues to ?lat=&lng= within ?radius= km, optionally only those free on ?date="""
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            radius = float(request.query_params.get('radius', 10))
+            limit = int(request.query_params.get('limit', 20))
+        except (KeyError, ValueError):
+            return Response({'error': 'lat and lng parameters required, radius and limit must be numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+            return Response({'error': 'Invalid coordinates'}, status=status.HTTP_400_BAD_REQUEST)
+        if not (0 < radius <= MAX_NEARBY_RADIUS_KM) or not (0 < limit <= MAX_NEARBY_RESULTS):
+            return Response({'error': f'radius must be up to {MAX_NEARBY_RADIUS_KM} km and limit up to '
+                                      f'{MAX_NEARBY_RESULTS}'},
+                          status=status.HTTP_400_BAD_REQUEST)
+
+        date = request.query_params.get('date')
+        if date:
+            date = parse_date(date)
+            if not date:
+                return Response({'error': 'Invalid date format. Use YYYY-MM-DD'},
+                              status=status.HTTP_400_BAD_REQUEST)
+
+        futsals = geo.nearest(self.get_queryset(), lat, lng, radius).prefetch_related('grounds')
+        if date:
+            # Every venue in range is checked in one availability query, then the closest free ones kept
+            futsals = list(futsals)
+            counts = availability.free_slot_counts([futsal.id for futsal in futsals], date)
+            futsals = [futsal for futsal in futsals if counts.get(futsal.id)]
+            for futsal in futsals:
+                futsal.free_slots = counts[futsal.id]
+        futsals = futsals[:limit]
+
+        serializer = NearbyFutsalSerializer(futsals, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
     @action(detail=True, methods=['get'])
     def available_slots(self, request, pk=None):
         futsal = self.get_object()
@@ -212,16 +340,41 @@ class FutsalViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Date parameter required'}, 
                           status=status.HTTP_400_BAD_REQUEST)
         
-        slots = TimeSlot.objects.filter(
-            ground__futsal=futsal,
-            date=date,
-            is_booked=False
+        date = parse_date(date)
+        if not date:
+            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        # Answered from the availability index, TimeSlot is not touched
+        return conditional_response(
+            request,
+            availability.etag(futsal.grounds.all(), date, date),
+            lambda: availability.slots_for(date, futsal=futsal),
         )
-        serializer = TimeSlotSerializer(slots, many=True)
-        return Response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def calendar(self, request, pk=None):
+        """Availability of every ground over a date range in one response"""
+        futsal = self.get_object()
+        start = parse_date(request.query_params.get('start') or '')
+        end = parse_date(request.query_params.get('end') or '')
+        
+        if not start or not end:
+            return Response({'error': 'start and end parameters required (YYYY-MM-DD)'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if end < start or (end - start).days >= MAX_CALENDAR_DAYS:
+            return Response({'error': f'Date range must cover 1 to {MAX_CALENDAR_DAYS} days'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        return conditional_response(request, availability.etag(futsal.grounds.all(), start, end), lambda: {
+            'futsal': futsal.id,
+            'start': start,
+            'end': end,
+            'grounds': availability.calendar(futsal, start, end),
+        })
 
-class GroundViewSet(viewsets.ModelViewSet):
-    queryset = Ground.objects.all()
+class GroundViewSet(CachedCatalogMixin, viewsets.ModelViewSet):
+    queryset = Ground.objects.order_by('id')
     serializer_class = GroundSerializer
     
     def get_permissions(self):
@@ -234,9 +387,10 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
     queryset = TimeSlot.objects.all()
     serializer_class = TimeSlotSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OptionalSlotKeysetPagination
     
     def get_queryset(self):
-        queryset = TimeSlot.objects.all()
+        queryset = TimeSlot.objects.select_related('ground')
         ground_id = self.request.query_params.get('ground')
         date = self.request.query_params.get('date')
         available_only = self.request.query_params.get('available')
@@ -249,6 +403,40 @@ class TimeSlotViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(is_booked=False)
         
         return queryset.order_by('date', 'start_time')
+    
+    def list(self, request, *args, **kwargs):
+        ground_id = request.query_params.get('ground')
+        date = parse_date(request.query_params.get('date') or '')
+        
+        # A single ground/day is what the app asks for, serve it from the index
+        if ground_id and ground_id.isdigit() and date:
+            def build():
+                slots = availability.slots_for(
+                    date,
+                    available_only=bool(request.query_params.get('available')),
+                    id=ground_id,
+                )
+                page = self.paginate_queryset(slots)
+                if page is not None:
+                    return self.get_paginated_response(page).data
+                return slots
+
+            grounds = Ground.objects.filter(id=ground_id)
+            return conditional_response(request, availability.etag(grounds, date, date), build)
+        return super().list(request, *args, **kwargs)
+    
+    def perform_create(self, serializer):
+        slot = serializer.save()
+        availability.rebuild([slot.ground_id], [slot.date])
+    
+    def perform_update(self, serializer):
+        old_ground_id, old_date = serializer.instance.ground_id, serializer.instance.date
+        slot = serializer.save()
+        availability.rebuild({old_ground_id, slot.ground_id}, {old_date, slot.date})
+    
+    def perform_destroy(self, instance):
+        instance.delete()
+        availability.rebuild([instance.ground_id], [instance.date])
 
 # Teams
 class TeamViewSet(viewsets.ModelViewSet):
@@ -302,6 +490,49 @@ class TeamViewSet(viewsets.ModelViewSet):
         team.members.remove(request.user)
         return Response({'message': 'Left team successfully'})
     
+    @action(detail=True, methods=['get'])
+    def opponents(self, request, pk=None):
+        """Teams to play, closest in matches played first, with slots free for both sides
+
+        Looks ?days= (default 14) ahead from ?from= (default today), on the
+        grounds of ?futsal= or of every active venue.
+        """
+        team = self.get_object()
+        user = request.user
+        if team.captain_id != user.id and not team.members.filter(id=user.id).exists() and not user.is_staff:
+            return Response({'error': 'Only team members can look for opponents'},
+                          status=status.HTTP_403_FORBIDDEN)
+        
+        params = request.query_params
+        start = parse_date(params['from']) if params.get('from') else timezone.localdate()
+        if start is None:
+            return Response({'error': 'Invalid date format. Use YYYY-MM-DD'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        try:
+            days = int(params.get('days', 14))
+            limit = int(params.get('limit', 10))
+            futsal_id = int(params['futsal']) if params.get('futsal') else None
+        except ValueError:
+            return Response({'error': 'days, limit and futsal must be numbers'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        if not (0 < days <= MAX_OPPONENT_DAYS) or not (0 < limit <= MAX_OPPONENT_RESULTS):
+            return Response({'error': f'days must be up to {MAX_OPPONENT_DAYS} and limit up to '
+                                      f'{MAX_OPPONENT_RESULTS}'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        grounds = Ground.objects.filter(is_available=True, futsal__is_active=True).only('id', 'name')
+        if futsal_id is not None:
+            grounds = grounds.filter(futsal_id=futsal_id)
+        found = opponents.find(team, grounds, max(start, timezone.localdate()),
+                               start + timedelta(days=days - 1), limit=limit)
+        return Response([
+            {
+                'team': {'id': opponent.id, 'name': opponent.name, 'matches_count': opponent.matches_count},
+                'options': options,
+            }
+            for opponent, options in found
+        ])
+    
     @action(detail=False, methods=['get'], url_path='my-teams')
     def my_teams(self, request):
         from django.db.models import Count, Q
@@ -318,6 +549,7 @@ class BookingViewSet(viewsets.ModelViewSet):
     queryset = Booking.objects.all()
     serializer_class = BookingSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OptionalKeysetPagination
 
     def get_permissions(self):
         if self.action == 'khalti_verify':
@@ -332,31 +564,26 @@ class BookingViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         user = self.request.user
         
-        # Check if user is eligible for free booking
-        is_free_booking = user.is_eligible_for_reward()
-        
-        # Create the booking
-        booking = serializer.save(
-            user=user,
-            is_free_booking=is_free_booking  # Mark as free if eligible
-        )
+        # Claiming the reward is a single conditional UPDATE, parallel bookings
+        # of the same user cannot both get the same free booking
+        is_free_booking = loyalty.claim_reward(user.id)
         
-        # Update user's booking counts
-        if is_free_booking:
-            # Reset counter after claiming reward
-            user.bookings_since_reward = 0
-            user.total_rewards_claimed += 1
-        else:
-            # Increment counters for paid booking
-            user.total_bookings += 1
-            user.bookings_since_reward += 1
+        try:
+            booking = serializer.save(
+                user=user,
+                is_free_booking=is_free_booking  # Mark as free if eligible
+            )
+        except Exception:
+            if is_free_booking:
+                loyalty.refund_reward(user.id)
+            raise
         
-        user.save()
+        # Ledger entry plus an atomic increment of the counters for paid bookings
+        loyalty.record([booking])
         
         # Update team matches if applicable
-        if booking.team:
-            booking.team.matches_count += 1
-            booking.team.save()
+        if booking.team_id:
+            Team.objects.filter(id=booking.team_id).update(matches_count=F('matches_count') + 1)
     
     @action(detail=True, methods=['post'])
     def cancel(self, request, pk=None):
@@ -365,13 +592,21 @@ class BookingViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Not authorized'}, 
                           status=status.HTTP_403_FORBIDDEN)
         
-        booking.status = 'CANCELLED'
-        booking.save()
-        
-        # Free up the time slot
-        time_slot = booking.time_slot
-        time_slot.is_booked = False
-        time_slot.save()
+        # Only the request that actually flips a CONFIRMED booking frees the slot.
+        # A repeated cancel, or one of a completed booking, must not release a
+        # slot somebody else has booked since
+        with transaction.atomic():
+            cancelled = Booking.objects.filter(id=booking.id, status='CONFIRMED').update(
+                status='CANCELLED', updated_at=timezone.now()
+            )
+            if not cancelled:
+                return Response({'error': 'Only confirmed bookings can be cancelled'},
+                              status=status.HTTP_400_BAD_REQUEST)
+            
+            # Free up the time slot
+            time_slot = booking.time_slot
+            TimeSlot.objects.filter(id=time_slot.id).update(is_booked=False)
+            availability.mark_free(time_slot)
         
         return Response({'message': 'Booking cancelled'})
     
@@ -382,12 +617,14 @@ class BookingViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Admin only'}, 
                           status=status.HTTP_403_FORBIDDEN)
         
-        booking.status = 'COMPLETED'
-        booking.save()
+        # Only the request that flips the status counts the match
+        completed = Booking.objects.filter(id=booking.id).exclude(
+            status='COMPLETED'
+        ).update(status='COMPLETED', updated_at=timezone.now())
         
         # Increment matches played for user
-        booking.user.matches_played += 1
-        booking.user.save()
+        if completed:
+            User.objects.filter(id=booking.user_id).update(matches_played=F('matches_played') + 1)
         
         return Response({'message': 'Booking marked as completed'})
 
@@ -402,11 +639,21 @@ class BookingViewSet(viewsets.ModelViewSet):
         if not time_slot_ids or not total_amount:
             return Response({'error': 'Missing data'}, status=status.HTTP_400_BAD_REQUEST)
         
+        # Virtual slots get their TimeSlot row now so verification can book them
+        try:
+            time_slot_ids = availability.materialize(time_slot_ids)
+        except (TypeError, ValueError):
+            return Response({'error': 'Invalid time slot'}, status=status.HTTP_400_BAD_REQUEST)
+        
         # Generate unique booking reference
         booking_ref = f"BOOK_{request.user.id}_{secrets.token_hex(8)}"
         
-        khalti_url = "https://a.khalti.com/api/v2/epayment/initiate/"
-        khalti_secret_key =os.getenv('KHALTI_SECRET_KEY') 
+        # Reserve the slots before sending anyone to pay for them
+        try:
+            holds.hold_slots(time_slot_ids, booking_ref)
+        except holds.SlotsHeld:
+            return Response({'error': 'Some of these slots are no longer available'},
+                          status=status.HTTP_409_CONFLICT)
         
         payload = {
            "return_url": f"http://localhost:8000/api/khalti-verify/?ref={booking_ref}",
@@ -421,16 +668,10 @@ class BookingViewSet(viewsets.ModelViewSet):
             }
         }
         
-        headers = {
-            "Authorization": f"Key {khalti_secret_key}",
-            "Content-Type": "application/json"
-        }
-        
         try:
-            response = requests.post(khalti_url, json=payload, headers=headers)
-            response_data = response.json()
+            status_code, response_data = khalti.get_client().initiate(payload)
             
-            if response.status_code == 200:
+            if status_code == 200:
                 # Storing booking data in database cause sessions may not be reliable for long-term storage
                 # Alternatively, we can use cache or a temporary model
                 PendingBooking.objects.create(
@@ -447,11 +688,16 @@ class BookingViewSet(viewsets.ModelViewSet):
                     'booking_ref': booking_ref
                 })
             else:
+                holds.release(booking_ref)
                 return Response(
                     {'error': 'Payment initiation failed', 'details': response_data},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+        except khalti.KhaltiError as e:
+            holds.release(booking_ref)
+            return Response({'error': 'Payment gateway unavailable'}, status=status.HTTP_502_BAD_GATEWAY)
         except Exception as e:
+            holds.release(booking_ref)
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Tournaments
@@ -481,11 +727,48 @@ class TournamentViewSet(viewsets.ModelViewSet):
                               status=status.HTTP_400_BAD_REQUEST)
             
             tournament.registered_teams.add(team)
+            standings.ensure(tournament.id, [team.id])
             return Response({'message': 'Team registered successfully'})
         except Team.DoesNotExist:
             return Response({'error': 'Team not found'}, 
                           status=status.HTTP_404_NOT_FOUND)
 
+    @action(detail=True, methods=['post'])
+    def generate_fixtures(self, request, pk=None):
+        """Pair the registered teams and schedule the matches in free ground slots"""
+        tournament = self.get_object()
+        grounds = Ground.objects.filter(is_available=True, futsal__is_active=True)
+        ground_ids = request.data.get('grounds')
+        if ground_ids:
+            grounds = grounds.filter(id__in=ground_ids)
+        try:
+            rest_hours = int(request.data.get('rest_hours', 1))
+        except (TypeError, ValueError):
+            return Response({'error': 'rest_hours must be a number'},
+                          status=status.HTTP_400_BAD_REQUEST)
+        
+        try:
+            fixtures = scheduler.generate(
+                tournament, request.data.get('format', 'round_robin'), grounds, rest_hours=max(rest_hours, 0)
+            )
+        except scheduler.SchedulingError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        fixtures = Fixture.objects.filter(id__in=[fixture.id for fixture in fixtures]).select_related(
+            'tournament', 'team1', 'team2', 'ground'
+        ).order_by('match_date', 'match_time')
+        return Response(FixtureSerializer(fixtures, many=True).data, status=status.HTTP_201_CREATED)
+    
+    @action(detail=True, methods=['get'])
+    def standings(self, request, pk=None):
+        """League table, read from the standings kept up to date as results come in"""
+        tournament = self.get_object()
+        rows = Standing.objects.filter(tournament=tournament).select_related('team')
+        data = StandingSerializer(standings.ordered(rows), many=True).data
+        for position, row in enumerate(data, start=1):
+            row['position'] = position
+        return Response(data)
+
 # Fixtures
 class FixtureViewSet(viewsets.ModelViewSet):
     queryset = Fixture.objects.all()
@@ -503,30 +786,91 @@ class FixtureViewSet(viewsets.ModelViewSet):
         if tournament_id:
             queryset = queryset.filter(tournament_id=tournament_id)
         return queryset.order_by('match_date', 'match_time')
+    
+    @transaction.atomic
+    def perform_create(self, serializer):
+        fixture = serializer.save()
+        self._book(fixture)
+    
+    # The result a fixture had and the one it gets are swapped in the standings together,
+    # and a moved fixture gives its old slot back
+    @transaction.atomic
+    def perform_update(self, serializer):
+        before = copy.copy(serializer.instance)
+        fixture = serializer.save()
+        moved = (before.ground_id, before.match_date, before.match_time.hour) != (
+            fixture.ground_id, fixture.match_date, fixture.match_time.hour
+        )
+        if moved:
+            scheduler.release_slots([before])
+            self._book(fixture)
+    
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        instance.delete()
+        scheduler.release_slots([instance])
+    
+    def _book(self, fixture):
+        try:
+            scheduler.book_slots([fixture])
+        except scheduler.SchedulingError as e:
+            raise ValidationError({'match_time': [str(e)]})
 
 # Community Posts
 class PostViewSet(viewsets.ModelViewSet):
     queryset = Post.objects.all()
     serializer_class = PostSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OptionalKeysetPagination
     filter_backends = [filters.SearchFilter]
     search_fields = ['title', 'content']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        q = self.request.query_params.get('q')
+        if q and self.action in ('list', 'feed'):
+            # Full-text search: stemmed words, "quoted phrases", OR and -excluded terms
+            query = SearchQuery(q, search_type='websearch', config='english')
+            queryset = queryset.filter(search_vector=query).annotate(
+                rank=SearchRank(F('search_vector'), query)
+            ).order_by('-rank', '-created_at')
+        return queryset
     
     def get_serializer_context(self):
         return {'request': self.request}
     
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
+
+    @action(detail=False, methods=['get'])
+    def feed(self, request):
+        """Paginated posts with their counts and latest comments, in three queries per page"""
+        page = self.paginate_queryset(self.feed_queryset(self.filter_queryset(self.get_queryset())))
+        likes.overlay(page)
+        serializer = FeedPostSerializer(page, many=True, context=self.get_serializer_context())
+        return self.get_paginated_response(serializer.data)
+
+    def feed_queryset(self, posts):
+        Like = Post.likes.through
+        latest_comments = (
+            Comment.objects.select_related('author')
+            .annotate(feed_rank=Window(RowNumber(), partition_by=F('post'), order_by=F('created_at').desc()))
+            .filter(feed_rank__lte=FEED_PREVIEW_COMMENTS)
+            .order_by('created_at')
+        )
+        return posts.select_related('author').annotate(
+            comments_count=Coalesce(Subquery(
+                Comment.objects.filter(post=OuterRef('pk')).values('post').annotate(n=Count('*')).values('n')
+            ), Value(0)),
+            is_liked=Exists(Like.objects.filter(post=OuterRef('pk'), user=self.request.user.pk)),
+        ).prefetch_related(Prefetch('comments', queryset=latest_comments, to_attr='latest_comments'))
     
     @action(detail=True, methods=['post'])
     def like(self, request, pk=None):
         post = self.get_object()
-        if post.likes.filter(id=request.user.id).exists():
-            post.likes.remove(request.user)
-            return Response({'message': 'Unliked', 'likes_count': post.total_likes()})
-        else:
-            post.likes.add(request.user)
-            return Response({'message': 'Liked', 'likes_count': post.total_likes()})
+        # The like itself is written now, only the counter is batched
+        liked, likes_count = likes.toggle(post, request.user.id)
+        return Response({'message': 'Liked' if liked else 'Unliked', 'likes_count': likes_count})
     
     @action(detail=True, methods=['post'])
     def add_comment(self, request, pk=None):
@@ -547,7 +891,7 @@ class PostViewSet(viewsets.ModelViewSet):
 
 # Comments
 class CommentViewSet(viewsets.ModelViewSet):
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.select_related('author')
     serializer_class = CommentSerializer
     permission_classes = [IsAuthenticated]
     
@@ -559,64 +903,117 @@ class CommentViewSet(viewsets.ModelViewSet):
 @api_view(['GET'])
 @permission_classes([AllowAny])
 def khalti_payment_verify(request):
-    """Verify Khalti payment and create booking"""
+    """Record the Khalti callback, the payment worker verifies it and creates the booking"""
     booking_ref = request.query_params.get('ref')
     pidx = request.query_params.get('pidx')
     
-    print(f"🔵 Verifying payment - ref: {booking_ref}, pidx: {pidx}")
+    print(f"🔵 Payment callback - ref: {booking_ref}, pidx: {pidx}")
     
     if not booking_ref or not pidx:
         return Response({'error': 'Invalid callback'}, status=status.HTTP_400_BAD_REQUEST)
     
-    # Get booking data from database
-    try:
-        pending = PendingBooking.objects.get(booking_ref=booking_ref)
-    except PendingBooking.DoesNotExist:
-        return Response({'error': 'Booking data not found'}, status=status.HTTP_404_NOT_FOUND)
-    
-    khalti_url = "https://a.khalti.com/api/v2/epayment/lookup/"
-    khalti_secret_key = os.getenv('KHALTI_SECRET_KEY')
+    verification = PaymentVerification.objects.filter(booking_ref=booking_ref).first()
+    if verification is None:
+        if not PendingBooking.objects.filter(booking_ref=booking_ref).exists():
+            return Response({'error': 'Booking data not found'}, status=status.HTTP_404_NOT_FOUND)
+        # Khalti may call back more than once, the unique ref keeps one job
+        verification, _ = PaymentVerification.objects.get_or_create(
+            booking_ref=booking_ref, defaults={'pidx': pidx}
+        )
     
-    headers = {
-        "Authorization": f"Key {khalti_secret_key}",
-        "Content-Type": "application/json"
+    return Response(_verification_data(verification), status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def payment_status(request):
+    """Poll the outcome of a payment callback"""
+    verification = PaymentVerification.objects.filter(
+        booking_ref=request.query_params.get('ref')
+    ).first()
+    if verification is None:
+        return Response({'error': 'Payment not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(_verification_data(verification))
+
+
+def _verification_data(verification):
+    return {
+        'booking_ref': verification.booking_ref,
+        'status': verification.status.lower(),
+        'message': verification.message,
+        'updated_at': verification.updated_at,
     }
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def catalog_cache_stats(request):
+    """Hit and miss counters of the catalog cache in this process"""
+    return Response(catalog.stats())
+
+
+@require_safe
+def media_file(request, path):
+    """Uploaded file with long-lived caching, sent by the web server when MEDIA_OFFLOAD is set"""
+    return media.file_response(path)
+
+
+async def availability_stream(request, futsal_id):
+    """Server-Sent Events with the slot changes of a futsal on ?date=
+
+    Opens with a ``snapshot`` event holding the free slots, then relays
+    ``booked``, ``freed``, ``held``, ``released``, ``changed`` and
+    ``resync`` events as they happen. Needs the ASGI entry point, e.g.
+    ``uvicorn futsal_project.asgi:application``.
+    """
+    date = parse_date(request.GET.get('date') or '')
+    if not date:
+        return JsonResponse({'error': 'Invalid date format. Use YYYY-MM-DD'}, status=400)
+    ground_ids = await sync_to_async(_stream_grounds, thread_sensitive=False)(futsal_id)
+    if ground_ids is None:
+        return JsonResponse({'error': 'Futsal not found'}, status=404)
+
+    async def events():
+        subscription = live.broker.subscribe((ground_id, date.isoformat()) for ground_id in ground_ids)
+        try:
+            await live.broker.ready()
+            # Subscribed before the snapshot is read, so no change falls in between
+            snapshot = await sync_to_async(_stream_snapshot, thread_sensitive=False)(date, futsal_id)
+            yield _sse('snapshot', snapshot)
+            while True:
+                try:
+                    event = await subscription.get(timeout=SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield _sse(event['event'], event)
+        finally:
+            live.broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# The stream's database work runs on the shared executor and gives its
+# connection back right away, idle streams must not hold one each
+def _stream_grounds(futsal_id):
     try:
-        response = requests.post(khalti_url, json={"pidx": pidx}, headers=headers)
-        payment_data = response.json()
-        
-        print(f"🔵 Khalti response status: {response.status_code}")
-        print(f"🔵 Khalti response data: {payment_data}")
-        
-        if response.status_code == 200 and payment_data.get('status') == 'Completed':
-            # Payment verified, Create bookings
-            for slot_id in pending.time_slot_ids:
-                time_slot = TimeSlot.objects.get(id=slot_id)
-                
-                Booking.objects.create(
-                    user=pending.user,
-                    time_slot=time_slot,
-                    ground=time_slot.ground,
-                    amount_paid=pending.total_amount / 100,
-                    payment_status='PAID',
-                    status='CONFIRMED',
-                    notes=f'Khalti Payment - {payment_data.get("transaction_id")}'
-                )
-                
-                time_slot.is_booked = True
-                time_slot.save()
-            # Delete pending booking
-            pending.delete()
-            print("✅ All done!")
-            
-            return Response({
-                'status': 'success',
-                'message': 'Booking confirmed!'
-            })
-        else:
-            return Response(
-                {'status': 'failed', 'message': 'Payment verification failed'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-    except Exception as e:
-        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        if not Futsal.objects.filter(id=futsal_id, is_active=True).exists():
+            return None
+        return list(Ground.objects.filter(futsal_id=futsal_id).values_list('id', flat=True))
+    finally:
+        connection.close()
+
+
+def _stream_snapshot(date, futsal_id):
+    try:
+        return availability.slots_for(date, futsal_id=futsal_id)
+    finally:
+        connection.close()
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
@@ -1,5 +1,9 @@
+import os
 from pathlib import Path
 from datetime import timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -17,6 +21,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third party
     'rest_framework',
@@ -91,6 +96,15 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 # Media files
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+STORAGES = {
+    'default': {'BACKEND': 'futsal.media.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+# Who sends media bytes: '' Django itself (DEBUG only), 'x-accel' nginx, 'x-sendfile' Apache/lighttpd.
+# Web server setup is in futsal/media.py
+MEDIA_OFFLOAD = os.getenv('MEDIA_OFFLOAD', '')
+MEDIA_ACCEL_PREFIX = '/protected-media/'  # nginx `internal` location aliased to MEDIA_ROOT
+MEDIA_ORPHAN_GRACE = timedelta(days=1)  # unreferenced files younger than this are kept
 
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -122,3 +136,47 @@ SIMPLE_JWT = {
 CORS_ALLOW_ALL_ORIGINS = True  # Change in production
 CORS_ALLOW_CREDENTIALS = True
 
+# Khalti payment gateway
+KHALTI_BASE_URL = os.getenv('KHALTI_BASE_URL', 'https://a.khalti.com/api/v2/')
+KHALTI_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+KHALTI_RETRIES = 2
+KHALTI_BACKOFF = 0.5  # seconds, doubled on every retry
+KHALTI_POOL_SIZE = 20  # keep-alive connections per process
+
+# Payment verification worker (run_payment_worker)
+PAYMENT_MAX_ATTEMPTS = 6
+PAYMENT_RETRY_DELAY = 5  # seconds before the first retry, doubled on every retry
+
+# How long slots stay reserved for a checkout that has not been paid yet
+SLOT_HOLD_TTL = timedelta(minutes=20)
+# How far ahead schedule-driven slots can be booked
+BOOKING_HORIZON_DAYS = 90
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+if os.getenv('REDIS_URL'):
+    # Shared by every process, needs the redis package
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    }
+
+# Venue and ground catalog cache (futsal.catalog)
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24
+CATALOG_PROCESS_CACHE_TIMEOUT = 30  # without REDIS_URL each process caches on its own, briefly
+CATALOG_LOCAL_TTL = 5  # seconds a process trusts its copy of the catalog version
+CATALOG_LOCAL_MAX_ENTRIES = 500
+
+# Like counter changes are buffered per process and written in batches (futsal.likes)
+LIKE_FLUSH_SIZE = 500  # posts with a pending change
+LIKE_FLUSH_INTERVAL = 2  # seconds
+
+# A free booking for every this many paid ones (futsal.loyalty)
+LOYALTY_REWARD_AFTER = 7
+
+# Threads per process rendering resized image variants (futsal.images)
+IMAGE_VARIANT_WORKERS = 2
@@ -1,12 +1,21 @@
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.conf import settings
-from django.conf.urls.static import static
+from django.core.exceptions import ImproperlyConfigured
+from futsal.media import OFFLOADS
+from futsal.views import media_file
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('futsal.urls')),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+if settings.MEDIA_OFFLOAD not in OFFLOADS:
+    raise ImproperlyConfigured(f'MEDIA_OFFLOAD must be one of {", ".join(map(repr, OFFLOADS))}')
+
+# Without an offload Django would stream every file itself, outside of development
+# the web server serves MEDIA_ROOT at MEDIA_URL directly instead
+if settings.DEBUG or settings.MEDIA_OFFLOAD:
+    urlpatterns.append(
+        re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)$', media_file, name='media_file'),
+    )